@@ -0,0 +1,156 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Benchmark the hashing of config files
+
+Builds a template tree where every file extends a few others and compares
+``build.addHashes`` with the previous implementation, which re-parsed every
+file and did a string replace for every hash. Usage::
+
+  $ bin/python benchmarks/bench_addhashes.py [number-of-files]
+
+$Id$
+"""
+import ConfigParser
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from keas.build import base, build
+
+def makeTree(directory, count):
+    # some names are a suffix of others
+    names = ['base.cfg', 'mybase.cfg', 'ourbase.cfg', 'yourbase.cfg']
+    names += ['part-%03i.cfg' % i for i in range(count - len(names))]
+    rand = random.Random(42)
+    for index, name in enumerate(names):
+        # every file extends the one before and a few random ones
+        extends = names[max(index-1, 0):index]
+        extends += rand.sample(names[:max(index-1, 0)], min(max(index-1, 0), 2))
+        content = '[buildout]\n'
+        if extends:
+            content += 'extends = %s\n' % ' '.join(extends)
+        content += 'parts = %s\n\n[%s]\nvalue = %i\n' % (
+            name[:-4], name[:-4], index)
+        open(os.path.join(directory, name), 'w').write(content)
+    project = os.path.join(directory, 'project.cfg')
+    open(project, 'w').write(
+        '[buildout]\nextends = %s\n' % names[-1])
+    return project
+
+def addHashesBefore(dependencies, hashes, rename=True):
+    # the implementation before the single pass rewrite
+    rdep = []
+    for fname in dependencies:
+        modified = False
+        justname = os.path.split(fname)[-1]
+
+        config = base.NonDestructiveRawConfigParser()
+        config.read(fname)
+
+        try:
+            extends = config.get('buildout', 'extends')
+            for oldname, hash in hashes.items():
+                parts = os.path.splitext(oldname)
+                newname = "%s-%s%s" % (parts[0], hash, parts[1])
+
+                if oldname in extends:
+                    extends = extends.replace(oldname, newname)
+                    modified = True
+
+            if modified:
+                config.set('buildout', 'extends', extends)
+        except ConfigParser.NoSectionError:
+            pass
+        except ConfigParser.NoOptionError:
+            pass
+
+        newname = justname
+        if rename:
+            try:
+                hash = hashes[justname]
+                parts = os.path.splitext(justname)
+                newname = "%s-%s%s" % (parts[0], hash, parts[1])
+                modified = True
+            except KeyError:
+                pass
+
+        if modified:
+            config.write(open(newname, 'w'))
+            rdep.append(newname)
+        else:
+            rdep.append(fname)
+
+    return rdep
+
+def brokenExtends(filenames):
+    # the number of extends that point to files that were not written
+    broken = 0
+    for filename in filenames:
+        config = base.NonDestructiveRawConfigParser()
+        config.read(filename)
+        try:
+            extends = config.get('buildout', 'extends').split()
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            continue
+        broken += len([name for name in extends if not os.path.exists(name)])
+    return broken
+
+def bench(func, project, templates):
+    outdir = tempfile.mkdtemp()
+    here = os.getcwd()
+    os.chdir(outdir)
+    try:
+        hashes = {}
+        graph = build.ExtendsGraph()
+        dependencies = build.getDependentConfigFiles(
+            templates, project, addSelf=False, hashes=hashes, graph=graph)
+        start = time.time()
+        result = func(dependencies, hashes, graph)
+        duration = time.time() - start
+        return duration, len(result), brokenExtends(result)
+    finally:
+        os.chdir(here)
+        shutil.rmtree(outdir)
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    count = 500
+    if args:
+        count = int(args[0])
+    base.logger.addHandler(logging.StreamHandler(sys.stdout))
+    templates = tempfile.mkdtemp()
+    try:
+        project = makeTree(templates, count)
+        print 'Template tree with %i files' % count
+
+        duration, written, broken = bench(
+            lambda deps, hashes, graph: build.addHashes(
+                deps, hashes, graph=graph),
+            project, templates)
+        print 'addHashes:        %8.3f s, %i files, %i broken extends' % (
+            duration, written, broken)
+        beforeDuration, written, broken = bench(
+            lambda deps, hashes, graph: addHashesBefore(deps, hashes),
+            project, templates)
+        print 'before:           %8.3f s, %i files, %i broken extends (%.1fx)' % (
+            beforeDuration, written, broken, beforeDuration / duration)
+    finally:
+        shutil.rmtree(templates)
+
+if __name__ == '__main__':
+    main()
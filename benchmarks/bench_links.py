@@ -0,0 +1,91 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Benchmark the link extraction of index pages
+
+Compares ``base.iterLinks`` with the BeautifulSoup 3 scraping used before,
+if BeautifulSoup is installed. Usage::
+
+  $ bin/python benchmarks/bench_links.py [number-of-files]
+
+$Id$
+"""
+import re
+import sys
+import time
+from keas.build import base
+
+PACKAGE = 'twollo.web'
+VERSION = re.compile(PACKAGE+r'-(\d+\.\d+(\.\d+){0,2})')
+
+def makePage(count):
+    rows = ['<tr><td><a href="%s-1.%i.%i.tar.gz">%s-1.%i.%i.tar.gz</a></td>'
+            '<td>2013-11-28 12:00</td><td>42K</td></tr>' % (
+                PACKAGE, i // 100, i % 100, PACKAGE, i // 100, i % 100)
+            for i in range(count)]
+    return ('<html><head><title>Index of /eggs/</title></head><body>'
+            '<h1>Index of /eggs/</h1><table>%s</table></body></html>'
+            % '\n'.join(rows))
+
+def versionsFromSoup(page):
+    import BeautifulSoup
+    soup = BeautifulSoup.BeautifulSoup(page)
+    versions = []
+    for tag in soup('a'):
+        m = VERSION.search(str(tag.contents[0]))
+        if m:
+            versions.append(m.group(1))
+    return versions
+
+def versionsFromLinks(page):
+    chunks = [page[i:i+16384] for i in range(0, len(page), 16384)]
+    versions = []
+    for href, text in base.iterLinks(chunks):
+        m = VERSION.search(text)
+        if m:
+            versions.append(m.group(1))
+    return versions
+
+def bench(func, page, repeat=5):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = func(page)
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return best, result
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    count = 5000
+    if args:
+        count = int(args[0])
+    page = makePage(count)
+    print 'Index page with %i files, %i KB' % (count, len(page) // 1024)
+
+    duration, versions = bench(versionsFromLinks, page)
+    print 'iterLinks:     %8.3f s' % duration
+    try:
+        import BeautifulSoup
+    except ImportError:
+        print 'BeautifulSoup: not installed'
+        return
+    soupDuration, soupVersions = bench(versionsFromSoup, page)
+    print 'BeautifulSoup: %8.3f s (%.1fx)' % (
+        soupDuration, soupDuration / duration)
+    assert versions == soupVersions
+
+if __name__ == '__main__':
+    main()
@@ -55,7 +55,6 @@ setup(
           ],
     ),
     install_requires=[
-        'BeautifulSoup',
         'setuptools',
         ],
     zip_safe = False,
@@ -63,6 +62,7 @@ setup(
     [console_scripts]
     build = keas.build.build:main
     build-package = keas.build.package:main
+    build-cache = keas.build.cache:main
     install = keas.build.install:main
     """,
     )
@@ -11,43 +11,493 @@ __docformat__ = 'ReStructuredText'
 import StringIO
 import base64
 import ConfigParser
+import HTMLParser
 import collections
+import hashlib
+import htmlentitydefs
 import httplib
+import json
 import logging
 import optparse
 import os
 import pkg_resources
+import Queue
+import re
+import shutil
+import signal
+import socket
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 from UserDict import DictMixin
+import urllib
 import urllib2
 import urlparse
+from xml.etree import ElementTree
 
 logger = logging.Logger('build')
 formatter = logging.Formatter('%(levelname)s - %(message)s')
 
+class PrefixFilter(logging.Filter):
+    """Prefix the messages of a thread, see `setLogPrefix()`."""
+
+    local = threading.local()
+
+    def filter(self, record):
+        prefix = getattr(self.local, 'prefix', None)
+        if prefix:
+            record.msg = '[%s] %s' % (prefix, record.msg)
+        return True
+
+logger.addFilter(PrefixFilter())
+
+def setLogPrefix(prefix):
+    PrefixFilter.local.prefix = prefix
+
+def getLogPrefix():
+    return getattr(PrefixFilter.local, 'prefix', None)
+
 BUILD_SECTION = 'build'
 
-def do(cmd, cwd=None, captureOutput=True):
-    logger.debug('Command: ' + cmd)
-    if captureOutput:
-        stdout = stderr = subprocess.PIPE
-    else:
-        stdout = stderr = None
-    p = subprocess.Popen(
-        cmd, stdout=stdout, stderr=stderr,
-        shell=True, cwd=cwd)
-    stdout, stderr = p.communicate()
-    if stdout is None:
-        stdout = "See output above"
-    if stderr is None:
-        stderr = "See output above"
-    if p.returncode != 0:
+# default timeout in seconds for commands, see configure()
+commandTimeout = None
+# (command, seconds) of all commands that were run
+commandTimings = []
+# how often a failed PUT is repeated, see configure()
+uploadRetries = 2
+
+class Command(object):
+    """A shell command whose output is streamed instead of buffered.
+
+    Only the last `tailSize` lines of each output stream are kept for error
+    reports, unless the whole standard output is asked for with
+    `keepOutput`.
+    """
+
+    tailSize = 50
+
+    # all commands currently running, see cancelAll()
+    running = set()
+    runningLock = threading.Lock()
+
+    returncode = None
+    duration = None
+    timedOut = False
+    cancelled = False
+    _ownGroup = False
+
+    def __init__(self, cmd, cwd=None, captureOutput=True, keepOutput=True,
+                 timeout=None):
+        self.cmd = cmd
+        self.cwd = cwd
+        self.captureOutput = captureOutput
+        self.keepOutput = keepOutput
+        self.timeout = timeout
+        self.stdoutTail = collections.deque(maxlen=self.tailSize)
+        self.stderrTail = collections.deque(maxlen=self.tailSize)
+        self.output = []
+        self.process = None
+
+    def _read(self, pipe, tail, output, prefix):
+        # the output is logged with the prefix of the thread running the
+        # command
+        setLogPrefix(prefix)
+        for line in iter(pipe.readline, ''):
+            tail.append(line)
+            if output is not None:
+                output.append(line)
+            logger.debug(line.rstrip('\r\n'))
+        pipe.close()
+
+    def _expire(self):
+        self.timedOut = True
+        self._kill()
+
+    def _kill(self):
+        try:
+            if self._ownGroup:
+                # the shell's children hold the pipes open too
+                os.killpg(self.process.pid, signal.SIGKILL)
+            else:
+                self.process.kill()
+        except OSError:
+            # already finished
+            pass
+
+    def cancel(self):
+        self.cancelled = True
+        if self.process is not None:
+            self._kill()
+
+    def run(self):
+        logger.debug('Command: ' + self.cmd)
+        pipe = None
+        if self.captureOutput:
+            pipe = subprocess.PIPE
+        # captured commands do not use the terminal, so they can run in
+        # their own process group, which is killed as a whole
+        preexec = None
+        self._ownGroup = self.captureOutput and sys.platform != 'win32'
+        if self._ownGroup:
+            preexec = os.setpgrp
+        start = time.time()
+        self.process = subprocess.Popen(
+            self.cmd, stdout=pipe, stderr=pipe, shell=True, cwd=self.cwd,
+            preexec_fn=preexec)
+        with self.runningLock:
+            self.running.add(self)
+        readers = []
+        if self.captureOutput:
+            output = None
+            if self.keepOutput:
+                output = self.output
+            for stream, tail, out in (
+                (self.process.stdout, self.stdoutTail, output),
+                (self.process.stderr, self.stderrTail, None)):
+                reader = threading.Thread(
+                    target=self._read,
+                    args=(stream, tail, out, getLogPrefix()))
+                reader.daemon = True
+                reader.start()
+                readers.append(reader)
+        timer = None
+        if self.timeout:
+            timer = threading.Timer(self.timeout, self._expire)
+            timer.daemon = True
+            timer.start()
+        try:
+            self.returncode = self.process.wait()
+            for reader in readers:
+                if self.timeout:
+                    # descendants that left the process group can keep the
+                    # pipes open after the command was killed or finished
+                    reader.join(max(start + self.timeout - time.time(), 1))
+                    if reader.isAlive():
+                        self.timedOut = True
+                else:
+                    reader.join()
+        except KeyboardInterrupt:
+            self._kill()
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+            with self.runningLock:
+                self.running.discard(self)
+            self.duration = time.time() - start
+            commandTimings.append((self.cmd, self.duration))
+        logger.debug('Command finished in %.2f seconds' % self.duration)
+        return self.returncode
+
+    def errorReport(self):
+        tail = self.stderrTail or self.stdoutTail
+        if not self.captureOutput:
+            return 'See output above'
+        return ''.join(tail)
+
+def reportTimings(count=5):
+    """Log the number and time of the commands run, and the slowest ones."""
+    if not commandTimings:
+        return
+    timings = list(commandTimings)
+    logger.info('%i commands ran in %.2f seconds' % (
+        len(timings), sum([duration for cmd, duration in timings])))
+    timings.sort(key=lambda timing: -timing[1])
+    for cmd, duration in timings[:count]:
+        # no passwords in the log
+        cmd = re.sub(r'--password \S+', '--password ***', cmd)
+        logger.info('  %.2fs %s' % (duration, cmd))
+
+def cancelAll():
+    """Cancel all commands that are currently running."""
+    with Command.runningLock:
+        commands = list(Command.running)
+    for command in commands:
+        command.cancel()
+
+def runParallel(func, items, jobs):
+    """Call `func` for each item, using at most `jobs` threads.
+
+    Returns a list of (result, excInfo) pairs in the order of the items.
+    `excInfo` is None if the call succeeded. ``sys.exit()`` calls are caught
+    too, they are how commands report errors.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    queue = Queue.Queue()
+    for index, item in enumerate(items):
+        queue.put((index, item))
+
+    def work():
+        while True:
+            try:
+                index, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = (func(item), None)
+            except BaseException:
+                results[index] = (None, sys.exc_info())
+
+    workers = []
+    for i in range(max(1, min(jobs, len(items)))):
+        worker = threading.Thread(target=work)
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        # join with timeout, so that Ctrl-C still works
+        while worker.isAlive():
+            worker.join(0.2)
+    return results
+
+def do(cmd, cwd=None, captureOutput=True, ignoreErrors=False,
+       keepOutput=True, timeout=None):
+    if timeout is None:
+        timeout = commandTimeout
+    command = Command(cmd, cwd, captureOutput, keepOutput, timeout)
+    command.run()
+    if command.timedOut:
+        logger.error(u'Command timed out after %s seconds: %s' %(
+            timeout, cmd))
+        logger.error('Error Output: \n%s' % command.errorReport())
+        sys.exit(1)
+    if command.cancelled:
+        logger.error(u'Command was cancelled: %s' %cmd)
+        sys.exit(1)
+    if command.returncode != 0:
+        if ignoreErrors:
+            logger.debug('Ignored error output: \n%s' % command.errorReport())
+            return ''.join(command.output)
         logger.error(u'An error occurred while running command: %s' %cmd)
-        logger.error('Error Output: \n%s' % stderr)
-        sys.exit(p.returncode)
-    logger.debug('Output: \n%s' % stdout)
-    return stdout
+        logger.error('Error Output: \n%s' % command.errorReport())
+        sys.exit(command.returncode)
+    if not captureOutput:
+        return "See output above"
+    return ''.join(command.output)
+
+SVNInfo = collections.namedtuple(
+    'SVNInfo', ('repoRevision', 'revision', 'url', 'root'))
+
+def normalizeURL(url):
+    # svn reports canonical URLs: unquoted here, no double or trailing slashes
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    path = urllib.unquote(path)
+    while '//' in path:
+        path = path.replace('//', '/')
+    return urlparse.urlunsplit(
+        (scheme, netloc, path.rstrip('/'), query, fragment))
+
+def parseInfo(xml):
+    """Parse the output of ``svn info --xml`` into a mapping.
+
+    The keys are the normalized entry URLs, the values `SVNInfo` tuples.
+    """
+    result = {}
+    if not xml.strip():
+        return result
+    try:
+        elem = ElementTree.fromstring(xml)
+    except SyntaxError:
+        # svn stops writing when a target is missing
+        elem = ElementTree.fromstring(xml + '</info>')
+    for entry in elem.findall('entry'):
+        repoRevision = int(entry.get('revision') or 0)
+        commit = entry.find('commit')
+        revision = 0
+        if commit is not None:
+            revision = int(commit.get('revision') or 0)
+        url = entry.findtext('url')
+        root = entry.findtext('repository/root')
+        result[normalizeURL(url)] = SVNInfo(repoRevision, revision, url, root)
+    return result
+
+class MetadataCache(object):
+    """Persistent cache of parsed svn lookup results.
+
+    An entry is valid for `ttl` seconds and only as long as the repository
+    HEAD revision did not move since it was stored.
+    """
+
+    def __init__(self, path, ttl=3600):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # HEAD revisions probed during this run, by repository URL
+        self.heads = {}
+        self.headLock = threading.Lock()
+        # counts the invalidations of the heads
+        self.generation = 0
+        self.data = {}
+        if os.path.exists(path):
+            try:
+                self.data = json.load(open(path, 'r'))
+            except ValueError:
+                logger.warn('Ignoring corrupt svn cache: %s' % path)
+
+    def get(self, kind, url, head):
+        entry = self.data.get('%s %s' % (kind, normalizeURL(url)))
+        if entry is None:
+            return None
+        if entry['head'] != head or time.time() - entry['time'] > self.ttl:
+            return None
+        logger.debug('Cached svn %s: %s' % (kind, url))
+        return entry['value']
+
+    def set(self, kind, url, head, value):
+        with self.lock:
+            self.data['%s %s' % (kind, normalizeURL(url))] = {
+                'head': head, 'time': time.time(), 'value': value}
+
+    def invalidateHeads(self):
+        # something was committed, HEAD must be probed again. A probe that
+        # is still running is not stored, see SVN.head()
+        with self.headLock:
+            self.generation += 1
+            self.heads.clear()
+
+    def save(self):
+        with self.lock:
+            dirname, filename = os.path.split(self.path)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            # builds sharing the --cache-dir each write their own file
+            fd, tmpPath = tempfile.mkstemp(prefix=filename + '.',
+                                           dir=dirname or os.curdir)
+            try:
+                tmpFile = os.fdopen(fd, 'w')
+                json.dump(self.data, tmpFile)
+                tmpFile.close()
+                if os.path.exists(self.path) and sys.platform == 'win32':
+                    os.remove(self.path)
+                os.rename(tmpPath, self.path)
+            except BaseException:
+                if os.path.exists(tmpPath):
+                    os.remove(tmpPath)
+                raise
+
+class ArtifactCache(object):
+    """Built distribution files by package, tag URL and tag revision, with or
+    without wheels.
+
+    A tag revision never changes, so neither do its distributions. When the
+    cache grows beyond `maxSize` bytes the least recently used entries are
+    removed.
+    """
+
+    def __init__(self, directory, maxSize=None):
+        self.directory = directory
+        self.maxSize = maxSize
+        self.lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _path(self, pkg, tagUrl, revision, wheels=False):
+        key = '%s %s %s' % (pkg, normalizeURL(tagUrl), revision)
+        if wheels:
+            key += ' wheels'
+        return os.path.join(self.directory, hashlib.md5(key).hexdigest())
+
+    def get(self, pkg, tagUrl, revision, wheels=False):
+        """Return the paths of the cached files, None if there are none."""
+        path = self._path(pkg, tagUrl, revision, wheels)
+        try:
+            meta = json.load(open(os.path.join(path, 'meta.json'), 'r'))
+        except (IOError, ValueError):
+            return None
+        filenames = [os.path.join(path, str(name)) for name in meta['files']]
+        if not filenames or [name for name in filenames
+                             if not os.path.exists(name)]:
+            return None
+        # the modification time of the metadata is the last use
+        os.utime(os.path.join(path, 'meta.json'), None)
+        logger.debug('Cached distribution of %s@%s' % (tagUrl, revision))
+        return filenames
+
+    def store(self, pkg, tagUrl, revision, filenames, wheels=False):
+        """Copy the files into the cache and return the paths of the copies."""
+        path = self._path(pkg, tagUrl, revision, wheels)
+        tmpPath = tempfile.mkdtemp(dir=self.directory)
+        for filename in filenames:
+            shutil.copyfile(
+                filename, os.path.join(tmpPath, os.path.split(filename)[-1]))
+        meta = {'pkg': pkg, 'url': tagUrl, 'revision': revision,
+                'wheels': wheels, 'files': [os.path.split(filename)[-1]
+                          for filename in filenames]}
+        json.dump(meta, open(os.path.join(tmpPath, 'meta.json'), 'w'))
+        with self.lock:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.rename(tmpPath, path)
+        self.prune(keep=path)
+        return [os.path.join(path, name) for name in meta['files']]
+
+    def entries(self):
+        """Return (lastUsed, size, path, meta) of all entries, oldest first."""
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            metaPath = os.path.join(path, 'meta.json')
+            try:
+                meta = json.load(open(metaPath, 'r'))
+                lastUsed = os.path.getmtime(metaPath)
+            except (IOError, OSError, ValueError):
+                # being stored or broken
+                continue
+            size = sum([os.path.getsize(os.path.join(path, filename))
+                        for filename in os.listdir(path)])
+            entries.append((lastUsed, size, path, meta))
+        return sorted(entries)
+
+    def prune(self, maxSize=None, keep=None):
+        """Remove the least recently used entries beyond the size limit,
+        except for the one at `keep`.
+
+        Returns the number of removed entries.
+        """
+        if maxSize is None:
+            maxSize = self.maxSize
+        if maxSize is None:
+            return 0
+        removed = 0
+        with self.lock:
+            entries = self.entries()
+            size = sum([entry[1] for entry in entries])
+            for lastUsed, entrySize, path, meta in entries:
+                if size <= maxSize:
+                    break
+                if path == keep:
+                    continue
+                logger.debug('Removing cached distribution of %s@%s' % (
+                    meta['url'], meta['revision']))
+                shutil.rmtree(path)
+                size -= entrySize
+                removed += 1
+        return removed
+
+# set up by configure()
+svnCache = None
+artifactCache = None
+
+def configure(options):
+    """Check the options and set up the caches, command timeout and upload
+    retries given by them."""
+    global svnCache, artifactCache, commandTimeout, uploadRetries
+    if options.plan and options.resume:
+        # a plan is only written, there is no run to resume
+        logger.error('The --plan and --resume options cannot be combined')
+        sys.exit(1)
+    commandTimeout = options.commandTimeout
+    uploadRetries = options.uploadRetries
+    if options.cacheDir:
+        session.cache = PageCache(os.path.join(options.cacheDir, 'http'))
+        svnCache = MetadataCache(
+            os.path.join(options.cacheDir, 'svn.json'), options.svnCacheTTL)
+        artifactCache = ArtifactCache(
+            os.path.join(options.cacheDir, 'artifacts'),
+            options.artifactCacheSize * 1024 * 1024)
 
 class SVN(object):
 
@@ -55,12 +505,54 @@ class SVN(object):
     passwd = None
     forceAuth = False
 
+    # maximum number of targets passed to a single svn call
+    batchSize = 100
+
+    # used to probe the HEAD revision that invalidates cached lookups
+    repositoryUrl = None
+
     #TODO: spaces in urls+folder names???
 
-    def __init__(self, user=None, passwd=None, forceAuth=False):
+    def __init__(self, user=None, passwd=None, forceAuth=False,
+                 repositoryUrl=None, cache=None):
         self.user = user
         self.passwd = passwd
         self.forceAuth = forceAuth
+        self.repositoryUrl = repositoryUrl
+        if cache is None:
+            cache = svnCache
+        self.cache = cache
+
+    def head(self):
+        """Return the HEAD revision of the repository, probed once per run
+        and again after every commit.
+
+        None is returned when the HEAD is unknown, cached lookups are not
+        used then.
+        """
+        if self.cache is None or self.repositoryUrl is None:
+            return None
+        with self.cache.headLock:
+            head = self.cache.heads.get(self.repositoryUrl)
+            if head is not None:
+                return head
+            generation = self.cache.generation
+        command = 'svn info --non-interactive ##__auth__## --xml %s' % (
+            self.repositoryUrl)
+        command = self._addAuth(command)
+        infos = parseInfo(do(command, ignoreErrors=True))
+        if not infos:
+            return None
+        head = infos.values()[0].repoRevision
+        with self.cache.headLock:
+            if self.cache.generation != generation:
+                # a commit invalidated the heads while probing, the probed
+                # HEAD might be older than the commit
+                return None
+            self.cache.heads.setdefault(self.repositoryUrl, head)
+            head = self.cache.heads[self.repositoryUrl]
+        logger.debug('Repository HEAD revision: %i' % head)
+        return head
 
     def _addAuth(self, command):
         auth = ''
@@ -73,32 +565,168 @@ class SVN(object):
         command = command.replace('##__auth__##', auth)
         return command
 
-    def info(self, url):
-        command = 'svn info --non-interactive ##__auth__## --xml %s' % url
-        command = self._addAuth(command)
-        return do(command)
+    def info(self, urls):
+        """Get the revisions of one or many URLs with a single ``svn info``.
+
+        Returns a mapping of normalized URL to `SVNInfo`. URLs that do not
+        exist are not contained in the mapping.
+        """
+        if isinstance(urls, basestring):
+            urls = [urls]
+        head = self.head()
+        result = {}
+        missing = []
+        for url in urls:
+            value = None
+            if head is not None:
+                value = self.cache.get('info', url, head)
+            if value is None:
+                missing.append(url)
+            else:
+                result[normalizeURL(url)] = SVNInfo(*value)
+        for start in range(0, len(missing), self.batchSize):
+            command = 'svn info --non-interactive ##__auth__## --xml %s' % (
+                ' '.join(missing[start:start+self.batchSize]))
+            command = self._addAuth(command)
+            infos = parseInfo(do(command, ignoreErrors=True))
+            result.update(infos)
+            if head is not None:
+                for url, info in infos.items():
+                    self.cache.set('info', url, head, list(info))
+        if head is not None and missing:
+            self.cache.save()
+        return result
 
     def ls(self, url):
+        """Return the names of the entries of the given URL."""
+        head = self.head()
+        if head is not None:
+            names = self.cache.get('ls', url, head)
+            if names is not None:
+                return names
         command = 'svn ls --non-interactive ##__auth__## --xml %s' % url
         command = self._addAuth(command)
-        return do(command)
+        elem = ElementTree.fromstring(do(command))
+        names = [elem.text for elem in elem.findall('./list/entry/name')]
+        if head is not None:
+            self.cache.set('ls', url, head, names)
+            self.cache.save()
+        return names
+
+    def cat(self, url):
+        """Return the contents of the file at the given URL."""
+        head = self.head()
+        if head is not None:
+            content = self.cache.get('cat', url, head)
+            if content is not None:
+                return content.encode('utf-8')
+        command = 'svn cat --non-interactive ##__auth__## %s' % url
+        command = self._addAuth(command)
+        content = do(command)
+        if head is not None:
+            try:
+                self.cache.set('cat', url, head, content.decode('utf-8'))
+            except UnicodeDecodeError:
+                pass
+            else:
+                self.cache.save()
+        return content
+
+    def log(self, url, start, end='HEAD'):
+        """Return the commits from revision start to end below url.
+
+        The result is a list of ``(revision, paths)`` tuples, where paths are
+        the changed paths relative to the repository root. Returns None if the
+        log is not available.
+        """
+        head = self.head()
+        key = '%s@%s:%s' % (url, start, end)
+        if head is not None:
+            entries = self.cache.get('log', key, head)
+            if entries is not None:
+                return entries
+        command = 'svn log --non-interactive ##__auth__## --xml -v -r %s:%s %s' % (
+            start, end, url)
+        command = self._addAuth(command)
+        try:
+            elem = ElementTree.fromstring(do(command, ignoreErrors=True))
+        except SyntaxError:
+            return None
+        entries = []
+        for entry in elem.findall('logentry'):
+            paths = [path.text for path in entry.findall('paths/path')]
+            entries.append((int(entry.get('revision')), paths))
+        if head is not None:
+            self.cache.set('log', key, head, entries)
+            self.cache.save()
+        return entries
+
+    def _committed(self):
+        if self.cache is not None:
+            self.cache.invalidateHeads()
 
     def cp(self, fromurl, tourl, comment):
         command = 'svn cp --non-interactive ##__auth__## -m "%s" %s %s' %(
             comment, fromurl, tourl)
         command = self._addAuth(command)
-        do(command)
+        do(command, keepOutput=False)
+        self._committed()
 
     def co(self, url, folder):
         command = 'svn co --non-interactive ##__auth__## %s %s' % (url, folder)
         command = self._addAuth(command)
-        do(command)
+        do(command, keepOutput=False)
+
+    def export(self, url, folder, revision=None):
+        if revision is not None:
+            url = '%s@%s' % (url, revision)
+        command = 'svn export --non-interactive ##__auth__## %s %s' % (
+            url, folder)
+        command = self._addAuth(command)
+        do(command, keepOutput=False)
 
     def ci(self, folder, comment):
         command = 'svn ci --non-interactive ##__auth__## -m "%s" %s' % (
             comment, folder)
         command = self._addAuth(command)
-        do(command)
+        do(command, keepOutput=False)
+        self._committed()
+
+    def mucc(self, operations, comment, revision=None):
+        """Commit several operations at once with ``svnmucc``, no working copy
+        is needed.
+
+        `operations` are tuples like ``('cp', REV, fromurl, tourl)``,
+        ``('put', content, url)`` or ``('rm', url)``; the content of a ``put``
+        is passed in a temporary file. When `revision` is given, the commit
+        fails if a changed path was modified after it.
+
+        Returns the committed revision.
+        """
+        tempDir = tempfile.mkdtemp()
+        try:
+            args = []
+            for index, operation in enumerate(operations):
+                if operation[0] == 'put':
+                    path = os.path.join(tempDir, 'put-%i' % index)
+                    open(path, 'wb').write(operation[1])
+                    operation = ('put', path) + tuple(operation[2:])
+                args.extend([str(arg) for arg in operation])
+            command = 'svnmucc --non-interactive ##__auth__## -m "%s" ' % comment
+            if revision is not None:
+                command += '-r %s ' % revision
+            command += ' '.join(args)
+            command = self._addAuth(command)
+            output = do(command)
+        finally:
+            shutil.rmtree(tempDir)
+        self._committed()
+        match = re.search(r'r(\d+) committed', output)
+        if match is None:
+            logger.error(u'No committed revision in the output of svnmucc: '
+                         u'\n%s' % output)
+            sys.exit(1)
+        return int(match.group(1))
 
 def getInput(prompt, default, useDefaults):
     if useDefaults:
@@ -111,47 +739,598 @@ def getInput(prompt, default, useDefaults):
         return default
     return value
 
-def uploadContent(content, filename, url, username, password,
-                  offline, method, headers=None):
-    if offline:
-        logger.info('Offline: File `%s` not uploaded.' %filename)
-        return
+class Response(object):
+    """A response of the `HTTPSession`.
 
-    logger.debug('Uploading `%s` to %s' %(filename, url))
-    pieces = urlparse.urlparse(url)
-    Connection = httplib.HTTPConnection
-    if pieces[0] == 'https':
-        Connection = httplib.HTTPSConnection
+    The body must be consumed with `read()` or `iterChunks()`, only then the
+    connection goes back to the pool.
+    """
+
+    def __init__(self, session, key, connection, response, url):
+        self.session = session
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = dict(response.getheaders())
+        self._key = key
+        self._connection = connection
+        self._response = response
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def iterChunks(self, size=16384):
+        while True:
+            chunk = self._response.read(size)
+            if not chunk:
+                break
+            yield chunk
+        self._done()
+
+    def read(self):
+        body = self._response.read()
+        self._done()
+        return body
+
+    def _done(self):
+        if self._connection is None:
+            return
+        if self._response.will_close:
+            self._connection.close()
+        else:
+            self.session._release(self._key, self._connection)
+        self._connection = None
+
+class URLResponse(Response):
+    """A `Response` read with ``urllib2``, for URLs the session does not
+    pool, e.g. ``file:`` URLs."""
+
+    def __init__(self, session, response, url):
+        self.session = session
+        self.url = url
+        self.status = getattr(response, 'code', None) or 200
+        self.reason = getattr(response, 'msg', None) or 'OK'
+        self.headers = dict([(name.lower(), value)
+                             for name, value in response.info().items()])
+        self._key = None
+        self._connection = None
+        self._response = response
+
+    def _done(self):
+        self._response.close()
+
+class LinkExtractor(HTMLParser.HTMLParser):
+    """Incremental parser collecting the anchors of an HTML page.
+
+    Found anchors are appended to `links` as (href, text) pairs. If `parent`
+    is given, only anchors directly inside such an element are collected.
+    """
+
+    # elements without end tag, they never become a parent
+    empty = ('br', 'hr', 'img', 'input', 'link', 'meta')
+
+    def __init__(self, parent=None):
+        HTMLParser.HTMLParser.__init__(self)
+        self.parent = parent
+        self.links = []
+        self._open = []
+        self._href = None
+        self._text = None
+        self._collect = False
 
-    base64string = base64.encodestring('%s:%s' % (username, password))[:-1]
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            self._closeAnchor()
+            self._collect = (self.parent is None or
+                             (self._open and self._open[-1] == self.parent))
+            self._href = dict(attrs).get('href')
+            self._text = []
+        elif tag not in self.empty:
+            self._open.append(tag)
 
-    if headers is None:
-        headers = {}
+    def handle_endtag(self, tag):
+        if tag == 'a':
+            self._closeAnchor()
+        elif tag in self._open:
+            while self._open.pop() != tag:
+                pass
 
-    headers["Authorization"] = "Basic %s" % base64string
+    def handle_data(self, data):
+        if self._text is not None:
+            self._text.append(data)
 
-    conn = Connection(pieces[1])
-    conn.request(
-        method,
-        pieces[2],
-        content,
-        headers)
+    def handle_entityref(self, name):
+        if self._text is not None:
+            codepoint = htmlentitydefs.name2codepoint.get(name)
+            if codepoint is None:
+                self._text.append('&%s;' % name)
+            else:
+                self._text.append(unichr(codepoint))
 
-    response = conn.getresponse()
-    if ((response.status != 201 and method == 'PUT')
-        or response.status != 200 and method == 'POST'):
+    def handle_charref(self, name):
+        if self._text is not None:
+            if name.lower().startswith('x'):
+                self._text.append(unichr(int(name[1:], 16)))
+            else:
+                self._text.append(unichr(int(name)))
+
+    def _closeAnchor(self):
+        if self._text is None:
+            return
+        if self._collect:
+            self.links.append((self._href, ''.join(self._text)))
+        self._text = None
+
+    def close(self):
+        HTMLParser.HTMLParser.close(self)
+        self._closeAnchor()
+
+def iterLinks(chunks, parent=None):
+    """Yield (href, text) of the anchors of an HTML page.
+
+    `chunks` is the page or an iterable of pieces of it, e.g. of a response
+    that is still being received. Links are yielded as soon as they are
+    parsed.
+    """
+    if isinstance(chunks, basestring):
+        chunks = [chunks]
+    parser = LinkExtractor(parent)
+    try:
+        for chunk in chunks:
+            parser.feed(chunk)
+            for link in parser.links:
+                yield link
+            del parser.links[:]
+        parser.close()
+    except HTMLParser.HTMLParseError, err:
+        logger.warn('Could not parse all links: %s' % err)
+    for link in parser.links:
+        yield link
+
+def teeChunks(chunks, into):
+    # yield the chunks, keeping them in the list `into`
+    for chunk in chunks:
+        into.append(chunk)
+        yield chunk
+
+# PEP 691: prefer the JSON simple repository API, fall back to HTML
+SIMPLE_JSON = 'application/vnd.pypi.simple.v1+json'
+SIMPLE_ACCEPT = '%s, text/html;q=0.01' % SIMPLE_JSON
+
+def isSimpleJSON(page):
+    return (page.contentType or '').split(';')[0].strip() == SIMPLE_JSON
+
+def normalizeProjectName(name):
+    # PEP 503
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+class Page(object):
+    """A page fetched by `HTTPSession.fetch()`.
+
+    `extracted` holds data callers derived from the body, so that it can be
+    reused as long as the page did not change.
+    """
+
+    notModified = False
+    # the (href, text) of the anchors, when they were parsed while the page
+    # was received, see `HTTPSession.fetch()`
+    links = None
+
+    def __init__(self, url, body, headers=None, extracted=None):
+        headers = headers or {}
+        self.url = url
+        self.body = body
+        self.etag = headers.get('etag')
+        self.lastModified = headers.get('last-modified')
+        self.contentType = headers.get('content-type')
+        self.cacheControl = headers.get('cache-control')
+        self.fetched = time.time()
+        self.extracted = extracted or {}
+
+    def iterLinks(self, parent=None):
+        """Return an iterator of the (href, text) of the anchors of the page,
+        see `iterLinks`."""
+        if self.links is not None and parent is None:
+            return iter(self.links)
+        return iterLinks(self.body, parent)
+
+    def isFresh(self):
+        """Whether the page can be used without asking the server.
+
+        That is only the case for ``immutable`` pages, e.g. hashed
+        configuration files, within their ``max-age``. Other pages, like
+        package index pages, change with every upload and are revalidated.
+        """
+        directives = {}
+        for directive in (self.cacheControl or '').lower().split(','):
+            name, sep, value = directive.strip().partition('=')
+            directives[name] = value.strip('"')
+        if 'no-cache' in directives or 'no-store' in directives:
+            return False
+        if 'immutable' not in directives:
+            return False
+        try:
+            maxAge = int(directives.get('max-age'))
+        except (TypeError, ValueError):
+            return True
+        return time.time() - self.fetched < maxAge
+
+class PageCache(object):
+    """On-disk store of pages with their ``ETag``/``Last-Modified``."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _path(self, url):
+        return os.path.join(self.directory, hashlib.md5(url).hexdigest())
+
+    def get(self, url):
+        path = self._path(url)
+        try:
+            meta = json.load(open(path + '.json', 'r'))
+            body = open(path + '.body', 'rb').read()
+        except (IOError, ValueError):
+            return None
+        page = Page(url, body, extracted=meta['extracted'])
+        page.etag = meta['etag']
+        page.lastModified = meta['lastModified']
+        page.contentType = meta['contentType']
+        page.cacheControl = meta.get('cacheControl')
+        page.fetched = meta.get('fetched', 0)
+        return page
+
+    def store(self, page, body=True, extracted=None):
+        path = self._path(page.url)
+        if extracted is None:
+            extracted = page.extracted
+        meta = {'url': page.url, 'etag': page.etag,
+                'lastModified': page.lastModified,
+                'contentType': page.contentType,
+                'cacheControl': page.cacheControl,
+                'fetched': page.fetched,
+                'extracted': extracted}
+        with self.lock:
+            if body:
+                open(path + '.body', 'wb').write(page.body)
+            json.dump(meta, open(path + '.json', 'w'))
+
+class HTTPSession(object):
+    """Keep-alive HTTP client shared by all modules.
+
+    Connections are pooled per host and reused, authorization headers are
+    computed once per credential.
+    """
+
+    maxRedirects = 5
+    timeout = None
+    # a `PageCache`, see configure()
+    cache = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.extractedLock = threading.Lock()
+        # pages fetched or validated during this run
+        self.pages = {}
+        self.idle = {}
+        self.authHeaders = {}
+        self.requests = 0
+        self.connections = 0
+        self.reused = 0
+        # proxies by scheme, from the environment
+        self.proxies = urllib.getproxies()
+
+    def authHeader(self, username, password):
+        key = (username, password)
+        header = self.authHeaders.get(key)
+        if header is None:
+            header = 'Basic %s' % base64.b64encode('%s:%s' % key)
+            self.authHeaders[key] = header
+        return header
+
+    def getProxy(self, scheme, netloc):
+        """Return the proxy URL for the host from the environment
+        (``http_proxy``, ``https_proxy``, ``no_proxy``), or None."""
+        proxy = self.proxies.get(scheme)
+        if not proxy or urllib.proxy_bypass(netloc.split(':')[0]):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        return proxy
+
+    def _proxyHeaders(self, proxy):
+        userinfo, sep, host = urlparse.urlsplit(proxy)[1].rpartition('@')
+        if not userinfo:
+            return {}
+        username, sep, password = userinfo.partition(':')
+        return {'Proxy-Authorization': self.authHeader(
+            urllib.unquote(username), urllib.unquote(password))}
+
+    def _acquire(self, key):
+        with self.lock:
+            self.requests += 1
+            idle = self.idle.get(key)
+            if idle:
+                self.reused += 1
+                return idle.pop(), True
+            self.connections += 1
+        scheme, netloc, proxy = key
+        Connection = httplib.HTTPConnection
+        if scheme == 'https':
+            Connection = httplib.HTTPSConnection
+        if proxy is None:
+            return Connection(netloc, timeout=self.timeout), False
+        proxyHost = urlparse.urlsplit(proxy)[1].rpartition('@')[2]
+        connection = Connection(proxyHost, timeout=self.timeout)
+        if scheme == 'https':
+            # tunnel through the proxy with CONNECT
+            connection.set_tunnel(netloc, headers=self._proxyHeaders(proxy))
+        return connection, False
+
+    def _release(self, key, connection):
+        with self.lock:
+            self.idle.setdefault(key, []).append(connection)
+
+    def request(self, method, url, body=None, headers=None,
+                username=None, password=None):
+        """Send a request and return the `Response`, whatever its status.
+
+        URLs other than ``http:`` and ``https:`` ones are opened with
+        ``urllib2``.
+        """
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        headers = dict(headers or {})
+        if username:
+            headers['Authorization'] = self.authHeader(username, password)
+        if scheme not in ('http', 'https'):
+            return self._urlopen(method, url, body, headers)
+        path = path or '/'
+        if query:
+            path += '?' + query
+        proxy = self.getProxy(scheme, netloc)
+        if proxy is not None and scheme == 'http':
+            # plain HTTP proxies get the whole URL
+            path = urlparse.urlunsplit((scheme, netloc, path, '', ''))
+            headers.update(self._proxyHeaders(proxy))
+        key = (scheme, netloc, proxy)
+        while True:
+            connection, reused = self._acquire(key)
+            if isinstance(body, StreamBody):
+                body.rewind()
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if reused:
+                    # the server closed the idle connection, try a new one
+                    continue
+                raise
+            return Response(self, key, connection, response, url)
+
+    def _urlopen(self, method, url, body, headers):
+        with self.lock:
+            self.requests += 1
+        if isinstance(body, StreamBody):
+            body.rewind()
+            body = body.read()
+        request = urllib2.Request(url, body, headers)
+        request.get_method = lambda: method
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+        except urllib2.HTTPError, err:
+            # a response like any other
+            response = err
+        return URLResponse(self, response, url)
+
+    def open(self, url, username=None, password=None, headers=None):
+        """GET the URL following redirects, like ``urllib2.urlopen()``.
+
+        Raises ``urllib2.HTTPError`` for error responses.
+        """
+        for i in range(self.maxRedirects + 1):
+            response = self.request('GET', url, headers=headers,
+                                    username=username, password=password)
+            if response.status in (301, 302, 303, 307, 308):
+                response.read()
+                url = urlparse.urljoin(url, response.getheader('location'))
+                continue
+            if response.status >= 400:
+                response.read()
+                raise urllib2.HTTPError(url, response.status, response.reason,
+                                        response.headers, None)
+            return response
+        raise urllib2.HTTPError(url, response.status, 'Too many redirects',
+                                response.headers, None)
+
+    def fetch(self, url, username=None, password=None, offline=False,
+              headers=None, parseLinks=False):
+        """Return the `Page` at the URL, revalidating a cached copy.
+
+        With `parseLinks` the anchors of a received HTML page are parsed
+        while it arrives and set as its `links`.
+
+        A cached copy of an immutable page, see `Page.isFresh()`, is used
+        without asking the server. In offline mode only the cache is
+        used and None is returned for pages that were never fetched.
+        """
+        page = self.pages.get(url)
+        if page is not None:
+            return page
+        cached = None
+        if self.cache is not None:
+            cached = self.cache.get(url)
+        if offline:
+            return cached
+        if cached is not None and cached.isFresh():
+            logger.debug('Fresh: ' + url)
+            cached.notModified = True
+            self.pages[url] = cached
+            return cached
+        headers = dict(headers or {})
+        if cached is not None:
+            if cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached.lastModified:
+                headers['If-Modified-Since'] = cached.lastModified
+        response = self.open(url, username, password, headers)
+        if response.status == 304 and cached is not None:
+            response.read()
+            logger.debug('Not modified: ' + url)
+            cached.notModified = True
+            cached.fetched = time.time()
+            if response.getheader('cache-control'):
+                cached.cacheControl = response.getheader('cache-control')
+            if self.cache is not None:
+                self.cache.store(cached, body=False)
+            page = cached
+        else:
+            links = None
+            if parseLinks and not response.getheader(
+                'content-type', '').startswith(SIMPLE_JSON):
+                chunks = []
+                links = list(iterLinks(teeChunks(response.iterChunks(),
+                                                 chunks)))
+                body = ''.join(chunks)
+            else:
+                body = response.read()
+            page = Page(url, body, response.headers)
+            page.links = links
+            if self.cache is not None:
+                self.cache.store(page)
+        self.pages[url] = page
+        return page
+
+    def remember(self, page, key, value):
+        """Set what was extracted from the page and store it in the cache.
+
+        Pages are shared between threads, the cache gets a copy made under
+        the same lock as the change.
+        """
+        with self.extractedLock:
+            page.extracted[key] = value
+            extracted = dict(page.extracted)
+        if self.cache is not None:
+            self.cache.store(page, body=False, extracted=extracted)
+        return value
+
+    def stats(self):
+        return '%i HTTP requests, %i connections opened, %i reused' % (
+            self.requests, self.connections, self.reused)
+
+session = HTTPSession()
+
+class StreamBody(object):
+    """A request body read in chunks from strings and open files.
+
+    Its length is known upfront, so ``httplib`` sends it with a
+    ``Content-Length`` header and a chunk at a time, without the whole body
+    ever being in memory.
+    """
+
+    def __init__(self, *parts):
+        self.parts = parts
+        self.length = 0
+        for part in parts:
+            if isinstance(part, str):
+                self.length += len(part)
+            else:
+                self.length += os.fstat(part.fileno()).st_size
+        self.rewind()
+
+    def __len__(self):
+        return self.length
+
+    def rewind(self):
+        # start over, for sending the body again
+        self.index = 0
+        self.offset = 0
+        for part in self.parts:
+            if not isinstance(part, str):
+                part.seek(0)
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.length
+        chunks = []
+        while size > 0 and self.index < len(self.parts):
+            part = self.parts[self.index]
+            if isinstance(part, str):
+                chunk = part[self.offset:self.offset + size]
+                self.offset += len(chunk)
+            else:
+                chunk = part.read(size)
+            if not chunk:
+                self.index += 1
+                self.offset = 0
+                continue
+            chunks.append(chunk)
+            size -= len(chunk)
+        return ''.join(chunks)
+
+    def close(self):
+        for part in self.parts:
+            if not isinstance(part, str):
+                part.close()
+
+def multipartBody(boundary, name, path):
+    """Return the `StreamBody` of a form with the file in the field name."""
+    return StreamBody(
+        '--%s\nContent-Disposition: form-data; name="%s";filename="%s"\n\n'
+        % (boundary, name, os.path.split(path)[-1]),
+        open(path, 'rb'),
+        '\n--%s--\n' % boundary)
+
+def uploadContent(content, filename, url, username, password,
+                  offline, method, headers=None):
+    # content is a string or a `StreamBody`
+    if offline:
+        logger.info('Offline: File `%s` not uploaded.' %filename)
+        return False
+
+    logger.debug('Uploading `%s` to %s' %(filename, url))
+    # index pages fetched so far might list the uploaded file now
+    session.pages.clear()
+    # a PUT is idempotent, it can be repeated when the connection broke or
+    # the server failed
+    attempts = 1
+    if method == 'PUT':
+        attempts += uploadRetries
+    for attempt in range(attempts):
+        try:
+            response = session.request(method, url, content, headers,
+                                       username=username, password=password)
+            response.read()
+        except (httplib.HTTPException, socket.error), err:
+            status, reason = 0, str(err)
+        else:
+            status, reason = response.status, response.reason
+            if status < 500:
+                break
+        if attempt + 1 < attempts:
+            logger.warn('Uploading `%s` failed (%s), retrying' % (
+                filename, reason))
+            time.sleep(0.5 * 2 ** attempt)
+    if ((status != 201 and method == 'PUT')
+        or status != 200 and method == 'POST'):
         logger.error('Error uploading file. Code: %i (%s)' %(
-            response.status, response.reason))
-    else:
-        logger.info('File uploaded: %s' %filename)
+            status, reason))
+        return False
+    logger.info('File uploaded: %s' %filename)
+    return True
 
 def uploadFile(path, url, username, password, offline, method='PUT',
                headers=None):
     filename = os.path.split(path)[-1]
 
-    uploadContent(open(path, 'r').read(),
-                  filename, url+'/'+filename,
-                  username, password, offline, method, headers=headers)
+    body = StreamBody(open(path, 'rb'))
+    try:
+        return uploadContent(body, filename, url+'/'+filename, username,
+                             password, offline, method, headers=headers)
+    finally:
+        body.close()
 
 
 def guessNextVersion(version):
@@ -376,3 +1555,78 @@ parser.add_option(
     dest="noBranchUpdate", default=False,
     help=("When set, the branch is not updated with a new version after a "
          "release is created."))
+
+parser.add_option(
+    "--plan", action="store",
+    dest="plan", metavar="FILE", default=None,
+    help=("When specified, the versions and releases are decided and written "
+          "to this file, but nothing is released or uploaded."))
+
+parser.add_option(
+    "--apply", action="store",
+    dest="apply", metavar="FILE", default=None,
+    help="When specified, the plan in this file is executed without questions.")
+
+parser.add_option(
+    "--state-file", action="store",
+    dest="stateFile", metavar="FILE", default=None,
+    help=("The file keeping the state of the last build, so that unchanged "
+          "packages and files are skipped. Defaults to a file in the "
+          "--cache-dir, if given."))
+
+parser.add_option(
+    "--resume", action="store_true",
+    dest="resume", default=False,
+    help=("When specified, a failed run is continued from the last completed "
+          "step recorded in its journal."))
+
+parser.add_option(
+    "--journal", action="store",
+    dest="journal", metavar="FILE", default=None,
+    help=("The file recording the steps of a run for --resume. Defaults to "
+          "a file in the --cache-dir, if given, otherwise runs are not "
+          "recorded."))
+
+parser.add_option(
+    "--batch-release", action="store_true",
+    dest="batchRelease", default=False,
+    help=("When specified, all release tags are created in one commit and "
+          "all branch versions are updated in another one."))
+
+parser.add_option(
+    "-j", "--jobs", action="store", type="int",
+    dest="jobs", metavar="NUMBER", default=4,
+    help="The number of packages processed or files uploaded concurrently.")
+
+parser.add_option(
+    "--upload-retries", action="store", type="int",
+    dest="uploadRetries", metavar="NUMBER", default=2,
+    help="How often a failed upload of a file is repeated.")
+
+parser.add_option(
+    "--sdist-workers", action="store", type="int",
+    dest="sdistWorkers", metavar="NUMBER", default=0,
+    help=("When specified, distributions are built by this many Python "
+          "worker processes that import setuptools only once, instead of a "
+          "new `python setup.py sdist` process per package."))
+
+parser.add_option(
+    "--cache-dir", action="store",
+    dest="cacheDir", metavar="DIR", default=None,
+    help="When specified, repository lookups are cached in this directory.")
+
+parser.add_option(
+    "--svn-cache-ttl", action="store", type="int",
+    dest="svnCacheTTL", metavar="SECONDS", default=3600,
+    help="Maximum age of cached svn lookups.")
+
+parser.add_option(
+    "--artifact-cache-size", action="store", type="int",
+    dest="artifactCacheSize", metavar="MB", default=1024,
+    help=("Maximum size of the built distributions kept in the --cache-dir "
+          "for rebuilds of the same tag."))
+
+parser.add_option(
+    "--command-timeout", action="store", type="int",
+    dest="commandTimeout", metavar="SECONDS", default=None,
+    help="When specified, commands running longer than this are aborted.")
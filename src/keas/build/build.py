@@ -17,10 +17,9 @@ $Id$
 """
 __docformat__ = 'ReStructuredText'
 import datetime
-import BeautifulSoup
 import ConfigParser
 import StringIO
-import base64
+import hashlib
 import logging
 import md5
 import pkg_resources
@@ -28,15 +27,19 @@ import re
 import sys
 import shutil
 import os
+import time
+import traceback
+import urllib
 import urllib2
-from keas.build import base, package
+from keas.build import base, package, sdist, state
 
 logger = base.logger
 
 is_win32 = sys.platform == 'win32'
 
 def findProjectVersions(project, config, options, uploadType):
-    if options.offline:
+    if options.offline and (uploadType == 'local'
+                            or base.session.cache is None):
         logger.info('Offline: Skip looking for project versions.')
         return []
 
@@ -55,30 +58,149 @@ def findProjectVersions(project, config, options, uploadType):
     else:
         url = config.get(base.BUILD_SECTION, 'buildout-server') + project + '/'
         logger.debug('Package Index: ' + url)
-        req = urllib2.Request(url)
-
         username = config.get(base.BUILD_SECTION, 'buildout-server-username')
         password = config.get(base.BUILD_SECTION, 'buildout-server-password')
-        base64string = base64.encodestring('%s:%s' % (username, password))[:-1]
-        req.add_header("Authorization", "Basic %s" % base64string)
 
         try:
-            soup = BeautifulSoup.BeautifulSoup(urllib2.urlopen(req).read())
+            page = base.session.fetch(url, username, password,
+                                      offline=options.offline,
+                                      parseLinks=True)
         except urllib2.HTTPError, err:
             logger.error("There was an error accessing %s: %s" % (url, err))
             return []
+        if page is None:
+            logger.info('Offline: No cached versions of %s.' % project)
+            return []
 
-        versions = []
-        for tag in soup('a'):
-            cntnt = str(tag.contents[0]) # str: re does not like non-strings
-            m = VERSION.search(cntnt)
-            if m:
-                versions.append(m.group(1))
+        versions = page.extracted.get(project)
+        if versions is None:
+            versions = []
+            for href, cntnt in page.iterLinks():
+                m = VERSION.search(cntnt)
+                if m:
+                    versions.append(m.group(1))
+            base.session.remember(page, project, versions)
 
     return sorted(versions, key=lambda x: pkg_resources.parse_version(x))
 
+def findServerFiles(project, config, options, uploadType):
+    """Return the names of the files of the project on the buildout server.
+
+    The listing is read once, an unknown listing is empty.
+    """
+    if uploadType == 'local':
+        dest = os.path.join(config.get(base.BUILD_SECTION, 'buildout-server'),
+                            project)
+        if not os.path.isdir(dest):
+            return set()
+        return set(os.listdir(dest))
+
+    if options.offline or options.noUpload:
+        return set()
+    url = config.get(base.BUILD_SECTION, 'buildout-server') + project + '/'
+    try:
+        page = base.session.fetch(
+            url,
+            config.get(base.BUILD_SECTION, 'buildout-server-username'),
+            config.get(base.BUILD_SECTION, 'buildout-server-password'))
+    except urllib2.HTTPError, err:
+        logger.warn("Could not list the files at %s: %s" % (url, err))
+        return set()
+    files = set()
+    for href, text in page.iterLinks():
+        if href:
+            files.add(urllib.unquote(href.rstrip('/').split('/')[-1]))
+        if text:
+            files.add(text.strip())
+    return files
+
+class ExtendsGraph(object):
+    """The buildout configuration files and the files they extend.
+
+    Every file is read, hashed and parsed only once, however many files
+    extend it.
+    """
+
+    def __init__(self):
+        # path -> parsed configuration
+        self.configs = {}
+        # path -> md5 of the file contents
+        self.hashes = {}
+        # path -> paths of the directly extended files
+        self.extends = {}
+
+    def getConfig(self, path):
+        if path not in self.configs:
+            content = open(path, 'rb').read()
+            self.hashes[path] = md5.new(content).hexdigest()
+            config = base.NonDestructiveRawConfigParser()
+            config.readfp(StringIO.StringIO(content), path)
+            self.configs[path] = config
+        return self.configs[path]
+
+    def getExtendsParts(self, path):
+        try:
+            return self.getConfig(path).get('buildout', 'extends').split()
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            return []
+
+    def getExtends(self, path, baseFolder=None):
+        # extends filenames are relative to the file, unless baseFolder
+        # says otherwise
+        if path not in self.extends:
+            if baseFolder is None:
+                baseFolder = os.path.dirname(path)
+            extends = []
+            for part in self.getExtendsParts(path):
+                fullname = os.path.normpath(os.path.join(baseFolder, part))
+                if is_win32:
+                    #most buildouts use / but win32 uses \
+                    fullname = fullname.replace('/', '\\')
+                if not os.path.exists(fullname):
+                    logger.error("FATAL: %s not found, but is referenced by %s"
+                                 % (fullname, path))
+                    sys.exit(0)
+                extends.append(fullname)
+            self.extends[path] = extends
+        return self.extends[path]
+
+    def resolve(self, path, baseFolder=None):
+        """Return path and all files it extends in topological order.
+
+        Every file comes before the files it extends, so the reversed order
+        can be read into a single parser. An extends cycle is fatal.
+        """
+        order = []
+        done = set()
+        # depth first without recursion, extends chains can be long; the
+        # stack holds the files being visited and their remaining extends
+        stack = [(path, iter(self.getExtends(path, baseFolder)))]
+        visiting = [path]
+        visitingSet = set(visiting)
+        while stack:
+            path, extends = stack[-1]
+            for fullname in extends:
+                if fullname in done:
+                    continue
+                if fullname in visitingSet:
+                    cycle = visiting[visiting.index(fullname):] + [fullname]
+                    logger.error("FATAL: extends cycle: %s"
+                                 % ' -> '.join(cycle))
+                    sys.exit(1)
+                stack.append((fullname, iter(self.getExtends(fullname))))
+                visiting.append(fullname)
+                visitingSet.add(fullname)
+                break
+            else:
+                stack.pop()
+                visitingSet.remove(visiting.pop())
+                done.add(path)
+                order.append(path)
+        order.reverse()
+        return order
+
 def getDependentConfigFiles(baseFolder, infile, addSelf=True, outfile=None,
-                            hashes=None):
+                            hashes=None, graph=None):
     # go and read all cfg files that are required by the master
     # to collect them all
     # if they have a path, modify according to that the the files are flat
@@ -89,121 +211,211 @@ def getDependentConfigFiles(baseFolder, infile, addSelf=True, outfile=None,
     # in that case we want to read/write the modified file, but look for
     # the others in the template_path
 
-    if hashes is not None:
-        justname = os.path.split(infile)[-1]
-        if justname not in hashes:
-            hash = md5.new(open(infile, 'rb').read()).hexdigest()
-            hashes[justname] = hash
-
-    config = base.NonDestructiveRawConfigParser()
-    config.read(infile)
-
-    dependents = set()
-    if addSelf:
-        dependents.add(infile)
-
-    try:
-        extends = config.get('buildout', 'extends')
-    except ConfigParser.NoSectionError:
-        return dependents
-    except ConfigParser.NoOptionError:
-        return dependents
-
-    extendParts = extends.split()
-    hasPath = False
-    for part in extendParts:
-        if '/' in part or '\\' in part:
-            hasPath = True
-
-        # extends filenames are always relative to the actual file
-        fullname = os.path.join(baseFolder, part)
-
-        if is_win32:
-            #most buildouts use / but win32 uses \
-            fullname = fullname.replace('/', '\\')
-
-        if not os.path.exists(fullname):
-            logger.error("FATAL: %s not found, but is referenced by %s" % (
-                fullname, infile))
-            sys.exit(0)
-
-        dependents.update(getDependentConfigFiles(os.path.dirname(fullname),
-                                                  fullname, hashes=hashes))
-
-    if hasPath:
-        #we need to clean relative path from extends as on the server
-        #everything is flat
-        extendParts = [os.path.split(part)[-1] for part in extendParts]
-        extends = '\n  '.join(extendParts)
-
-        config.set('buildout', 'extends', extends)
-
-        if outfile:
-            #if the config is created by ourselves
-            config.write(open(outfile, 'w'))
+    # the files are returned in the order of ExtendsGraph.resolve
+    if graph is None:
+        graph = ExtendsGraph()
+
+    dependents = []
+    for path in graph.resolve(infile, baseFolder):
+        config = graph.getConfig(path)
+        if hashes is not None:
+            justname = os.path.split(path)[-1]
+            if justname not in hashes:
+                hashes[justname] = graph.hashes[path]
+
+        extendParts = graph.getExtendsParts(path)
+        hasPath = False
+        for part in extendParts:
+            if '/' in part or '\\' in part:
+                hasPath = True
+
+        if path == infile and not addSelf:
+            newname = None
         else:
-            #this is a referenced config, don't modify the original
-            newname = os.path.split(infile)[-1]
-            config.write(open(newname, 'w'))
-
-            if addSelf:
-                #adjust dependents
-                dependents.remove(infile)
-                dependents.add(newname)
+            newname = path
+
+        if hasPath:
+            #we need to clean relative path from extends as on the server
+            #everything is flat
+            extendParts = [os.path.split(part)[-1] for part in extendParts]
+            extends = '\n  '.join(extendParts)
+
+            config.set('buildout', 'extends', extends)
+
+            if path == infile and outfile:
+                #if the config is created by ourselves
+                config.write(open(outfile, 'w'))
+            else:
+                #this is a referenced config, don't modify the original
+                flatname = os.path.split(path)[-1]
+                config.write(open(flatname, 'w'))
+                graph.configs[flatname] = config
+                if newname is not None:
+                    newname = flatname
+
+        if newname is not None:
+            dependents.append(newname)
 
     return dependents
 
-def addHashes(dependencies, hashes, rename=True):
+# hashed configuration files never change, see addHashes
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+def hashedName(filename, hash):
+    parts = os.path.splitext(filename)
+    return "%s-%s%s" % (parts[0], hash, parts[1])
+
+def addHashes(dependencies, hashes, rename=True, graph=None):
     # add hashes to files
 
+    # the extends of every file are split into filenames once and mapped
+    # through the new names, a filename never matches part of another one
+    newnames = dict([(oldname, hashedName(oldname, hash))
+                     for oldname, hash in hashes.items()])
+
+    # dependencies are in the order of getDependentConfigFiles, every file
+    # before the files it extends. Going bottom up, the extended files are
+    # renamed first and the hash of a file is taken from its rewritten
+    # content, so it covers the hashes of everything it extends and a hashed
+    # file never changes.
     rdep = []
-    for fname in dependencies:
+    for fname in reversed(dependencies):
         modified = False
         justname = os.path.split(fname)[-1]
 
-        config = base.NonDestructiveRawConfigParser()
-        config.read(fname)
+        config = None
+        if graph is not None:
+            config = graph.configs.get(fname)
+        if config is None:
+            config = base.NonDestructiveRawConfigParser()
+            config.read(fname)
 
+        # 1. modify file contents
         try:
-            # 1. modify file contents
-            extends = config.get('buildout', 'extends')
-            for oldname, hash in hashes.items():
-                parts = os.path.splitext(oldname)
-                newname = "%s-%s%s" % (parts[0], hash, parts[1])
-
-                if oldname in extends:
-                    extends = extends.replace(oldname, newname)
-                    modified = True
-
-            if modified:
-                config.set('buildout', 'extends', extends)
-        except ConfigParser.NoSectionError:
-            pass
-        except ConfigParser.NoOptionError:
-            pass
+            extendParts = config.get('buildout', 'extends').split()
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            extendParts = []
+        newParts = []
+        for part in extendParts:
+            head, tail = os.path.split(part)
+            if tail in newnames:
+                part = head and head + '/' + newnames[tail] or newnames[tail]
+            newParts.append(part)
+        if newParts != extendParts:
+            config.set('buildout', 'extends', '\n  '.join(newParts))
+            modified = True
 
         # 2. rename/copy files
         newname = justname
-        if rename:
-            try:
-                hash = hashes[justname]
-                parts = os.path.splitext(justname)
-                newname = "%s-%s%s" % (parts[0], hash, parts[1])
-                modified = True
-            except KeyError:
-                pass
-
-        if modified:
-            #RawConfigParser fools us... next time it does I'll do
-            #plain replace on the file contents
+        if rename and justname in hashes:
+            content = StringIO.StringIO()
+            config.write(content)
+            content = content.getvalue()
+            hashes[justname] = md5.new(content).hexdigest()
+            newname = newnames[justname] = hashedName(
+                justname, hashes[justname])
+            open(newname, 'w').write(content)
+        elif modified:
             config.write(open(newname, 'w'))
-            rdep.append(newname)
         else:
             rdep.append(fname)
+            continue
 
+        if graph is not None:
+            graph.configs[newname] = config
+        rdep.append(newname)
+
+    rdep.reverse()
     return rdep
 
-def build(configFile, options):
+def uploadFiles(upload, filenames, jobs):
+    """Upload the files concurrently, `upload(filename)` returns whether it
+    succeeded.
+
+    Returns the uploaded files, after reporting the time each took.
+    """
+    def timedUpload(filename):
+        start = time.time()
+        uploaded = upload(filename)
+        return uploaded, time.time() - start
+
+    if not filenames:
+        return []
+    logger.info('Uploading %i files, %i at a time' % (len(filenames), jobs))
+    start = time.time()
+    results = base.runParallel(timedUpload, filenames, jobs)
+    duration = time.time() - start
+
+    uploaded = []
+    size = 0
+    for filename, (result, excInfo) in zip(filenames, results):
+        if excInfo is not None:
+            error = traceback.format_exception_only(
+                excInfo[0], excInfo[1])[-1].strip()
+            logger.error('Upload of %s failed: %s' % (filename, error))
+            continue
+        success, seconds = result
+        fileSize = os.path.getsize(filename)
+        logger.info('%s %s: %i bytes in %.3f seconds' % (
+            success and 'Uploaded' or 'Failed', filename, fileSize, seconds))
+        if success:
+            uploaded.append(filename)
+            size += fileSize
+    logger.info('%i files uploaded, %i failed, %.1f kB in %.2f seconds '
+                '(%.1f kB/s)' % (
+        len(uploaded), len(filenames) - len(uploaded), size / 1024.0,
+        duration, size / 1024.0 / max(duration, 0.001)))
+    return uploaded
+
+def getStatePath(config, options):
+    if options.stateFile:
+        return options.stateFile
+    if options.cacheDir:
+        return os.path.join(options.cacheDir, 'state-%s.json' % (
+            config.get(base.BUILD_SECTION, 'name')))
+    return None
+
+def finishBuild(buildState, journal, builders, complete, inputs=None,
+                projectVersion=None, uploaded=True):
+    """Remember a complete build for the next run and remove its journal.
+
+    An incomplete build is not the last build, only its uploaded files are
+    remembered and the journal is kept for ``--resume``. Neither is a build
+    whose files were not `uploaded` at all (``--no-upload``, ``--offline``),
+    the next run has to build and upload them.
+    """
+    if buildState is not None:
+        if complete and uploaded:
+            buildState.setBuild(
+                [(builder.pkg, builder.chosenVersion, builder.chosenBranch,
+                  builder.branchRevision) for builder in builders],
+                inputs, projectVersion)
+        buildState.save()
+    if complete:
+        journal.finish()
+    else:
+        logger.error('Not all files could be uploaded, continue with '
+                     '--resume')
+
+def chooseProjectVersion(projectName, config, options, uploadType):
+    defaultVersion = configVersion = config.get(base.BUILD_SECTION, 'version')
+    projectVersions = findProjectVersions(projectName, config,
+                                          options, uploadType)
+
+    # Determine new project version
+    if projectVersions:
+        defaultVersion = projectVersions[-1]
+    if options.nextVersion or configVersion == '+':
+        defaultVersion = base.guessNextVersion(defaultVersion)
+    if options.forceVersion:
+        if options.forceVersion in projectVersions:
+            logger.error('Forced version %s already exists' % options.forceVersion)
+        else:
+            defaultVersion = options.forceVersion
+    return base.getInput(
+        'Project Version', defaultVersion, options.useDefaults)
+
+def build(configFile, options, sdistPool=None):
     # save the time we started
     now = datetime.datetime.now()
 
@@ -225,21 +437,85 @@ def build(configFile, options):
     if not projectParser.has_section('versions'):
         projectParser.add_section('versions')
 
+    # Load the state of the last build
+    buildState = None
+    statePath = getStatePath(config, options)
+    if statePath:
+        buildState = state.BuildState(statePath)
+
+    # The journal of this run, or of the failed run to resume
+    journal = None
+    if not options.plan:
+        journal = state.Journal(state.getJournalPath(configFile, options))
+
     # Determine all versions of the important packages
+    plan = {}
+    if options.resume:
+        if journal.plan is None:
+            logger.error('Nothing to resume, no journal at %s' % journal.path)
+            sys.exit(1)
+        logger.info('Resuming from journal: ' + journal.path)
+        builders, plan = package.planBuilders(journal.plan, configFile,
+                                              options)
+    elif options.apply:
+        builders, plan = package.loadPlan(options.apply, configFile, options)
+    else:
+        builders = []
+        for pkg in config.get(base.BUILD_SECTION, 'packages').split():
+            customPath = None
+            if ':' in pkg:
+                pkg, customPath = pkg.split(':')
+            builders.append(package.PackageBuilder(pkg, options))
+
+        # Look up versions and revisions of all packages upfront and
+        # concurrently
+        package.prefetch(builders, configFile, options, buildState)
+
+        for builder in builders:
+            if builder.unchanged:
+                continue
+            builder.runCLI(configFile, askToCreateRelease=True,
+                           forceSvnAuth = options.forceSvnAuth,
+                           deferRelease=True)
+
     pkgversions = {}
-    pkginfos = {}
-    for pkg in config.get(base.BUILD_SECTION, 'packages').split():
-        customPath = None
-        if ':' in pkg:
-            pkg, customPath = pkg.split(':')
-        builder = package.PackageBuilder(pkg, options)
+    for builder in builders:
+        pkgversions[builder.pkg] = builder.chosenVersion
+        projectParser.set('versions', builder.pkg, builder.chosenVersion)
+
+    if not options.plan:
+        for builder in builders:
+            builder.journal = journal
+        if not options.resume:
+            journal.start(package.makePlan(configFile, builders))
+        # Create the new releases concurrently
+        failed = package.ReleaseExecutor(
+            options.jobs, options.batchRelease, sdistPool).run(builders)
+        if failed:
+            logger.error('Not all releases could be created, STOPPING')
+            logger.info('Continue with --resume')
+            sys.exit(1)
+        package.resolveBranchRevisions(builders)
 
-        version = builder.runCLI(configFile, askToCreateRelease=True,
-                                 forceSvnAuth = options.forceSvnAuth)
+    pkginfos = {}
+    for builder in builders:
+        pkginfos[builder.pkg] = (builder.branchUrl, builder.branchRevision)
 
-        pkgversions[pkg] = version
-        pkginfos[pkg] = (builder.branchUrl, builder.branchRevision)
-        projectParser.set('versions', pkg, version)
+    # Everything the generated configuration files are made from
+    graph = ExtendsGraph()
+    inputs = [os.path.abspath(configFile)]
+    if template_path:
+        inputs.extend(graph.resolve(template_path))
+    for section in config.sections():
+        if section != base.BUILD_SECTION:
+            inputs.append(os.path.abspath(config.get(section, 'template')))
+    unchanged = (buildState is not None
+                 and buildState.projectVersion is not None
+                 and not options.forceVersion
+                 and plan.get('project-version') in (
+                     None, buildState.projectVersion)
+                 and not buildState.packagesChanged(pkgversions)
+                 and not buildState.inputsChanged(inputs))
 
     # Get upload type
     try:
@@ -251,6 +527,10 @@ def build(configFile, options):
     try:
         config.get(base.BUILD_SECTION, 'buildout-server')
     except ConfigParser.NoOptionError:
+        if options.plan:
+            package.writePlan(options.plan, configFile, builders)
+        else:
+            finishBuild(buildState, journal, builders, True)
         logger.info('No buildout-server specified in the cfg, STOPPING')
         logger.info('Selected package versions:\n%s' % (
             '\n'.join('%s = %s' % (pkg, version)
@@ -259,22 +539,27 @@ def build(configFile, options):
 
     # Write the new configuration file to disk
     projectName = config.get(base.BUILD_SECTION, 'name')
-    defaultVersion = configVersion = config.get(base.BUILD_SECTION, 'version')
-    projectVersions = findProjectVersions(projectName, config,
-                                          options, uploadType)
-
-    # Determine new project version
-    if projectVersions:
-        defaultVersion = projectVersions[-1]
-    if options.nextVersion or configVersion == '+':
-        defaultVersion = base.guessNextVersion(defaultVersion)
-    if options.forceVersion:
-        if options.forceVersion in projectVersions:
-            logger.error('Forced version %s already exists' % options.forceVersion)
+    if unchanged:
+        if options.plan:
+            package.writePlan(options.plan, configFile, builders,
+                              projectVersion=buildState.projectVersion)
         else:
-            defaultVersion = options.forceVersion
-    projectVersion = base.getInput(
-        'Project Version', defaultVersion, options.useDefaults)
+            finishBuild(buildState, journal, builders, True, inputs,
+                        buildState.projectVersion)
+        logger.info('Nothing changed since the build of %s %s, STOPPING' % (
+            projectName, buildState.projectVersion))
+        return
+    if plan.get('project-version'):
+        projectVersion = plan['project-version']
+    else:
+        projectVersion = chooseProjectVersion(
+            projectName, config, options, uploadType)
+
+    if options.plan:
+        package.writePlan(options.plan, configFile, builders,
+                          projectVersion=projectVersion)
+        return
+    journal.setProjectVersion(projectVersion)
 
     # Write out the new project config -- the pinned versions
     projectConfigFilename = '%s-%s.cfg' % (projectName, projectVersion)
@@ -282,6 +567,7 @@ def build(configFile, options):
     projectParser.write(open(projectConfigFilename, 'w'))
 
     filesToUpload = [projectConfigFilename]
+    hashedFiles = set()
 
     try:
         hashConfigFiles = config.getboolean(base.BUILD_SECTION,
@@ -302,12 +588,14 @@ def build(configFile, options):
                                                projectConfigFilename,
                                                addSelf=False,
                                                outfile=projectConfigFilename,
-                                               hashes=hashes)
+                                               hashes=hashes, graph=graph)
 
         if hashConfigFiles:
-            dependencies = addHashes(dependencies, hashes)
+            dependencies = addHashes(dependencies, hashes, graph=graph)
+            hashedFiles.update(dependencies)
             #fix main config too
-            addHashes([projectConfigFilename], hashes, rename=False)
+            addHashes([projectConfigFilename], hashes, rename=False,
+                      graph=graph)
 
         filesToUpload.extend(dependencies)
 
@@ -332,7 +620,8 @@ def build(configFile, options):
     # first define a parser for load addition variable (vars) section somewhere
     # in your templates chain.
     varsParser = base.NonDestructiveRawConfigParser()
-    # make sure we use the right (tempalte inheritation) order
+    # make sure we use the right (tempalte inheritation) order, the files
+    # are in the topological order of ExtendsGraph.resolve
     varsParser.read(reversed(filesToUpload))
 
     for section in config.sections():
@@ -363,6 +652,17 @@ def build(configFile, options):
         vars['project-version'] = projectVersion
         vars['instance-name'] = section
 
+        # an unchanged section does not need to be built and uploaded again
+        key = hashlib.md5(repr((template, projectConfigFilename,
+                                sorted(vars.items())))).hexdigest()
+        if buildState is not None:
+            deployConfigFilename = buildState.getSection(section, key)
+            if deployConfigFilename is not None:
+                logger.info('Deployment file is unchanged: %s'
+                            % deployConfigFilename)
+                filesToUpload.append(deployConfigFilename)
+                continue
+
         # add current time
         vars['current-datetime'] = now.isoformat()
         vars['current-date'] = now.date().isoformat()
@@ -388,10 +688,34 @@ def build(configFile, options):
         deployConfig.set('buildout', 'extends', projectConfigFilename)
         logger.info('Writing deployment file: ' + deployConfigFilename)
         deployConfig.write(open(deployConfigFilename, 'w'))
+        if buildState is not None:
+            buildState.setSection(section, key, deployConfigFilename)
 
         filesToUpload.append(deployConfigFilename)
 
+    # hashed files are named by their content, a file of the same name on
+    # the server is the same file
+    if hashedFiles:
+        serverFiles = findServerFiles(projectName, config, options, uploadType)
+        for filename in sorted(hashedFiles & serverFiles):
+            logger.info('File is on the server already: %s' % filename)
+            filesToUpload.remove(filename)
+
+    def needsUpload(filename, destination):
+        if buildState is not None and buildState.isUploaded(
+            filename, destination):
+            logger.info('File is unchanged, not uploaded: %s' % filename)
+            return False
+        if journal.isUploaded(filename, destination):
+            logger.info('Resuming: file was uploaded already: %s' % filename)
+            return False
+        return True
+
     # Upload the files
+    complete = True
+    # only copying to a local destination happens offline and with
+    # --no-upload
+    skipped = uploadType != 'local' and (options.offline or options.noUpload)
     if uploadType == 'local':
         #no upload, just copy to destination
         dest = os.path.join(config.get(base.BUILD_SECTION, 'buildout-server'),
@@ -399,17 +723,36 @@ def build(configFile, options):
         if not os.path.exists(dest):
             os.makedirs(dest)
         for filename in filesToUpload:
-            shutil.copyfile(filename, os.path.join(dest, filename))
+            if needsUpload(filename, dest):
+                shutil.copyfile(filename, os.path.join(dest, filename))
+                journal.setUploaded(filename, dest)
+                if buildState is not None:
+                    buildState.setUploaded(filename, dest)
     elif uploadType == 'webdav':
         if not options.offline and not options.noUpload:
-            for filename in filesToUpload:
-                base.uploadFile(
-                    filename,
-                    config.get(
-                        base.BUILD_SECTION, 'buildout-server')+'/'+projectName,
+            url = config.get(
+                base.BUILD_SECTION, 'buildout-server')+'/'+projectName
+
+            def upload(filename):
+                headers = None
+                if filename in hashedFiles:
+                    headers = {'Cache-Control': IMMUTABLE}
+                uploaded = base.uploadFile(
+                    filename, url,
                     config.get(base.BUILD_SECTION, 'buildout-server-username'),
                     config.get(base.BUILD_SECTION, 'buildout-server-password'),
-                    options.offline)
+                    options.offline, headers=headers)
+                if uploaded:
+                    journal.setUploaded(filename, url)
+                return uploaded
+
+            filenames = [filename for filename in filesToUpload
+                         if needsUpload(filename, url)]
+            uploaded = uploadFiles(upload, filenames, options.jobs)
+            complete = len(uploaded) == len(filenames)
+            for filename in uploaded:
+                if buildState is not None:
+                    buildState.setUploaded(filename, url)
     elif uploadType == 'mypypi':
         if not options.offline and not options.noUpload:
             server = config.get(base.BUILD_SECTION, 'buildout-server')
@@ -419,21 +762,33 @@ def build(configFile, options):
             boundary = "--------------GHSKFJDLGDS7543FJKLFHRE75642756743254"
             headers={"Content-Type":
                 "multipart/form-data; boundary=%s; charset=utf-8" % boundary}
-            for filename in filesToUpload:
-                justfname = os.path.split(filename)[-1]
-                #being lazy here with the construction of the multipart form data
-                content = """--%s
-Content-Disposition: form-data; name="content";filename="%s"
-
-%s
---%s--
-""" % (boundary, justfname, open(filename, 'r').read(), boundary)
-
-                base.uploadContent(
-                    content, filename, url,
-                    config.get(base.BUILD_SECTION, 'buildout-server-username'),
-                    config.get(base.BUILD_SECTION, 'buildout-server-password'),
-                    options.offline, method='POST', headers=headers)
+
+            def upload(filename):
+                content = base.multipartBody(boundary, 'content', filename)
+                try:
+                    uploaded = base.uploadContent(
+                        content, filename, url,
+                        config.get(base.BUILD_SECTION,
+                                   'buildout-server-username'),
+                        config.get(base.BUILD_SECTION,
+                                   'buildout-server-password'),
+                        options.offline, method='POST', headers=headers)
+                finally:
+                    content.close()
+                if uploaded:
+                    journal.setUploaded(filename, url)
+                return uploaded
+
+            filenames = [filename for filename in filesToUpload
+                         if needsUpload(filename, url)]
+            uploaded = uploadFiles(upload, filenames, options.jobs)
+            complete = len(uploaded) == len(filenames)
+            for filename in uploaded:
+                if buildState is not None:
+                    buildState.setUploaded(filename, url)
+
+    finishBuild(buildState, journal, builders, complete, inputs,
+                projectVersion, uploaded=not skipped)
 
 
 def main(args=None):
@@ -458,11 +813,21 @@ def main(args=None):
     if options.quiet:
         logger.setLevel(logging.FATAL)
 
+    base.configure(options)
+    sdistPool = sdist.startPool(options)
+
     try:
-        build(options.configFile, options)
+        build(options.configFile, options, sdistPool)
     except KeyboardInterrupt:
+        base.cancelAll()
         logger.info("Quitting")
         sys.exit(0)
+    finally:
+        if sdistPool is not None:
+            sdistPool.close()
+
+    base.reportTimings()
+    logger.info(base.session.stats())
 
     # Remove the handler again.
     logger.removeHandler(handler)
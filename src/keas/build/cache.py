@@ -0,0 +1,113 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Inspect and prune the cache of built distributions
+
+$Id$
+"""
+__docformat__ = 'ReStructuredText'
+import logging
+import optparse
+import os
+import sys
+import time
+from keas.build import base
+
+logger = base.logger
+
+def formatSize(size):
+    return '%.1f MB' % (size / 1024.0 / 1024.0)
+
+def stats(cache):
+    entries = cache.entries()
+    size = sum([entry[1] for entry in entries])
+    print 'Cache: %s' % cache.directory
+    print 'Entries: %i, %s' % (len(entries), formatSize(size))
+    if cache.maxSize is not None:
+        print 'Limit: %s' % formatSize(cache.maxSize)
+    if not entries:
+        return
+    print 'Oldest use: %s' % time.ctime(entries[0][0])
+    print 'Latest use: %s' % time.ctime(entries[-1][0])
+    packages = {}
+    for lastUsed, entrySize, path, meta in entries:
+        count, total = packages.get(meta['pkg'], (0, 0))
+        packages[meta['pkg']] = (count + 1, total + entrySize)
+    print 'Packages:'
+    for pkg, (count, total) in sorted(packages.items()):
+        print '  * %s: %i, %s' % (pkg, count, formatSize(total))
+
+def prune(cache):
+    removed = cache.prune()
+    logger.info('Removed %i cached distributions' % removed)
+
+parser = optparse.OptionParser(
+    usage='%prog --cache-dir DIR [--max-size MB] stats|prune')
+parser.add_option(
+    "--cache-dir", action="store",
+    dest="cacheDir", metavar="DIR", default=None,
+    help="The --cache-dir of the builds.")
+
+parser.add_option(
+    "--max-size", action="store", type="int",
+    dest="maxSize", metavar="MB", default=1024,
+    help=("The size the cache is pruned to, the least recently used "
+          "distributions are removed first."))
+
+parser.add_option(
+    "-q", "--quiet", action="store_true",
+    dest="quiet", default=False,
+    help="When specified, no messages are displayed.")
+
+parser.add_option(
+    "-v", "--verbose", action="store_true",
+    dest="verbose", default=False,
+    help="When specified, debug information is created.")
+
+commands = {'stats': stats, 'prune': prune}
+
+def main(args=None):
+    # Make sure we get the arguments.
+    if args is None:
+        args = sys.argv[1:]
+    if not args:
+        args = ['-h']
+
+    # Set up logger handler
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(base.formatter)
+    logger.addHandler(handler)
+
+    # Parse arguments
+    options, args = parser.parse_args(args)
+
+    logger.setLevel(logging.INFO)
+    if options.verbose:
+        logger.setLevel(logging.DEBUG)
+    if options.quiet:
+        logger.setLevel(logging.FATAL)
+
+    if len(args) != 1 or args[0] not in commands:
+        parser.error('Expected one command: stats or prune')
+    if not options.cacheDir:
+        parser.error('--cache-dir is required')
+    directory = os.path.join(options.cacheDir, 'artifacts')
+    if not os.path.exists(directory):
+        logger.info('No cached distributions in %s' % options.cacheDir)
+        sys.exit(0)
+
+    commands[args[0]](
+        base.ArtifactCache(directory, options.maxSize * 1024 * 1024))
+
+    # Remove the handler again.
+    logger.removeHandler(handler)
@@ -16,14 +16,11 @@
 $Id$
 """
 __docformat__ = 'ReStructuredText'
-import BeautifulSoup
-import base64
 import logging
 import optparse
 import pkg_resources
 import re
 import sys
-import urllib2
 import urlparse
 import os.path
 from keas.build import base
@@ -37,19 +34,16 @@ class Installer(object):
     def __init__(self, options):
         self.options = options
 
+    def iterLinks(self, url, parent=None):
+        response = base.session.open(
+            url, self.options.username, self.options.password)
+        return base.iterLinks(response.iterChunks(), parent)
+
     def getProjects(self):
         logger.debug('Package Index: ' + self.options.url)
-        req = urllib2.Request(self.options.url)
-
-        if self.options.username:
-            base64string = base64.encodestring(
-                '%s:%s' % (self.options.username, self.options.password))[:-1]
-            req.add_header("Authorization", "Basic %s" % base64string)
-
-        soup = BeautifulSoup.BeautifulSoup(urllib2.urlopen(req).read())
-        projects = [tag.get('href').replace('/', '')
-                    for tag in soup('a')
-                    if tag.parent.name == 'td' and tag.get('href') != '/']
+        projects = [href.replace('/', '')
+                    for href, text in self.iterLinks(self.options.url, 'td')
+                    if href and href != '/']
         projects = sorted(projects)
         logger.debug('Found projects: %s' %' '.join(projects))
         return projects
@@ -58,17 +52,8 @@ class Installer(object):
         logger.debug('Package Index: ' + self.options.url)
         if not self.options.url.endswith('/'):
             self.options.url += '/'
-        req = urllib2.Request(self.options.url + project)
-
-        if self.options.username:
-            base64string = base64.encodestring(
-                '%s:%s' % (self.options.username, self.options.password))[:-1]
-            req.add_header("Authorization", "Basic %s" % base64string)
-
-        soup = BeautifulSoup.BeautifulSoup(urllib2.urlopen(req).read())
         variants = []
-        for tag in soup('a'):
-            text = tag.contents[0]
+        for href, text in self.iterLinks(self.options.url + project):
             if not text.startswith(project):
                 continue
             if len(text.split('-')) != 3:
@@ -83,17 +68,8 @@ class Installer(object):
 
     def getVersions(self, project, variant):
         logger.debug('Package Index: ' + self.options.url)
-        req = urllib2.Request(self.options.url + project)
-
-        if self.options.username:
-            base64string = base64.encodestring(
-                '%s:%s' % (self.options.username, self.options.password))[:-1]
-            req.add_header("Authorization", "Basic %s" % base64string)
-
-        soup = BeautifulSoup.BeautifulSoup(urllib2.urlopen(req).read())
         versions = []
-        for tag in soup('a'):
-            text = tag.contents[0]
+        for href, text in self.iterLinks(self.options.url + project):
             if not text:
                 continue
             text = str(text)
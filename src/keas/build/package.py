@@ -16,9 +16,8 @@
 $Id$
 """
 __docformat__ = 'ReStructuredText'
-import BeautifulSoup
 import ConfigParser
-import base64
+import json
 import logging
 import optparse
 import os
@@ -28,10 +27,11 @@ import shutil
 import sys
 import stat
 import tempfile
+import time
+import traceback
 import urllib
-import urllib2
-from xml.etree import ElementTree
-from keas.build import base
+import urlparse
+from keas.build import base, sdist, state
 
 logger = base.logger
 
@@ -52,6 +52,23 @@ def rmtree(dirname):
     else:
         shutil.rmtree(dirname)
 
+def setVersion(setuppy, version):
+    return re.sub(
+        "version ?= ?'(.*)',", "version = '%s'," %version, setuppy)
+
+def isPureWheel(filename):
+    # a wheel without ABI and platform tag runs everywhere, e.g.
+    # keas.build-0.4.2-py2-none-any.whl
+    return os.path.splitext(filename)[0].split('-')[-2:] == ['none', 'any']
+
+def nextDevVersion(setuppy, version):
+    # the dev version following the released one, None if setup.py has no
+    # version to update
+    if not re.search("version ?= ?'(.*)',", setuppy):
+        logger.error("No version =  found in setup.py, cannot update!")
+        return None
+    return base.guessNextVersion(version) + 'dev'
+
 class PackageBuilder(object):
 
     pkg = None
@@ -59,6 +76,7 @@ class PackageBuilder(object):
     options = None
 
     uploadType = 'internal'
+    buildWheels = False
     packageIndexUrl = None
     packageIndexUsername = None
     packageIndexPassword = None
@@ -68,13 +86,33 @@ class PackageBuilder(object):
     tagLayout = 'flat'
     svn = None
 
+    #filled by findVersions or upfront by build.py
+    versions = None
+    #svn info of branch and tag URLs, see resolveRevisions
+    revisions = None
+
     #filled by runCLI, as an info for build.py
+    chosenVersion = None
+    chosenBranch = None
     branchUrl = None
     branchRevision = None
+    #(version, branch) of a release deferred by runCLI
+    pendingRelease = None
+    #set by skipUnchanged when the version of the last build is used
+    unchanged = False
+    #the state.Journal recording the steps of the releases
+    journal = None
+    #the sdist.SdistPool building the distributions, see ReleaseExecutor
+    sdistPool = None
 
     def __init__(self, pkg, options):
         self.pkg = pkg
         self.options = options
+        # setup.py contents by branch
+        self.setupPys = {}
+        # (version, branch) -> whether the branch changed since the version,
+        # as found by the ChangeDetector
+        self.changes = {}
 
     def getTagURL(self, version):
         reposUrl = self.svnRepositoryUrl
@@ -107,77 +145,88 @@ class PackageBuilder(object):
         return branchUrl
 
     def getRevision(self, url):
-        #xml = base.do('svn info --xml ' + url)
-        xml = self.svn.info(url)
-        elem = ElementTree.fromstring(xml)
-        revision = elem.find("entry").find("commit").get("revision")
-        if not revision:
-            revision = 0
-        else:
-            revision = int(revision)
-        logger.debug('Revision for %s: %i' %(url, revision))
-
-        repoRevision = elem.find("entry").get("revision")
-        if not repoRevision:
-            repoRevision = 0
-        else:
-            repoRevision = int(repoRevision)
-            logger.debug('Repo Revision for %s: %i' %(url, repoRevision))
-        return (repoRevision, revision)
-
-    def findVersions(self):
-        if self.options.offline:
-            logger.info('Offline: Skip looking for versions.')
-            return []
-
-        logger.debug('Package Index: ' + self.packageIndexUrl)
-        req = urllib2.Request(self.packageIndexUrl)
-
-        if self.packageIndexUsername:
-            base64string = base64.encodestring(
-                '%s:%s' % (self.packageIndexUsername,
-                           self.packageIndexPassword))[:-1]
-            req.add_header("Authorization", "Basic %s" % base64string)
-
-        soup = BeautifulSoup.BeautifulSoup(urllib2.urlopen(req).read())
+        key = base.normalizeURL(url)
+        info = None
+        if self.revisions is not None:
+            info = self.revisions.get(key)
+        if info is None:
+            infos = self.svn.info(url)
+            info = infos.get(key)
+            if info is None and len(infos) == 1:
+                info = infos.values()[0]
+        if info is None:
+            logger.error('Could not get the revision of %s' % url)
+            sys.exit(1)
+        logger.debug('Revision for %s: %i' %(url, info.revision))
+        logger.debug('Repo Revision for %s: %i' %(url, info.repoRevision))
+        return (info.repoRevision, info.revision)
+
+    def forgetRevisions(self, branch):
+        # the branch gets committed to, so the resolved revisions are stale
+        if self.revisions is None:
+            return
+        branchUrl = self.getBranchURL(branch)
+        for url in (branchUrl, branchUrl + '/src'):
+            self.revisions.pop(base.normalizeURL(url), None)
+
+    def _extractVersions(self, url):
+        # Returns the versions and the link to the package's own page found
+        # on the page at url, or None if the page is not available.
+        page = base.session.fetch(
+            url, self.packageIndexUsername, self.packageIndexPassword,
+            offline=self.options.offline,
+            headers={'Accept': base.SIMPLE_ACCEPT}, parseLinks=True)
+        if page is None:
+            return None
+        result = page.extracted.get(self.pkg)
+        if result is not None:
+            return result
 
         VERSION = re.compile(self.pkg+r'-(\d+\.\d+(\.\d+){0,2})')
 
         simplePageUrl = None
 
         versions = []
-        for tag in soup('a'):
-            cntnt = str(tag.contents[0]) # str: re does not like non-strings
-
-            if cntnt == self.pkg:
-                try:
-                    simplePageUrl = tag['href']
-                except KeyError:
-                    pass
+        if base.isSimpleJSON(page):
+            # PEP 691 index: either the project list or the file list
+            data = json.loads(page.body)
+            name = base.normalizeProjectName(self.pkg)
+            for project in data.get('projects', ()):
+                if base.normalizeProjectName(project['name']) == name:
+                    simplePageUrl = urlparse.urljoin(url, name + '/')
+            names = [info['filename'] for info in data.get('files', ())]
+        else:
+            names = []
+            for href, cntnt in page.iterLinks():
+                if cntnt == self.pkg and href:
+                    simplePageUrl = urlparse.urljoin(url, href)
+                names.append(cntnt)
 
+        for cntnt in names:
             m = VERSION.search(cntnt)
             if m:
                 versions.append(m.group(1))
 
-        if len(versions) == 0 and simplePageUrl:
-            #we probably hit a PYPI-like simple index
-            #reload the linked page, check again for versions
-            req = urllib2.Request(simplePageUrl)
-
-            if self.packageIndexUsername:
-                base64string = base64.encodestring(
-                    '%s:%s' % (self.packageIndexUsername,
-                               self.packageIndexPassword))[:-1]
-                req.add_header("Authorization", "Basic %s" % base64string)
+        return base.session.remember(page, self.pkg, [versions, simplePageUrl])
 
-            soup = BeautifulSoup.BeautifulSoup(urllib2.urlopen(req).read())
+    def findVersions(self):
+        if self.options.offline and base.session.cache is None:
+            logger.info('Offline: Skip looking for versions.')
+            return []
 
-            for tag in soup('a'):
-                cntnt = str(tag.contents[0]) # str: re does not like non-strings
+        logger.debug('Package Index: ' + self.packageIndexUrl)
+        result = self._extractVersions(self.packageIndexUrl)
+        if result is None:
+            logger.info('Offline: No cached versions of %s.' % self.pkg)
+            return []
+        versions, simplePageUrl = result
 
-                m = VERSION.search(cntnt)
-                if m:
-                    versions.append(m.group(1))
+        if len(versions) == 0 and simplePageUrl:
+            #we probably hit a PYPI-like simple index
+            #reload the linked page, check again for versions
+            result = self._extractVersions(simplePageUrl)
+            if result is not None:
+                versions = result[0]
 
         logger.debug('All versions: ' + ' '.join(versions))
 
@@ -204,10 +253,7 @@ class PackageBuilder(object):
         logger.debug('Branches URL: ' + url)
 
         #xml = base.do('svn ls --xml ' + url)
-        xml = self.svn.ls(url)
-        elem = ElementTree.fromstring(xml)
-
-        branches = [elem.text for elem in elem.findall('./list/entry/name')]
+        branches = self.svn.ls(url)
 
         #if self.svnRepositoryUsername:
         #    base64string = base64.encodestring('%s:%s' % (
@@ -227,30 +273,32 @@ class PackageBuilder(object):
         # that our last release was updating the version in setup.py which also
         # forces a change after adding the tag. So let's check the source
         # directory instead.
-        branchUrl = self.getBranchURL(branch) + '/src'
-        tagUrl = self.getTagURL(version)
-        changed = self.getRevision(branchUrl)[1] > self.getRevision(tagUrl)[1]
+        changed = self.changes.get((version, branch))
+        if changed is None:
+            branchUrl = self.getBranchURL(branch) + '/src'
+            tagUrl = self.getTagURL(version)
+            changed = (self.getRevision(branchUrl)[1] >
+                       self.getRevision(tagUrl)[1])
         if changed:
             logger.info(
                 'Branch %r changed since the release of version %s' %(
                 branch, version))
         return changed
 
+    def getSetupPy(self, branch):
+        if branch not in self.setupPys:
+            branchURL = self.getBranchURL(branch)
+            if branchURL.endswith('/'):
+                branchURL = branchURL[:-1]
+            pyURL = '%s/setup.py' % branchURL
+            self.setupPys[branch] = self.svn.cat(pyURL)
+        return self.setupPys[branch]
+
     def isLastReleaseFromBranch(self, version, branch):
         # check if the dev marked version in setup.py from the given branch
         # compares with our version we will guess. If so, this means no
         # other branch was used for release this package.
-        branchURL = self.getBranchURL(branch)
-        if branchURL.endswith('/'):
-            branchURL = branchURL[:-1]
-        pyURL = '%s/setup.py' % branchURL
-        req = urllib2.Request(pyURL)
-        if self.packageIndexUsername:
-            base64string = base64.encodestring(
-                '%s:%s' % (self.packageIndexUsername,
-                           self.packageIndexPassword))[:-1]
-            req.add_header("Authorization", "Basic %s" % base64string)
-        setuppy = urllib2.urlopen(req).read()
+        setuppy = self.getSetupPy(branch)
         nextVersion = re.search("version ?= ?'(.*)',", setuppy)
         if not nextVersion:
             logger.error("No version =  found in setup.py, cannot update!")
@@ -266,6 +314,19 @@ class PackageBuilder(object):
                     version, branch))
                 return False
 
+    def isDone(self, step):
+        # whether the step of the release is recorded in the journal
+        return self.journal is not None and self.journal.isDone(self.pkg, step)
+
+    def getStep(self, step):
+        if self.journal is None:
+            return None
+        return self.journal.getStep(self.pkg, step)
+
+    def setStep(self, step, value=True):
+        if self.journal is not None:
+            self.journal.setStep(self.pkg, step, value)
+
     def createRelease(self, version, branch):
         logger.info('Creating release %r for %r from branch %r' %(
             version, self.pkg, branch))
@@ -276,94 +337,241 @@ class PackageBuilder(object):
         # 1. Create Release Tag
         branchUrl = self.getBranchURL(branch)
         tagUrl = self.getTagURL(version)
-
-        logger.info('Creating release tag')
-        #TODO: destination folder might not exist... create it
-        self.svn.cp(branchUrl, tagUrl, "Create release tag %s." % version)
-        #base.do('svn cp -m "Create release tag %s." %s %s' %(
-        #    version, branchUrl, tagUrl))
-
-        # 2. Download tag
         buildDir = tempfile.mkdtemp()
         tagDir = os.path.join(buildDir, '%s-%s' %(self.pkg, version))
-        self.svn.co(tagUrl, tagDir)
-        #base.do('svn co %s %s' %(tagUrl, tagDir))
-
-        # 3. Create release
-        # 3.1. Remove setup.cfg
-        logger.info("Updating tag version metadata")
-        setupCfgPath = os.path.join(tagDir, 'setup.cfg')
-        if os.path.exists(setupCfgPath):
-            os.remove(setupCfgPath)
-        # 3.2. Update the version
-        setuppy = file(os.path.join(tagDir, 'setup.py'), 'r').read()
-        setuppy = re.sub(
-            "version ?= ?'(.*)',", "version = '%s'," %version, setuppy)
-        file(os.path.join(tagDir, 'setup.py'), 'w').write(setuppy)
-        # 3.3. Check it all in
-        self.svn.ci(tagDir, "Prepare for release %s." % version)
-        #base.do('svn ci -m "Prepare for release %s." %s' %(version, tagDir))
+
+        # the steps recorded in the journal are skipped
+        revision = self.getStep('tag')
+        if self.isDone('tag'):
+            logger.info('Resuming: the release tag exists already')
+        elif self.releaseMode in ('svnmucc', 'export'):
+            # 1.-3. Tag and update the version in one commit
+            logger.info('Creating release tag with version metadata')
+            revision = self.createTag(branchUrl, tagUrl, version)
+            self.setStep('tag', revision)
+        else:
+            if self.isDone('copy'):
+                logger.info('Resuming: the release tag was copied already')
+            else:
+                logger.info('Creating release tag')
+                #TODO: destination folder might not exist... create it
+                self.svn.cp(branchUrl, tagUrl,
+                            "Create release tag %s." % version)
+                #base.do('svn cp -m "Create release tag %s." %s %s' %(
+                #    version, branchUrl, tagUrl))
+                self.setStep('copy')
+
+            # 2. Download tag
+            self.svn.co(tagUrl, tagDir)
+            #base.do('svn co %s %s' %(tagUrl, tagDir))
+
+            # 3. Create release
+            # 3.1. Remove setup.cfg
+            logger.info("Updating tag version metadata")
+            setupCfgPath = os.path.join(tagDir, 'setup.cfg')
+            if os.path.exists(setupCfgPath):
+                os.remove(setupCfgPath)
+            # 3.2. Update the version
+            setuppy = file(os.path.join(tagDir, 'setup.py'), 'r').read()
+            setuppy = setVersion(setuppy, version)
+            file(os.path.join(tagDir, 'setup.py'), 'w').write(setuppy)
+            # 3.3. Check it all in
+            self.svn.ci(tagDir, "Prepare for release %s." % version)
+            #base.do('svn ci -m "Prepare for release %s." %s' %(version, tagDir))
+            self.setStep('tag', None)
 
         # 4. Upload the distribution
+        self.distribute(version, tagUrl, tagDir, revision)
+
+        # 5. Update the start branch to the next development (dev) version
+        if self.isDone('branch'):
+            logger.info('Resuming: the branch version was updated already')
+        elif not self.options.noBranchUpdate:
+            logger.info("Updating branch version metadata")
+            if self.releaseMode in ('svnmucc', 'export'):
+                self.updateBranchVersion(branchUrl, version)
+            else:
+                # 5.1. Check out the branch.
+                branchDir = os.path.join(buildDir, 'branch')
+                self.svn.co(branchUrl, branchDir)
+                #base.do('svn co --non-recursive %s %s' %(branchUrl, branchDir))
+                # 5.2. Update setup.py to the next version
+                setupPyPath = os.path.join(branchDir, 'setup.py')
+                setuppy = file(setupPyPath, 'r').read()
+                newVersion = nextDevVersion(setuppy, version)
+                if newVersion is not None:
+                    file(setupPyPath, 'w').write(setVersion(setuppy, newVersion))
+                    # 5.3. Check in the changes.
+                    self.svn.ci(branchDir,
+                                "Update version number to %s." % newVersion)
+                    #base.do('svn ci -m "Update version number to %s." %s' %(
+                    #    newVersion, branchDir))
+            self.setStep('branch')
+
+        # 6. Cleanup
+        rmtree(buildDir)
+        self.forgetRevisions(branch)
+
+    def tagOperations(self, branchUrl, tagUrl, version):
+        # the svnmucc operations to copy the branch, set the version and
+        # remove setup.cfg; the branch is taken at the revision the
+        # decisions were based on
+        branchUrl = branchUrl.rstrip('/')
+        revision = self.getRevision(branchUrl)[0]
+        setuppy = self.svn.cat('%s/setup.py@%i' % (branchUrl, revision))
+        operations = [
+            ('cp', revision, branchUrl, tagUrl),
+            ('put', setVersion(setuppy, version), tagUrl + '/setup.py')]
+        if 'setup.cfg' in self.svn.ls('%s@%i' % (branchUrl, revision)):
+            operations.append(('rm', tagUrl + '/setup.cfg'))
+        return operations
+
+    def createTag(self, branchUrl, tagUrl, version):
+        # tag and update the version in a single commit on the server, based
+        # on the revision the decisions were made with
+        revision = self.getRevision(branchUrl.rstrip('/'))[0]
+        return self.svn.mucc(self.tagOperations(branchUrl, tagUrl, version),
+                             "Create release tag %s." % version, revision)
+
+    def getTag(self, tagUrl, tagDir, revision=None):
+        if self.releaseMode == 'export':
+            self.svn.export(tagUrl, tagDir, revision)
+        else:
+            self.svn.co(tagUrl, tagDir)
+
+    def distribute(self, version, tagUrl, tagDir, revision=None):
+        # build and upload the distribution, unless the journal says that
+        # it was done already
+        if self.isDone('upload'):
+            logger.info('Resuming: the distribution was uploaded already')
+            return
+        distributionFileNames = self.getStep('dists')
+        if (distributionFileNames is None and not self.buildWheels
+            and self.getStep('sdist')):
+            # journal of a run that built the tarball only
+            distributionFileNames = [self.getStep('sdist')]
+        if distributionFileNames and not [
+            name for name in distributionFileNames if not os.path.exists(name)]:
+            logger.info('Resuming: using the distributions built already')
+            self.uploadDistributionFiles(distributionFileNames)
+            return
+        if base.artifactCache is not None and self.uploadType == 'internal':
+            # the distribution of a tag revision never changes
+            if revision is None:
+                revision = self.getRevision(tagUrl)[1]
+            cached = base.artifactCache.get(self.pkg, tagUrl, revision,
+                                            self.buildWheels)
+            if cached is not None:
+                logger.info('Using the cached distributions of revision %s'
+                            % revision)
+                self.uploadDistributionFiles(cached)
+                return
+        if not os.path.exists(tagDir):
+            self.getTag(tagUrl, tagDir, revision)
+        self.uploadDistribution(version, tagDir, tagUrl, revision)
+
+    def uploadDistribution(self, version, tagDir, tagUrl=None, revision=None):
         if self.uploadType == 'internal':
             # 3.4. Create distribution
             logger.info("Creating release tarball")
-            base.do('python setup.py sdist', cwd = tagDir)
+            if self.sdistPool is not None:
+                files, duration = self.sdistPool.build(tagDir)
+                logger.info('Release tarball built in %.2f seconds' % duration)
+            else:
+                base.do('python setup.py sdist', cwd = tagDir,
+                        keepOutput=False)
 
             if is_win32:
                 ext = 'zip'
             else:
                 ext = 'tar.gz'
-            distributionFileName = os.path.join(
-                tagDir, 'dist', '%s-%s.%s' %(self.pkg, version, ext))
-            if not self.options.noUpload:
-                logger.info("Uploading release.")
-                base.uploadFile(
-                    distributionFileName,
-                    self.packageIndexUrl,
-                    self.packageIndexUsername, self.packageIndexPassword,
-                    self.options.offline)
+            distributionFileNames = [os.path.join(
+                tagDir, 'dist', '%s-%s.%s' %(self.pkg, version, ext))]
+            if self.buildWheels:
+                distributionFileNames.extend(self.buildWheel(tagDir))
+            if base.artifactCache is not None and revision is not None:
+                base.artifactCache.store(
+                    self.pkg, tagUrl, revision, distributionFileNames,
+                    self.buildWheels)
+            if self.journal is not None:
+                distributionFileNames = [
+                    self.journal.keep(name) for name in distributionFileNames]
+                self.setStep('dists', distributionFileNames)
+            self.uploadDistributionFiles(distributionFileNames)
         elif self.uploadType == 'setup.py':
             # 3.4. Create distribution and upload in one step
             logger.info("Uploading release to PyPI.")
+            commands = 'sdist'
+            if self.buildWheels:
+                commands = 'sdist bdist_wheel'
             # definitely DO NOT register!!!
-            base.do('python setup.py sdist upload', cwd = tagDir)
+            base.do('python setup.py %s upload' % commands, cwd = tagDir,
+                    keepOutput=False)
+            self.setStep('upload')
         else:
             logger.warn('Unknown uploadType: ' + self.uploadType)
 
-        # 5. Update the start branch to the next development (dev) version
-        if not self.options.noBranchUpdate:
-            logger.info("Updating branch version metadata")
-            # 5.1. Check out the branch.
-            branchDir = os.path.join(buildDir, 'branch')
-            self.svn.co(branchUrl, branchDir)
-            #base.do('svn co --non-recursive %s %s' %(branchUrl, branchDir))
-            # 5.2. Get the current version.
-            setuppy = file(os.path.join(branchDir, 'setup.py'), 'r').read()
-            currVersion = re.search("version ?= ?'(.*)',", setuppy)
-            if not currVersion:
-                logger.error("No version =  found in setup.py, cannot update!")
+    def buildWheel(self, tagDir):
+        # build the wheel from the same tree as the tarball, returns the
+        # wheel files
+        logger.info("Creating release wheel")
+        distDir = os.path.join(tagDir, 'dist')
+        before = set(os.listdir(distDir))
+        if self.sdistPool is not None:
+            files, duration = self.sdistPool.build(tagDir, ('bdist_wheel',))
+            logger.info('Release wheel built in %.2f seconds' % duration)
+        else:
+            base.do('python setup.py bdist_wheel', cwd = tagDir,
+                    keepOutput=False)
+        wheels = [os.path.join(distDir, name)
+                  for name in sorted(set(os.listdir(distDir)) - before)
+                  if name.endswith('.whl')]
+        for wheel in wheels:
+            if isPureWheel(wheel):
+                logger.info('Pure Python wheel for all platforms: %s'
+                            % os.path.split(wheel)[-1])
             else:
-                currVersion = currVersion.groups()[0]
-                # 5.3. Update setup/py to the next version of the currently
-                #      released one
-                newVersion = base.guessNextVersion(version) + 'dev'
-                setuppy = re.sub(
-                    "version ?= ?'(.*)',", "version = '%s'," %newVersion, setuppy)
-                file(os.path.join(branchDir, 'setup.py'), 'w').write(setuppy)
-                # 5.4. Check in the changes.
-                self.svn.ci(branchDir, "Update version number to %s." % newVersion)
-                #base.do('svn ci -m "Update version number to %s." %s' %(
-                #    newVersion, branchDir))
-
-        # 6. Cleanup
-        rmtree(buildDir)
+                logger.info('Platform specific wheel: %s'
+                            % os.path.split(wheel)[-1])
+        return wheels
 
-    def runCLI(self, configFile, askToCreateRelease=False, forceSvnAuth=False):
-        logger.info('-' * 79)
-        logger.info(self.pkg)
-        logger.info('-' * 79)
-        logger.info('Start releasing new version of ' + self.pkg)
+    def uploadDistributionFiles(self, distributionFileNames):
+        if self.options.noUpload:
+            return
+        logger.info("Uploading release.")
+        for distributionFileName in distributionFileNames:
+            if not base.uploadFile(
+                distributionFileName,
+                self.packageIndexUrl,
+                self.packageIndexUsername, self.packageIndexPassword,
+                self.options.offline):
+                logger.error('Could not upload %s' % distributionFileName)
+                sys.exit(1)
+        self.setStep('upload')
+
+    def branchVersionOperations(self, branchUrl, version, revision):
+        # the svnmucc operations to set the next dev version in the setup.py
+        # of the branch as of revision
+        branchUrl = branchUrl.rstrip('/')
+        setuppy = self.svn.cat('%s/setup.py@%i' % (branchUrl, revision))
+        newVersion = nextDevVersion(setuppy, version)
+        if newVersion is None:
+            return [], None
+        return [('put', setVersion(setuppy, newVersion),
+                 branchUrl + '/setup.py')], newVersion
+
+    def updateBranchVersion(self, branchUrl, version):
+        # set the next dev version on the server, the commit fails if
+        # setup.py changed since it was read
+        revision = self.getRevision(branchUrl)[0]
+        operations, newVersion = self.branchVersionOperations(
+            branchUrl, version, revision)
+        if not operations:
+            return None
+        return self.svn.mucc(
+            operations, "Update version number to %s." % newVersion, revision)
+
+    def loadConfig(self, configFile, forceSvnAuth=False):
         # 1. Read the configuration file.
         logger.info('Loading configuration file: ' + configFile)
         config = ConfigParser.RawConfigParser()
@@ -386,9 +594,10 @@ class PackageBuilder(object):
                 base.BUILD_SECTION, 'svn-repos-password')
 
             self.svn = base.SVN(svnRepositoryUsername, svnRepositoryPassword,
-                                forceAuth=True)
+                                forceAuth=True,
+                                repositoryUrl=self.svnRepositoryUrl)
         else:
-            self.svn = base.SVN()
+            self.svn = base.SVN(repositoryUrl=self.svnRepositoryUrl)
 
         try:
             self.uploadType = config.get(
@@ -396,12 +605,24 @@ class PackageBuilder(object):
         except ConfigParser.NoOptionError:
             self.uploadType = 'internal'
 
+        try:
+            self.buildWheels = config.getboolean(
+                base.BUILD_SECTION, 'build-wheels')
+        except ConfigParser.NoOptionError:
+            self.buildWheels = False
+
         try:
             self.tagLayout = config.get(
                 base.BUILD_SECTION, 'tag-layout')
         except ConfigParser.NoOptionError:
             self.tagLayout = 'flat'
 
+        try:
+            self.releaseMode = config.get(
+                base.BUILD_SECTION, 'release-mode')
+        except ConfigParser.NoOptionError:
+            self.releaseMode = 'checkout'
+
         # 1.3. Determine the possibly custom path.
         for pkg in config.get(base.BUILD_SECTION, 'packages').split():
             if pkg.startswith(self.pkg):
@@ -409,8 +630,20 @@ class PackageBuilder(object):
                     self.customPath = pkg.split(':')[1]
                 break
 
+    def runCLI(self, configFile, askToCreateRelease=False, forceSvnAuth=False,
+               deferRelease=False):
+        logger.info('-' * 79)
+        logger.info(self.pkg)
+        logger.info('-' * 79)
+        logger.info('Start releasing new version of ' + self.pkg)
+        # 1. Read the configuration file, unless build.py did it already.
+        if self.svn is None:
+            self.loadConfig(configFile, forceSvnAuth)
+
         # 2. Find all versions.
-        versions = self.findVersions()
+        if self.versions is None:
+            self.versions = self.findVersions()
+        versions = self.versions
         logger.info('Existing %s versions: %s' % (
             self.pkg, ' | '.join(reversed(versions))))
 
@@ -476,7 +709,7 @@ class PackageBuilder(object):
                 self.options.useDefaults and defaultVersion is not None)
             if version not in versions and not self.options.offline:
                 if askToCreateRelease:
-                    print 'The release %s-%s does not exist.' %(pkg, version)
+                    print 'The release %s-%s does not exist.' %(self.pkg, version)
                     doRelease = base.getInput(
                         'Do you want to create it? yes/no', 'yes',
                         self.options.useDefaults)
@@ -494,8 +727,12 @@ class PackageBuilder(object):
                         branch = base.getInput(
                             'What branch do you want to use?', 'trunk',
                             self.options.useDefaults)
-                    # 4.2. Create the release.
-                    self.createRelease(version, branch)
+                    # 4.2. Create the release, or leave it to a
+                    # ReleaseExecutor.
+                    if deferRelease:
+                        self.pendingRelease = (version, branch)
+                    else:
+                        self.createRelease(version, branch)
             break
         # 5. Return the version number.
         logger.info('Chosen version: ' + version)
@@ -503,12 +740,402 @@ class PackageBuilder(object):
         # save the info for build.py
         if branch is None:
             branch = 'trunk'
+        self.chosenVersion = version
+        self.chosenBranch = branch
         self.branchUrl = self.getBranchURL(branch)
-        self.branchRevision = self.getRevision(self.branchUrl)
+        if self.pendingRelease is None:
+            # otherwise the release changes it, see resolveBranchRevisions
+            self.branchRevision = self.getRevision(self.branchUrl)
 
         return version
 
 
+class ChangeDetector(object):
+    """Find out which packages changed since their last release.
+
+    Instead of comparing the revisions of every package, the commits since
+    the oldest of the last releases are read with a single ``svn log`` call
+    for all packages of a repository. The changed paths are mapped back to
+    the packages by their branch URLs.
+    """
+
+    def __init__(self, branch):
+        self.branch = branch
+
+    def _path(self, url, root):
+        # the path of url relative to the repository root
+        return base.normalizeURL(url)[len(base.normalizeURL(root)):]
+
+    def detect(self, builders):
+        """Store the result in the `changes` of the builders.
+
+        The builders must have resolved the revisions of their branch and
+        last release tag, see `resolveRevisions`. Builders for which nothing
+        can be found out are left alone and check their revisions later.
+        """
+        byRoot = {}
+        for builder in builders:
+            if not builder.versions or builder.revisions is None:
+                continue
+            branchInfo = builder.revisions.get(base.normalizeURL(
+                builder.getBranchURL(self.branch)))
+            tagInfo = builder.revisions.get(base.normalizeURL(
+                builder.getTagURL(builder.versions[-1])))
+            if branchInfo is None or tagInfo is None or not branchInfo.root:
+                continue
+            byRoot.setdefault(branchInfo.root, []).append(
+                (builder, branchInfo, tagInfo))
+        for root, infos in byRoot.items():
+            self._detect(root, infos)
+
+    def _detect(self, root, infos):
+        branchUrls = [base.normalizeURL(builder.getBranchURL(self.branch))
+                      for builder, branchInfo, tagInfo in infos]
+        # the deepest directory containing all branches
+        url = os.path.commonprefix([branchUrl + '/' for branchUrl in branchUrls])
+        url = url[:url.rindex('/')]
+        start = min([tagInfo.revision for builder, branchInfo, tagInfo
+                     in infos]) + 1
+        head = max([branchInfo.repoRevision for builder, branchInfo, tagInfo
+                    in infos])
+        entries = []
+        if start <= head:
+            logger.info('Reading the svn log of %s since revision %i' % (
+                url, start))
+            entries = infos[0][0].svn.log(url, start, head)
+            if entries is None:
+                logger.info('Could not read the svn log of %s' % url)
+                return
+        for builder, branchInfo, tagInfo in infos:
+            # changes of the version in setup.py do not count, see
+            # PackageBuilder.hasChangedSince
+            prefix = self._path(builder.getBranchURL(self.branch), root) + '/src'
+            changed = False
+            for revision, paths in entries:
+                if revision <= tagInfo.revision:
+                    continue
+                for path in paths:
+                    if path == prefix or path.startswith(prefix + '/'):
+                        changed = True
+                        break
+                if changed:
+                    break
+            builder.changes[(builder.versions[-1], self.branch)] = changed
+
+class ReleaseExecutor(object):
+    """Create the pending releases of several packages concurrently.
+
+    Each release runs in its own temporary directory and its log messages
+    are prefixed with the package name.
+    """
+
+    # the revision of the batch tagging commit
+    revision = None
+
+    def __init__(self, jobs=1, batch=False, sdistPool=None):
+        self.jobs = jobs
+        self.batch = batch
+        self.sdistPool = sdistPool
+
+    def _release(self, builder):
+        version, branch = builder.pendingRelease
+        base.setLogPrefix(builder.pkg)
+        try:
+            start = time.time()
+            builder.createRelease(version, branch)
+            return time.time() - start
+        finally:
+            base.setLogPrefix(None)
+
+    def _tagOperations(self, builder):
+        version, branch = builder.pendingRelease
+        base.setLogPrefix(builder.pkg)
+        try:
+            return builder.tagOperations(builder.getBranchURL(branch),
+                                         builder.getTagURL(version), version)
+        finally:
+            base.setLogPrefix(None)
+
+    def _distribute(self, builder):
+        version, branch = builder.pendingRelease
+        base.setLogPrefix(builder.pkg)
+        buildDir = tempfile.mkdtemp()
+        try:
+            start = time.time()
+            tagDir = os.path.join(buildDir, '%s-%s' %(builder.pkg, version))
+            builder.distribute(version, builder.getTagURL(version), tagDir,
+                               builder.getStep('tag') or self.revision)
+            return time.time() - start
+        finally:
+            rmtree(buildDir)
+            base.setLogPrefix(None)
+
+    def _branchVersionOperations(self, builder):
+        version, branch = builder.pendingRelease
+        return builder.branchVersionOperations(
+            builder.getBranchURL(branch), version, self.revision)
+
+    def _runBatch(self, builders):
+        # 1. Tag all packages and set their versions in one commit. Tags
+        #    recorded in the journal exist already.
+        svn = builders[0].svn
+        untagged = [builder for builder in builders
+                    if not builder.isDone('tag')]
+        tagged = [builder.getStep('tag') for builder in builders
+                  if builder.isDone('tag')]
+        if tagged:
+            logger.info('Resuming: %i release tags exist already'
+                        % len(tagged))
+            self.revision = max(tagged)
+        try:
+            operations = []
+            for result, excInfo in base.runParallel(
+                self._tagOperations, untagged, self.jobs):
+                if excInfo is not None:
+                    raise excInfo[0], excInfo[1], excInfo[2]
+                operations.extend(result)
+            if operations:
+                logger.info('Creating %i release tags in one commit'
+                            % len(untagged))
+                self.revision = svn.mucc(
+                    operations, 'Create release tags %s.' % (
+                    ', '.join(['%s %s' % (builder.pkg,
+                                          builder.pendingRelease[0])
+                               for builder in untagged])))
+                for builder in untagged:
+                    builder.setStep('tag', self.revision)
+        except BaseException:
+            excInfo = sys.exc_info()
+            return [(None, excInfo) for builder in builders]
+
+        # 2. Build and upload the distributions concurrently.
+        results = base.runParallel(self._distribute, builders, self.jobs)
+
+        # 3. Set the next dev versions of all released branches in one
+        #    commit; it fails if any of the setup.py files changed after
+        #    the tags were made.
+        released = [builder for builder, (duration, excInfo)
+                    in zip(builders, results)
+                    if excInfo is None and not builder.isDone('branch')]
+        if released and not released[0].options.noBranchUpdate:
+            logger.info('Updating branch version metadata of %i packages'
+                        % len(released))
+            try:
+                operations = []
+                for result, excInfo in base.runParallel(
+                    self._branchVersionOperations, released, self.jobs):
+                    if excInfo is not None:
+                        raise excInfo[0], excInfo[1], excInfo[2]
+                    operations.extend(result[0])
+                if operations:
+                    svn.mucc(operations, 'Update version numbers after '
+                             'release.', self.revision)
+                for builder in released:
+                    builder.setStep('branch')
+            except BaseException:
+                excInfo = sys.exc_info()
+                results = [(duration, excInfo) if builder in released
+                           else (duration, error)
+                           for builder, (duration, error)
+                           in zip(builders, results)]
+        for builder in builders:
+            builder.forgetRevisions(builder.pendingRelease[1])
+        return results
+
+    def run(self, builders):
+        """Release all builders with a pending release.
+
+        Returns the builders whose release failed, after reporting about all
+        of them.
+        """
+        builders = [builder for builder in builders
+                    if builder.pendingRelease is not None]
+        if not builders:
+            return []
+        logger.info('Creating %i releases, %i at a time' % (
+            len(builders), self.jobs))
+        for builder in builders:
+            builder.sdistPool = self.sdistPool
+        if self.batch and not builders[0].options.offline:
+            results = self._runBatch(builders)
+        else:
+            results = base.runParallel(self._release, builders, self.jobs)
+
+        failed = []
+        logger.info('-' * 79)
+        for builder, (duration, excInfo) in zip(builders, results):
+            version = builder.pendingRelease[0]
+            if excInfo is None:
+                logger.info('Released %s %s in %.1f seconds' % (
+                    builder.pkg, version, duration))
+                builder.pendingRelease = None
+            else:
+                error = traceback.format_exception_only(
+                    excInfo[0], excInfo[1])[-1].strip()
+                logger.error('Release of %s %s failed: %s' % (
+                    builder.pkg, version, error))
+                failed.append(builder)
+        logger.info('%i releases created, %i failed' % (
+            len(builders) - len(failed), len(failed)))
+        return failed
+
+def makePlan(configFile, builders, projectVersion=None):
+    """Return the versions chosen by runCLI and the pending releases."""
+    plan = {
+        'config': configFile,
+        'packages': [{'name': builder.pkg,
+                      'version': builder.chosenVersion,
+                      'branch': builder.chosenBranch,
+                      'release': builder.pendingRelease is not None}
+                     for builder in builders]}
+    if projectVersion is not None:
+        plan['project-version'] = projectVersion
+    return plan
+
+def writePlan(filename, configFile, builders, projectVersion=None):
+    """Write the plan of the builders.
+
+    The plan can be executed later with `loadPlan` and ``--apply``.
+    """
+    plan = makePlan(configFile, builders, projectVersion)
+    json.dump(plan, open(filename, 'w'), indent=2, sort_keys=True)
+    logger.info('Plan written to %s' % filename)
+    for info in plan['packages']:
+        action = 'use'
+        if info['release']:
+            action = 'release'
+        logger.info('  %s %s %s from %s' % (
+            action, info['name'], info['version'], info['branch']))
+
+def loadPlan(filename, configFile, options):
+    """Create builders for a plan written by `writePlan`.
+
+    Returns the builders, with their pending releases, and the plan.
+    """
+    logger.info('Loading plan: ' + filename)
+    return planBuilders(json.load(open(filename, 'r')), configFile, options)
+
+def planBuilders(plan, configFile, options):
+    """Create builders for a plan, see `loadPlan`."""
+    if plan.get('project-version') is not None:
+        plan['project-version'] = str(plan['project-version'])
+    builders = []
+    for info in plan['packages']:
+        # json gives unicode, which must not leak into the uploads
+        version, branch = str(info['version']), str(info['branch'])
+        builder = PackageBuilder(str(info['name']), options)
+        builder.loadConfig(configFile, forceSvnAuth=options.forceSvnAuth)
+        builder.chosenVersion = version
+        builder.chosenBranch = branch
+        builder.branchUrl = builder.getBranchURL(branch)
+        if info['release']:
+            builder.pendingRelease = (version, branch)
+        builders.append(builder)
+    return builders, plan
+
+def resolveBranchRevisions(builders):
+    """Get the branch revisions runCLI left out because of a release."""
+    missing = [builder for builder in builders
+               if builder.branchUrl and builder.branchRevision is None]
+    if not missing:
+        return
+    infos = missing[0].svn.info([builder.branchUrl for builder in missing])
+    for builder in missing:
+        if builder.revisions is None:
+            builder.revisions = {}
+        builder.revisions.update(infos)
+        builder.branchRevision = builder.getRevision(builder.branchUrl)
+
+def skipUnchanged(builders, state, branch=None):
+    """Use the versions of the last build for packages whose branch did not
+    change since.
+
+    The branches are checked with a single ``svn info`` call. The builders
+    of unchanged packages get their ``chosenVersion`` and are marked as
+    `unchanged`, the other builders are returned.
+    """
+    branch = branch or 'trunk'
+    known = []
+    for builder in builders:
+        info = state.getPackage(builder.pkg)
+        if info is not None and info[1] == branch:
+            known.append(builder)
+    if not known:
+        return builders
+    infos = known[0].svn.info(
+        [builder.getBranchURL(branch) for builder in known])
+    remaining = []
+    for builder in builders:
+        info = None
+        if builder in known:
+            info = infos.get(base.normalizeURL(builder.getBranchURL(branch)))
+        if info is None or info.revision != state.getPackage(builder.pkg)[2][1]:
+            remaining.append(builder)
+            continue
+        version = state.getPackage(builder.pkg)[0]
+        logger.info('%s did not change since the last build, using version %s'
+                    % (builder.pkg, version))
+        builder.unchanged = True
+        builder.chosenVersion = version
+        builder.chosenBranch = branch
+        builder.branchUrl = builder.getBranchURL(branch)
+        builder.branchRevision = (info.repoRevision, info.revision)
+    return remaining
+
+def prefetch(builders, configFile, options, state=None):
+    """Load everything the builders need to decide about their versions.
+
+    The package index versions and, for ``--independent-branches``, the
+    ``setup.py`` of the branch are fetched concurrently for all packages,
+    the svn revisions are resolved afterwards with a single call and the
+    changes since the last releases with a single ``svn log``. With the
+    `state` of the last build, packages that did not change are skipped
+    when no questions are asked.
+    """
+    if (state is not None and options.useDefaults and not options.offline
+        and not options.forceVersion):
+        for builder in builders:
+            builder.loadConfig(configFile, forceSvnAuth=options.forceSvnAuth)
+        builders = skipUnchanged(builders, state, options.branch)
+
+    def fetch(builder):
+        if builder.svn is None:
+            builder.loadConfig(configFile, forceSvnAuth=options.forceSvnAuth)
+        builder.versions = builder.findVersions()
+        if (options.branch and options.independent and options.nextVersion
+            and builder.versions and not options.offline):
+            builder.getSetupPy(options.branch)
+
+    logger.info('Looking up %i packages' % len(builders))
+    for result, excInfo in base.runParallel(fetch, builders, options.jobs):
+        if excInfo is not None:
+            raise excInfo[0], excInfo[1], excInfo[2]
+    resolveRevisions(builders, options.branch)
+    if options.branch and options.nextVersion and not options.offline:
+        ChangeDetector(options.branch).detect(builders)
+
+def resolveRevisions(builders, branch=None):
+    """Resolve the branch and last tag revisions of all builders at once.
+
+    The builders must have loaded their configuration and versions. All URLs
+    are looked up with one ``svn info`` call and the result is shared by the
+    builders, so that ``getRevision()`` does not need to call svn again.
+    """
+    if not builders:
+        return {}
+    urls = []
+    for builder in builders:
+        branchUrl = builder.getBranchURL(branch or 'trunk')
+        urls.append(branchUrl)
+        if branch and builder.versions and builder.options.nextVersion:
+            urls.append(builder.getTagURL(builder.versions[-1]))
+    logger.info('Resolving svn revisions of %i packages' % len(builders))
+    revisions = builders[0].svn.info(urls)
+    for builder in builders:
+        builder.revisions = revisions
+    return revisions
+
+
 def main(args=None):
     # Make sure we get the arguments.
     if args is None:
@@ -530,21 +1157,73 @@ def main(args=None):
     if options.quiet:
         logger.setLevel(logging.FATAL)
 
-    if len(args) == 0:
+    base.configure(options)
+    sdistPool = sdist.startPool(options)
+    try:
+        release(options, args, sdistPool)
+    finally:
+        if sdistPool is not None:
+            sdistPool.close()
+
+    base.reportTimings()
+    logger.info(base.session.stats())
+
+    # Remove the handler again.
+    logger.removeHandler(handler)
+
+def release(options, args, sdistPool=None):
+    journal = None
+    if not options.plan:
+        journal = state.Journal(
+            state.getJournalPath(options.configFile, options))
+
+    if options.resume:
+        if journal.plan is None:
+            logger.error('Nothing to resume, no journal at %s' % journal.path)
+            sys.exit(1)
+        logger.info('Resuming from journal: ' + journal.path)
+        builders, plan = planBuilders(
+            journal.plan, options.configFile, options)
+    elif options.apply:
+        builders, plan = loadPlan(options.apply, options.configFile, options)
+    elif len(args) == 0:
         print "No package was specified."
         print "Usage: build-package [options] package1 package2 ..."
         sys.exit(0)
-    for pkg in args:
-        builder = PackageBuilder(pkg, options,
-                                 forceSvnAuth = options.forceSvnAuth)
-        try:
-            builder.runCLI(options.configFile)
-        except KeyboardInterrupt:
-            logger.info("Quitting")
-            sys.exit(0)
+    else:
+        builders = []
+        for pkg in args:
+            builder = PackageBuilder(pkg, options)
+            try:
+                builder.runCLI(options.configFile,
+                               forceSvnAuth=options.forceSvnAuth,
+                               deferRelease=True)
+            except KeyboardInterrupt:
+                base.cancelAll()
+                logger.info("Quitting")
+                sys.exit(0)
+            builders.append(builder)
+
+    if options.plan:
+        writePlan(options.plan, options.configFile, builders)
+        sys.exit(0)
 
-    # Remove the handler again.
-    logger.removeHandler(handler)
+    for builder in builders:
+        builder.journal = journal
+    if not options.resume:
+        journal.start(makePlan(options.configFile, builders))
+
+    try:
+        failed = ReleaseExecutor(
+            options.jobs, options.batchRelease, sdistPool).run(builders)
+    except KeyboardInterrupt:
+        base.cancelAll()
+        logger.info("Quitting")
+        sys.exit(0)
+    if failed:
+        logger.info('Continue with --resume')
+        sys.exit(1)
+    journal.finish()
 
     # Exit cleanly.
     sys.exit(0)
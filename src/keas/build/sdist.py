@@ -0,0 +1,163 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""A pool of warm Python processes building source distributions
+
+$Id$
+"""
+__docformat__ = 'ReStructuredText'
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+import time
+import traceback
+from keas.build import base
+
+logger = base.logger
+
+def isSupported():
+    # every build runs in a forked child of a worker
+    return hasattr(os, 'fork')
+
+def warmUp():
+    # imported once per worker instead of once per package
+    import setuptools
+    import setuptools.command.sdist
+    import distutils.command.sdist
+
+def runSetup(tagDir, args):
+    # in the forked child: run setup.py as ``python setup.py args`` would
+    os.chdir(tagDir)
+    setupPath = os.path.join(tagDir, 'setup.py')
+    sys.path.insert(0, tagDir)
+    sys.argv = [setupPath] + list(args)
+    try:
+        execfile(setupPath, {'__name__': '__main__', '__file__': setupPath})
+    except SystemExit, err:
+        if err.code is None or isinstance(err.code, int):
+            return err.code or 0
+        sys.stderr.write('%s\n' % err.code)
+        return 1
+    except BaseException:
+        traceback.print_exc()
+        return 1
+    return 0
+
+def build(tagDir, args, timeout=None):
+    """Run setup.py in a fresh child of the worker.
+
+    Returns the exit code, the output, the new files in the ``dist``
+    directory, the time it took and whether the child was killed after
+    `timeout` seconds.
+    """
+    start = time.time()
+    distDir = os.path.join(tagDir, 'dist')
+    before = set()
+    if os.path.isdir(distDir):
+        before = set(os.listdir(distDir))
+    output = tempfile.TemporaryFile()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            # in its own process group, which is killed as a whole
+            os.setpgrp()
+            os.dup2(output.fileno(), 1)
+            os.dup2(output.fileno(), 2)
+            code = runSetup(tagDir, args)
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+    timedOut = False
+    while True:
+        finished, status = os.waitpid(pid, os.WNOHANG)
+        if finished:
+            break
+        if timeout and time.time() - start > timeout:
+            timedOut = True
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except OSError:
+                # already finished
+                pass
+            pid, status = os.waitpid(pid, 0)
+            break
+        time.sleep(0.02)
+    code = 1
+    if os.WIFEXITED(status):
+        code = os.WEXITSTATUS(status)
+    output.seek(0)
+    files = []
+    if os.path.isdir(distDir):
+        files = [os.path.join(distDir, name)
+                 for name in sorted(set(os.listdir(distDir)) - before)]
+    return code, output.read(), files, time.time() - start, timedOut
+
+def startPool(options):
+    """Return the pool of the ``--sdist-workers``, None if there is none.
+
+    The workers are forked, so the pool has to be started before any other
+    thread.
+    """
+    if not options.sdistWorkers or options.offline or options.plan:
+        return None
+    if not isSupported():
+        logger.warn('sdist workers are not supported on this platform')
+        return None
+    logger.info('Starting %i sdist workers' % options.sdistWorkers)
+    return SdistPool(options.sdistWorkers)
+
+class SdistPool(object):
+    """Build the distributions of tags in a pool of worker processes.
+
+    The workers import setuptools once. Each build runs in a forked child of
+    a worker, so that nothing a ``setup.py`` does leaks into the next one.
+    """
+
+    def __init__(self, workers):
+        self.pool = multiprocessing.Pool(workers, warmUp)
+
+    def build(self, tagDir, args=('sdist',)):
+        """Return the built files and the time it took; errors are fatal."""
+        timeout = base.commandTimeout
+        # get() with a timeout, so that Ctrl-C still works; the worker
+        # kills the build after the command timeout
+        code, output, files, duration, timedOut = self.pool.apply_async(
+            build, (tagDir, args, timeout)).get(2**31)
+        command = 'setup.py %s in %s' % (' '.join(args), tagDir)
+        base.commandTimings.append((command, duration))
+        for line in output.splitlines():
+            logger.debug(line)
+        tail = ''.join(output.splitlines(True)[-base.Command.tailSize:])
+        if timedOut:
+            logger.error(u'Command timed out after %s seconds: %s' % (
+                timeout, command))
+            logger.error('Error Output: \n%s' % tail)
+            sys.exit(1)
+        if code != 0:
+            logger.error(u'An error occurred while running command: %s'
+                         % command)
+            logger.error('Error Output: \n%s' % tail)
+            sys.exit(code)
+        logger.debug('Built %s in %.2f seconds' % (
+            ', '.join([os.path.split(name)[-1] for name in files]), duration))
+        return files, duration
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,255 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""The state of the last build of a project and the journal of a running one
+
+$Id$
+"""
+__docformat__ = 'ReStructuredText'
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+from keas.build import base
+
+logger = base.logger
+
+def fileHash(path):
+    return hashlib.md5(open(path, 'rb').read()).hexdigest()
+
+class UploadRecord(object):
+    """The uploaded files with their hashes, kept in ``data['uploaded']``."""
+
+    def _uploadKey(self, filename, destination):
+        return '%s/%s' % (destination.rstrip('/'), os.path.split(filename)[-1])
+
+    def isUploaded(self, filename, destination):
+        """Whether the file was uploaded to destination with this content."""
+        return self.data['uploaded'].get(
+            self._uploadKey(filename, destination)) == fileHash(filename)
+
+    def setUploaded(self, filename, destination):
+        self.data['uploaded'][self._uploadKey(filename, destination)] = (
+            fileHash(filename))
+
+class BuildState(UploadRecord):
+    """A manifest of what the last successful build did.
+
+    It records the chosen package versions with their branch revisions, the
+    hashes of the configuration files the build was made from, the deploy
+    sections and the hashes of the uploaded files, so that the next build can
+    skip everything that did not change.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = {'packages': {}, 'inputs': {}, 'sections': {},
+                     'uploaded': {}, 'project-version': None}
+        if os.path.exists(path):
+            try:
+                self.data.update(json.load(open(path, 'r')))
+            except ValueError:
+                logger.warn('Ignoring broken build state: %s' % path)
+            else:
+                logger.info('Loaded build state: %s' % path)
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp = '%s.%i.tmp' % (self.path, os.getpid())
+        json.dump(self.data, open(tmp, 'w'), indent=2, sort_keys=True)
+        os.rename(tmp, self.path)
+        logger.debug('Saved build state: %s' % self.path)
+
+    @property
+    def projectVersion(self):
+        version = self.data['project-version']
+        if version is not None:
+            version = str(version)
+        return version
+
+    def getPackage(self, pkg):
+        """Return the version, branch and branch revision of the last build.
+
+        Returns None for packages that were not built yet.
+        """
+        info = self.data['packages'].get(pkg)
+        if info is None:
+            return None
+        return (str(info['version']), str(info['branch']),
+                tuple(info['revision']))
+
+    def setPackage(self, pkg, version, branch, revision):
+        self.data['packages'][pkg] = {
+            'version': version, 'branch': branch, 'revision': list(revision)}
+
+    def packagesChanged(self, versions):
+        # versions is a mapping of package name to version
+        known = dict([(pkg, info['version'])
+                      for pkg, info in self.data['packages'].items()])
+        return known != versions
+
+    def inputsChanged(self, paths):
+        """Whether the given files, or any file the last build was made from,
+        changed since the last build."""
+        inputs = self.data['inputs']
+        for path in paths:
+            if os.path.abspath(path) not in inputs:
+                return True
+        for path, hash in inputs.items():
+            if not os.path.exists(path) or fileHash(path) != hash:
+                return True
+        return False
+
+    def setInputs(self, paths):
+        self.data['inputs'] = dict([(os.path.abspath(path), fileHash(path))
+                                    for path in paths])
+
+    def getSection(self, name, key):
+        """Return the deploy file written for the section, if the section
+        is built from the same key and the file is unchanged."""
+        info = self.data['sections'].get(name)
+        if info is None or info['key'] != key:
+            return None
+        filename = str(info['filename'])
+        if not os.path.exists(filename) or fileHash(filename) != info['hash']:
+            return None
+        return filename
+
+    def setSection(self, name, key, filename):
+        self.data['sections'][name] = {
+            'key': key, 'filename': filename, 'hash': fileHash(filename)}
+
+    def setBuild(self, packages, inputs=None, projectVersion=None):
+        """Remember a successful build.
+
+        `packages` are the (pkg, version, branch, revision) of the build,
+        only packages built by this build are kept.
+        """
+        self.data['packages'] = {}
+        for pkg, version, branch, revision in packages:
+            self.setPackage(pkg, version, branch, revision)
+        if inputs is not None:
+            self.setInputs(inputs)
+        if projectVersion is not None:
+            self.data['project-version'] = projectVersion
+
+def getJournalPath(configFile, options):
+    """Return the path of the journal, None if the run is not recorded.
+
+    Runs are recorded with ``--journal`` or in the ``--cache-dir``.
+    """
+    if options.journal:
+        return options.journal
+    if options.cacheDir:
+        configFile = os.path.abspath(configFile)
+        return os.path.join(options.cacheDir, 'journal-%s-%s' % (
+            os.path.basename(configFile),
+            hashlib.md5(configFile).hexdigest()[:8]))
+    if options.resume:
+        logger.error('Nothing to resume, a journal is only recorded with '
+                     '--journal or --cache-dir')
+        sys.exit(1)
+    return None
+
+class Journal(UploadRecord):
+    """A record of the steps of a run, so that ``--resume`` can continue
+    where a failed run stopped.
+
+    It holds the plan of the run, the completed steps of every release, the
+    distributions that were built, and the uploaded files. Distributions are
+    kept next to the journal until the run is finished. Without a path the
+    journal is kept in memory only.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {'plan': None, 'steps': {}, 'uploaded': {}}
+        if path is not None and os.path.exists(path):
+            try:
+                self.data.update(json.load(open(path, 'r')))
+            except ValueError:
+                logger.warn('Ignoring broken journal: %s' % path)
+
+    @property
+    def plan(self):
+        return self.data['plan']
+
+    @property
+    def filesDir(self):
+        return self.path + '.files'
+
+    def save(self):
+        # called with the lock held
+        if self.path is None:
+            return
+        tmp = '%s.%i.tmp' % (self.path, os.getpid())
+        json.dump(self.data, open(tmp, 'w'), indent=2, sort_keys=True)
+        os.rename(tmp, self.path)
+
+    def start(self, plan):
+        """Start a new run, forgetting the steps of an earlier one."""
+        self.finish()
+        with self.lock:
+            self.data = {'plan': plan, 'steps': {}, 'uploaded': {}}
+            self.save()
+        if self.path is not None:
+            logger.info('Journal started: %s' % self.path)
+
+    def setProjectVersion(self, version):
+        with self.lock:
+            self.data['plan']['project-version'] = version
+            self.save()
+
+    def isDone(self, pkg, step):
+        return step in self.data['steps'].get(pkg, {})
+
+    def getStep(self, pkg, step):
+        value = self.data['steps'].get(pkg, {}).get(step)
+        if isinstance(value, unicode):
+            value = str(value)
+        return value
+
+    def setStep(self, pkg, step, value=True):
+        with self.lock:
+            self.data['steps'].setdefault(pkg, {})[step] = value
+            self.save()
+
+    def keep(self, path):
+        """Copy the file next to the journal and return the copy's path."""
+        if self.path is None:
+            return os.path.abspath(path)
+        if not os.path.exists(self.filesDir):
+            os.makedirs(self.filesDir)
+        kept = os.path.abspath(
+            os.path.join(self.filesDir, os.path.split(path)[-1]))
+        shutil.copyfile(path, kept)
+        return kept
+
+    def setUploaded(self, filename, destination):
+        with self.lock:
+            UploadRecord.setUploaded(self, filename, destination)
+            self.save()
+
+    def finish(self):
+        """Remove the journal after a successful run."""
+        if self.path is None:
+            return
+        if os.path.exists(self.filesDir):
+            shutil.rmtree(self.filesDir)
+        if os.path.exists(self.path):
+            os.remove(self.path)
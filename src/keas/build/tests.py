@@ -0,0 +1,1637 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Tests
+
+$Id$
+"""
+__docformat__ = 'ReStructuredText'
+import BaseHTTPServer
+import ConfigParser
+import SocketServer
+import logging
+import md5
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from keas.build import base, build, package, sdist, state
+
+
+class TempDirTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, *names):
+        return os.path.join(self.tmpdir, *names)
+
+
+class CommandTest(unittest.TestCase):
+
+    def setUp(self):
+        self.timings = list(base.commandTimings)
+
+    def tearDown(self):
+        base.commandTimings[:] = self.timings
+
+    def test_output(self):
+        command = base.Command('echo out; echo err >&2')
+        self.assertEqual(command.run(), 0)
+        self.assertEqual(command.output, ['out\n'])
+        self.assertEqual(list(command.stderrTail), ['err\n'])
+        self.assertEqual(base.commandTimings[-1][0], command.cmd)
+
+    def test_tail(self):
+        command = base.Command('seq 100', keepOutput=False)
+        command.run()
+        self.assertEqual(command.output, [])
+        self.assertEqual(len(command.stdoutTail), base.Command.tailSize)
+        self.assertEqual(command.stdoutTail[-1], '100\n')
+
+    def test_timeout(self):
+        command = base.Command('sleep 30', timeout=0.3)
+        command.run()
+        self.assertTrue(command.timedOut)
+        self.assertTrue(command.duration < 10)
+        self.assertRaises(SystemExit, base.do, 'sleep 30', timeout=0.3)
+
+    def test_timeout_escaped_child(self):
+        # a child in its own session keeps the output pipe open
+        command = base.Command(
+            'python -c "import os, time; os.setsid(); time.sleep(5)" &',
+            timeout=0.3)
+        command.run()
+        self.assertTrue(command.timedOut)
+        self.assertTrue(command.duration < 4)
+
+    def test_prefix(self):
+        # the output of commands run in parallel is told apart by the
+        # prefix of the thread that runs them
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        base.logger.addHandler(handler)
+        level = base.logger.level
+        base.logger.setLevel(logging.DEBUG)
+
+        def run(pkg):
+            base.setLogPrefix(pkg)
+            try:
+                base.do('echo out-%s; echo err-%s >&2' % (pkg, pkg))
+            finally:
+                base.setLogPrefix(None)
+        try:
+            results = base.runParallel(run, ['pkg.a', 'pkg.b'], 2)
+        finally:
+            base.logger.removeHandler(handler)
+            base.logger.setLevel(level)
+        self.assertEqual(results, [(None, None), (None, None)])
+        for pkg in ('pkg.a', 'pkg.b'):
+            for line in ('out-' + pkg, 'err-' + pkg):
+                self.assertTrue('[%s] %s' % (pkg, line) in messages)
+
+    def test_reportTimings(self):
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        base.logger.addHandler(handler)
+        level = base.logger.level
+        base.logger.setLevel(logging.INFO)
+        try:
+            base.commandTimings[:] = [
+                ('svn ls --username joe --password secret http://svn', 2.0),
+                ('svn info http://svn', 1.0)]
+            base.reportTimings(count=1)
+        finally:
+            base.logger.removeHandler(handler)
+            base.logger.setLevel(level)
+        self.assertEqual(messages, [
+            '2 commands ran in 3.00 seconds',
+            '  2.00s svn ls --username joe --password *** http://svn'])
+
+
+class LinkExtractorTest(unittest.TestCase):
+
+    page = ('<html><body><h1>Links for pkg</h1>\n'
+            '<table><tr><td><a href="/pkg/">pkg</a></td>\n'
+            '<td><a href="pkg-1.0.tar.gz#md5=1">pkg-1.0.tar.gz</a><br/></td>'
+            '</tr></table>\n'
+            '<a href="other">caf&eacute; &#228;&#x41; &bogus;</a>\n'
+            '<a name="top">\n'
+            '</body></html>')
+
+    def test_links(self):
+        self.assertEqual(list(base.iterLinks(self.page)), [
+            ('/pkg/', 'pkg'),
+            ('pkg-1.0.tar.gz#md5=1', 'pkg-1.0.tar.gz'),
+            ('other', u'caf\xe9 \xe4A &bogus;'),
+            (None, '\n')])
+
+    def test_parent(self):
+        self.assertEqual(list(base.iterLinks(self.page, 'td')), [
+            ('/pkg/', 'pkg'),
+            ('pkg-1.0.tar.gz#md5=1', 'pkg-1.0.tar.gz')])
+
+    def test_chunks(self):
+        # the page split anywhere, even inside of tags and entities
+        for size in (1, 3, 7, 64):
+            chunks = [self.page[i:i+size]
+                      for i in range(0, len(self.page), size)]
+            self.assertEqual(list(base.iterLinks(chunks)),
+                             list(base.iterLinks(self.page)))
+
+    def test_broken(self):
+        self.assertEqual(
+            list(base.iterLinks('<a href="pkg-1.0.tar.gz">pkg</a><!')),
+            [('pkg-1.0.tar.gz', 'pkg')])
+
+
+class ConfigTestCase(TempDirTestCase):
+    """Config files in a temporary working directory."""
+
+    def setUp(self):
+        super(ConfigTestCase, self).setUp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        super(ConfigTestCase, self).tearDown()
+
+    def writeConfig(self, name, extends=(), content=''):
+        text = '[buildout]\n'
+        if extends:
+            text += 'extends = %s\n' % ' '.join(extends)
+        path = self.path(name)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').write(text + content)
+        return path
+
+
+class ExtendsGraphTest(ConfigTestCase):
+
+    def test_resolve(self):
+        # a diamond: every file comes before the files it extends
+        self.writeConfig('project.cfg', ['a.cfg', 'b.cfg'])
+        self.writeConfig('a.cfg', ['base.cfg'])
+        self.writeConfig('b.cfg', ['base.cfg'])
+        self.writeConfig('base.cfg')
+        graph = build.ExtendsGraph()
+        order = [os.path.basename(path) for path in
+                 graph.resolve(self.path('project.cfg'))]
+        self.assertEqual(order[0], 'project.cfg')
+        self.assertEqual(order[-1], 'base.cfg')
+        self.assertEqual(sorted(order), ['a.cfg', 'b.cfg', 'base.cfg',
+                                         'project.cfg'])
+        self.assertEqual(len(graph.configs), 4)
+
+    def test_long_chain(self):
+        for i in range(2000):
+            self.writeConfig('%i.cfg' % i, ['%i.cfg' % (i + 1)])
+        self.writeConfig('2000.cfg')
+        order = build.ExtendsGraph().resolve(self.path('0.cfg'))
+        self.assertEqual(len(order), 2001)
+
+    def test_relative(self):
+        self.writeConfig('project.cfg', ['sub/a.cfg'])
+        self.writeConfig('sub/a.cfg', ['base.cfg'])
+        self.writeConfig('sub/base.cfg')
+        order = build.ExtendsGraph().resolve(self.path('project.cfg'))
+        self.assertEqual(order[-1], self.path('sub', 'base.cfg'))
+
+    def test_cycle(self):
+        self.writeConfig('project.cfg', ['a.cfg'])
+        self.writeConfig('a.cfg', ['b.cfg'])
+        self.writeConfig('b.cfg', ['a.cfg'])
+        self.assertRaises(SystemExit, build.ExtendsGraph().resolve,
+                          self.path('project.cfg'))
+
+    def test_missing(self):
+        self.writeConfig('project.cfg', ['missing.cfg'])
+        self.assertRaises(SystemExit, build.ExtendsGraph().resolve,
+                          self.path('project.cfg'))
+
+
+class AddHashesTest(ConfigTestCase):
+
+    def addHashes(self):
+        self.writeConfig('a.cfg', ['b.cfg'])
+        self.writeConfig('b.cfg', ['c.cfg'])
+        hashes = dict([(name, 'unhashed')
+                       for name in ('a.cfg', 'b.cfg', 'c.cfg')])
+        names = build.addHashes(['a.cfg', 'b.cfg', 'c.cfg'], hashes)
+        return names, hashes
+
+    def test_merkle(self):
+        self.writeConfig('c.cfg', content='x = 1\n')
+        names, hashes = self.addHashes()
+        self.assertEqual(names, [build.hashedName(name, hashes[name])
+                                 for name in ('a.cfg', 'b.cfg', 'c.cfg')])
+        for name in names:
+            content = open(name).read()
+            self.assertTrue(md5.new(content).hexdigest() in name)
+        # the extends point to the hashed files
+        self.assertTrue(names[1] in open(names[0]).read())
+        self.assertTrue(names[2] in open(names[1]).read())
+
+        # a change at the bottom changes the hash of every file above it
+        self.writeConfig('c.cfg', content='x = 2\n')
+        changed, changedHashes = self.addHashes()
+        for name in ('a.cfg', 'b.cfg', 'c.cfg'):
+            self.assertNotEqual(hashes[name], changedHashes[name])
+
+    def test_stable(self):
+        self.writeConfig('c.cfg')
+        names, hashes = self.addHashes()
+        self.assertEqual(self.addHashes(), (names, hashes))
+
+
+class Options(object):
+    journal = None
+    cacheDir = None
+    resume = False
+
+
+class PlanOptions(Options):
+    forceSvnAuth = False
+    offline = True
+
+
+class PlanTest(TempDirTestCase):
+
+    def setUp(self):
+        super(PlanTest, self).setUp()
+        self.config = self.path('project.cfg')
+        open(self.config, 'w').write(
+            '[build]\n'
+            'package-index = http://index/\n'
+            'package-index-username = user\n'
+            'package-index-password = secret\n'
+            'svn-repos = http://svn/repos/\n'
+            'packages = pkg.a\n  pkg.b\n')
+        self.options = PlanOptions()
+        self.builders = []
+        for name, version, branch, release in (
+                ('pkg.a', '1.1', 'trunk', True),
+                ('pkg.b', '2.0', 'maint', False)):
+            builder = package.PackageBuilder(name, self.options)
+            builder.chosenVersion = version
+            builder.chosenBranch = branch
+            if release:
+                builder.pendingRelease = (version, branch)
+            self.builders.append(builder)
+
+    def assertBuilders(self, builders):
+        self.assertEqual([(builder.pkg, builder.chosenVersion,
+                           builder.chosenBranch, builder.pendingRelease)
+                          for builder in builders],
+                         [(builder.pkg, builder.chosenVersion,
+                           builder.chosenBranch, builder.pendingRelease)
+                          for builder in self.builders])
+        for builder in builders:
+            # no unicode from json
+            self.assertTrue(type(builder.pkg) is str)
+            self.assertTrue(type(builder.chosenVersion) is str)
+        self.assertEqual(builders[0].branchUrl, 'http://svn/repos/trunk/pkg.a')
+        self.assertEqual(builders[1].branchUrl,
+                         'http://svn/repos/branches/maint/pkg.b/')
+
+    def test_round_trip(self):
+        filename = self.path('plan.json')
+        package.writePlan(filename, self.config, self.builders, '3.0')
+        builders, plan = package.loadPlan(filename, self.config, self.options)
+        self.assertBuilders(builders)
+        self.assertEqual(plan['project-version'], '3.0')
+        self.assertEqual(
+            package.makePlan(self.config, builders, '3.0'),
+            package.makePlan(self.config, self.builders, '3.0'))
+
+    def test_plan_resume(self):
+        options, args = base.parser.parse_args(
+            ['--plan', self.path('plan.json'), '--resume'])
+        self.assertRaises(SystemExit, base.configure, options)
+
+    def test_journal(self):
+        # a resumed release continues with the plan in the journal
+        journal = state.Journal(self.path('journal'))
+        journal.start(package.makePlan(self.config, self.builders))
+        journal = state.Journal(self.path('journal'))
+        builders, plan = package.planBuilders(
+            journal.plan, self.config, self.options)
+        self.assertBuilders(builders)
+
+
+class PageCacheTest(TempDirTestCase):
+
+    def setUp(self):
+        super(PageCacheTest, self).setUp()
+        self.session = base.HTTPSession()
+        self.session.cache = base.PageCache(self.path('http'))
+
+    def test_remember_from_threads(self):
+        page = base.Page('http://index/', 'body')
+        self.session.cache.store(page)
+
+        def extract(n):
+            for i in range(200):
+                self.session.remember(page, 'pkg%i-%i' % (n, i), [[], None])
+        threads = [threading.Thread(target=extract, args=(n,))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        cached = self.session.cache.get('http://index/')
+        self.assertEqual(len(cached.extracted), 800)
+        self.assertEqual(cached.body, 'body')
+
+
+class RecordingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        etag = self.server.headers.get('ETag')
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.server.body
+        headers = {'Content-Type': 'text/html'}
+        headers.update(self.server.headers)
+        if self.path in self.server.pages:
+            if self.server.pages[self.path] is None:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            headers['Content-Type'], body = self.server.pages[self.path]
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        self.receive(201)
+
+    def do_POST(self):
+        self.receive(200)
+
+    def receive(self, status):
+        body = self.rfile.read(int(self.headers['content-length']))
+        self.server.uploads.append((self.command, self.path, body))
+        if self.server.statuses:
+            status = self.server.statuses.pop(0)
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+
+class HTTPTestCase(TempDirTestCase):
+    """Runs a local HTTP server recording the requests."""
+
+    body = ''
+
+    def setUp(self):
+        super(HTTPTestCase, self).setUp()
+        self.server = HTTPServer(('127.0.0.1', 0), RecordingHandler)
+        self.server.requests = []
+        self.server.body = self.body
+        self.server.headers = {}
+        # (content type, body) by path instead of the body, None for a
+        # missing page
+        self.server.pages = {}
+        self.server.uploads = []
+        # statuses of the next uploads, instead of 201 and 200
+        self.server.statuses = []
+        self.url = 'http://127.0.0.1:%i' % self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.session = base.HTTPSession()
+        self.session.proxies = {}
+
+    def tearDown(self):
+        # close the kept-alive connections, their handler threads end
+        for connections in self.session.idle.values():
+            for connection in connections:
+                connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+        super(HTTPTestCase, self).tearDown()
+
+
+class HTTPSessionTest(HTTPTestCase):
+
+    body = '<a href="pkg-1.0.tar.gz">pkg-1.0.tar.gz</a>'
+
+    def test_keepalive(self):
+        self.assertEqual(self.session.open(self.url + '/a').read(), self.body)
+        self.assertEqual(self.session.open(self.url + '/b').read(), self.body)
+        self.assertEqual(self.session.stats(),
+                         '2 HTTP requests, 1 connections opened, 1 reused')
+
+    def test_proxy(self):
+        self.session.proxies = {'http': 'http://joe:secret@%s'
+                                % self.url.split('://')[1]}
+        response = self.session.open('http://index.example.com/simple/')
+        self.assertEqual(response.read(), self.body)
+        path, headers = self.server.requests[0]
+        self.assertEqual(path, 'http://index.example.com/simple/')
+        self.assertEqual(headers['proxy-authorization'],
+                         self.session.authHeader('joe', 'secret'))
+
+    def test_file_url(self):
+        open(self.path('index.html'), 'w').write(self.body)
+        page = self.session.fetch('file://' + self.path('index.html'))
+        self.assertEqual(page.body, self.body)
+        self.assertEqual(self.server.requests, [])
+
+
+class FetchTest(HTTPTestCase):
+
+    body = '<a href="pkg-1.0.tar.gz">pkg-1.0.tar.gz</a>'
+
+    def setUp(self):
+        super(FetchTest, self).setUp()
+        self.session.cache = base.PageCache(self.path('http'))
+
+    def fetchAgain(self, url, **kw):
+        # a new run, with the pages of the last one on disk
+        self.session.pages.clear()
+        return self.session.fetch(url, **kw)
+
+    def test_etag(self):
+        self.server.headers = {'ETag': '"1"'}
+        page = self.session.fetch(self.url + '/simple/')
+        self.assertFalse(page.notModified)
+        self.session.remember(page, 'pkg', ['1.0'])
+        self.assertTrue(self.session.fetch(self.url + '/simple/') is page)
+        self.assertEqual(len(self.server.requests), 1)
+
+        page = self.fetchAgain(self.url + '/simple/')
+        self.assertTrue(page.notModified)
+        self.assertEqual(page.body, self.body)
+        self.assertEqual(page.extracted, {'pkg': ['1.0']})
+        self.assertEqual(self.server.requests[1][1]['if-none-match'], '"1"')
+
+        self.server.headers = {'ETag': '"2"'}
+        self.server.body = 'changed'
+        page = self.fetchAgain(self.url + '/simple/')
+        self.assertFalse(page.notModified)
+        self.assertEqual(page.body, 'changed')
+        self.assertEqual(page.extracted, {})
+
+    def test_offline(self):
+        self.assertEqual(
+            self.session.fetch(self.url + '/simple/', offline=True), None)
+        self.session.fetch(self.url + '/simple/')
+        page = self.fetchAgain(self.url + '/simple/', offline=True)
+        self.assertEqual(page.body, self.body)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_immutable(self):
+        self.server.headers = {
+            'ETag': '"1"', 'Cache-Control': build.IMMUTABLE}
+        self.session.fetch(self.url + '/base-123.cfg')
+        page = self.fetchAgain(self.url + '/base-123.cfg')
+        self.assertTrue(page.notModified)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_max_age_is_revalidated(self):
+        # index pages change with every upload, even within their max-age
+        self.server.headers = {
+            'ETag': '"1"', 'Cache-Control': 'public, max-age=600'}
+        self.session.fetch(self.url + '/simple/')
+        self.fetchAgain(self.url + '/simple/')
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_parseLinks(self):
+        self.server.headers = {'ETag': '"1"'}
+        self.server.body = ''.join([
+            '<a href="pkg-1.%i.tar.gz">pkg-1.%i.tar.gz</a>\n' % (i, i)
+            for i in range(2000)])
+        page = self.session.fetch(self.url + '/simple/pkg/', parseLinks=True)
+        self.assertEqual(page.body, self.server.body)
+        self.assertEqual(len(page.links), 2000)
+        self.assertEqual(page.links[-1], ('pkg-1.1999.tar.gz',
+                                          'pkg-1.1999.tar.gz'))
+        self.assertEqual(list(page.iterLinks()),
+                         list(base.iterLinks(page.body)))
+        # cached pages are parsed from their body
+        page = self.fetchAgain(self.url + '/simple/pkg/', parseLinks=True)
+        self.assertEqual(page.links, None)
+        self.assertEqual(len(list(page.iterLinks())), 2000)
+
+    def test_parseLinks_json(self):
+        self.server.headers = {'Content-Type': base.SIMPLE_JSON}
+        self.server.body = '{"files": []}'
+        page = self.session.fetch(self.url + '/simple/pkg/', parseLinks=True)
+        self.assertEqual(page.links, None)
+        self.assertTrue(base.isSimpleJSON(page))
+
+    def test_isFresh(self):
+        page = base.Page('http://index/', '', {'cache-control': 'immutable'})
+        self.assertTrue(page.isFresh())
+        page.cacheControl = 'max-age=60, immutable'
+        self.assertTrue(page.isFresh())
+        page.fetched -= 120
+        self.assertFalse(page.isFresh())
+        page.cacheControl = 'no-cache, immutable'
+        self.assertFalse(page.isFresh())
+        page.cacheControl = None
+        self.assertFalse(page.isFresh())
+
+
+class FindVersionsTest(HTTPTestCase):
+
+    def setUp(self):
+        super(FindVersionsTest, self).setUp()
+        self.globalSession = base.session
+        base.session = self.session
+        self.builder = package.PackageBuilder('Pkg.A', PlanOptions())
+        self.builder.options.offline = False
+        self.builder.options.branch = None
+        self.builder.packageIndexUrl = self.url + '/simple/'
+
+    def tearDown(self):
+        base.session = self.globalSession
+        super(FindVersionsTest, self).tearDown()
+
+    def test_json(self):
+        self.server.pages = {
+            '/simple/': (base.SIMPLE_JSON, '{"meta": {"api-version": "1.0"}, '
+                         '"projects": [{"name": "other"}, '
+                         '{"name": "pkg_a"}]}'),
+            '/simple/pkg-a/': (base.SIMPLE_JSON + '; charset=utf-8',
+                '{"meta": {"api-version": "1.1"}, "name": "pkg-a", '
+                '"versions": ["1.0", "1.2", "1.10"], "files": ['
+                '{"filename": "Pkg.A-1.10.zip", "url": "a"}, '
+                '{"filename": "Pkg.A-1.0.tar.gz", "url": "b"}, '
+                '{"filename": "Pkg.A-1.2-py2-none-any.whl", "url": "c"}, '
+                '{"filename": "Other-3.0.tar.gz", "url": "d"}]}')}
+        self.assertEqual(self.builder.findVersions(), ['1.0', '1.2', '1.10'])
+        self.assertEqual([path for path, headers in self.server.requests],
+                         ['/simple/', '/simple/pkg-a/'])
+        for path, headers in self.server.requests:
+            self.assertEqual(headers['accept'], base.SIMPLE_ACCEPT)
+
+    def test_html(self):
+        # the content type decides, not the Accept header
+        self.server.pages = {
+            '/simple/': ('text/html', '<a href="pkg-a/">Pkg.A</a>'),
+            '/simple/pkg-a/': ('text/html',
+                '<a href="Pkg.A-1.1.tar.gz">Pkg.A-1.1.tar.gz</a>\n'
+                '<a href="Pkg.A-1.0.tar.gz">Pkg.A-1.0.tar.gz</a>')}
+        self.assertEqual(self.builder.findVersions(), ['1.0', '1.1'])
+        self.assertEqual([path for path, headers in self.server.requests],
+                         ['/simple/', '/simple/pkg-a/'])
+
+
+class UploadTest(HTTPTestCase):
+
+    def setUp(self):
+        super(UploadTest, self).setUp()
+        self.globalSession = base.session
+        base.session = self.session
+        self.uploadRetries = base.uploadRetries
+        base.uploadRetries = 1
+        self.file = self.path('project-1.0.cfg')
+        open(self.file, 'w').write('[buildout]\n')
+        self.messages = []
+        self.handler = logging.Handler()
+        self.handler.emit = lambda record: self.messages.append(
+            record.getMessage())
+        base.logger.addHandler(self.handler)
+        self.level = base.logger.level
+        base.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        base.logger.removeHandler(self.handler)
+        base.logger.setLevel(self.level)
+        base.uploadRetries = self.uploadRetries
+        base.session = self.globalSession
+        super(UploadTest, self).tearDown()
+
+    def upload(self, method='PUT'):
+        return base.uploadContent('content', 'project-1.0.cfg',
+                                  self.url + '/project/project-1.0.cfg',
+                                  'user', 'secret', False, method)
+
+    def test_put(self):
+        self.assertTrue(base.uploadFile(self.file, self.url + '/project',
+                                        'user', 'secret', False))
+        self.assertEqual(self.server.uploads, [
+            ('PUT', '/project/project-1.0.cfg', '[buildout]\n')])
+
+    def test_put_retried(self):
+        self.server.statuses = [503]
+        self.assertTrue(self.upload())
+        self.assertEqual(len(self.server.uploads), 2)
+
+    def test_put_fails(self):
+        self.server.statuses = [500, 500]
+        self.assertFalse(self.upload())
+        self.assertEqual(len(self.server.uploads), 1 + base.uploadRetries)
+        # a response other than 201 Created is an error, and not repeated
+        self.server.statuses = [200]
+        self.assertFalse(self.upload())
+        self.assertEqual(len(self.server.uploads), 2 + base.uploadRetries)
+
+    def test_post(self):
+        self.assertTrue(self.upload('POST'))
+        # a POST is not repeated
+        self.server.statuses = [500]
+        self.assertFalse(self.upload('POST'))
+        self.server.statuses = [201]
+        self.assertFalse(self.upload('POST'))
+        self.assertEqual(len(self.server.uploads), 3)
+
+    def test_offline(self):
+        self.assertFalse(base.uploadContent(
+            'content', 'project-1.0.cfg', self.url + '/project-1.0.cfg',
+            'user', 'secret', True, 'PUT'))
+        self.assertEqual(self.server.uploads, [])
+
+    def test_uploadFiles(self):
+        files = []
+        for name in ('a.cfg', 'b.cfg', 'c.cfg'):
+            files.append(self.path(name))
+            open(files[-1], 'w').write(name)
+
+        def upload(filename):
+            if filename.endswith('c.cfg'):
+                raise IOError('broken')
+            return filename.endswith('a.cfg')
+        self.assertEqual(build.uploadFiles(upload, files, 2), files[:1])
+        self.assertEqual(build.uploadFiles(upload, [], 2), [])
+        self.assertEqual(self.messages[0],
+                         'Uploading 3 files, 2 at a time')
+        self.assertTrue(self.messages[1].startswith(
+            'Uploaded %s: 5 bytes in ' % files[0]))
+        self.assertTrue(self.messages[2].startswith(
+            'Failed %s: 5 bytes in ' % files[1]))
+        self.assertEqual(self.messages[3],
+                         'Upload of %s failed: IOError: broken' % files[2])
+        self.assertTrue(self.messages[4].startswith(
+            '1 files uploaded, 2 failed, 0.0 kB in '))
+        self.assertEqual(len(self.messages), 5)
+
+    def test_multipart(self):
+        body = base.multipartBody('BOUNDARY', 'content', self.file)
+        try:
+            self.assertTrue(base.uploadContent(
+                body, 'project-1.0.cfg', self.url + '/project/upload',
+                'user', 'secret', False, 'POST'))
+        finally:
+            body.close()
+        expected = ('--BOUNDARY\n'
+                    'Content-Disposition: form-data; name="content";'
+                    'filename="project-1.0.cfg"\n\n'
+                    '[buildout]\n'
+                    '\n--BOUNDARY--\n')
+        self.assertEqual(self.server.uploads,
+                         [('POST', '/project/upload', expected)])
+        self.assertEqual(len(body), len(expected))
+
+
+class StreamBodyTest(TempDirTestCase):
+
+    def test_read(self):
+        path = self.path('file')
+        open(path, 'w').write('0123456789')
+        body = base.StreamBody('ab', open(path, 'rb'), '', 'cd')
+        try:
+            self.assertEqual(len(body), 14)
+            for size in (1, 3, 5, 14, 100):
+                body.rewind()
+                chunks = []
+                while True:
+                    chunk = body.read(size)
+                    if not chunk:
+                        break
+                    self.assertTrue(len(chunk) <= size)
+                    chunks.append(chunk)
+                self.assertEqual(''.join(chunks), 'ab0123456789cd')
+            body.rewind()
+            self.assertEqual(body.read(), 'ab0123456789cd')
+            self.assertEqual(body.read(), '')
+        finally:
+            body.close()
+
+
+class FindServerFilesTest(HTTPTestCase):
+
+    def setUp(self):
+        super(FindServerFilesTest, self).setUp()
+        self.globalSession = base.session
+        base.session = self.session
+        self.config = ConfigParser.RawConfigParser()
+        self.config.add_section('build')
+        self.config.set('build', 'buildout-server', self.url + '/buildouts/')
+        self.config.set('build', 'buildout-server-username', 'user')
+        self.config.set('build', 'buildout-server-password', 'secret')
+        self.options, args = base.parser.parse_args([])
+
+    def tearDown(self):
+        base.session = self.globalSession
+        super(FindServerFilesTest, self).tearDown()
+
+    def test_listing(self):
+        self.server.pages['/buildouts/project/'] = ('text/html',
+            '<html><body><h1>Index of /buildouts/project</h1>\n'
+            '<a href="../">Parent Directory</a>\n'
+            '<a href="base-0123.cfg">base-0123.cfg</a>\n'
+            '<a href="/buildouts/project/my%20base-4567.cfg">my base</a>\n'
+            '</body></html>')
+        files = build.findServerFiles('project', self.config, self.options,
+                                      'webdav')
+        self.assertTrue('base-0123.cfg' in files)
+        self.assertTrue('my base-4567.cfg' in files)
+        self.assertEqual(self.server.requests[0][1]['authorization'],
+                         self.session.authHeader('user', 'secret'))
+
+    def test_missing(self):
+        self.server.pages['/buildouts/project/'] = None
+        self.assertEqual(build.findServerFiles(
+            'project', self.config, self.options, 'webdav'), set())
+
+    def test_no_upload(self):
+        self.options.noUpload = True
+        self.assertEqual(build.findServerFiles(
+            'project', self.config, self.options, 'webdav'), set())
+        self.assertEqual(self.server.requests, [])
+
+    def test_local(self):
+        self.config.set('build', 'buildout-server', self.path('buildouts'))
+        self.assertEqual(build.findServerFiles(
+            'project', self.config, self.options, 'local'), set())
+        os.makedirs(self.path('buildouts', 'project'))
+        open(self.path('buildouts', 'project', 'base-0123.cfg'), 'w')
+        self.assertEqual(build.findServerFiles(
+            'project', self.config, self.options, 'local'),
+            set(['base-0123.cfg']))
+
+
+class BuildTest(HTTPTestCase):
+    """Runs `build.build` for a project without packages in a temporary
+    working directory, uploading to the test server."""
+
+    def setUp(self):
+        super(BuildTest, self).setUp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        self.globalSession = base.session
+        base.session = self.session
+        self.writeConfig()
+
+    def writeConfig(self, options=''):
+        open(self.path('project.cfg'), 'w').write(
+            '[build]\n'
+            'name = project\n'
+            'version = 1.0\n'
+            'packages =\n'
+            'package-index = %(url)s/simple/\n'
+            'package-index-username = user\n'
+            'package-index-password = secret\n'
+            'svn-repos = http://svn/repos/\n'
+            'buildout-server = %(url)s/buildouts/\n'
+            'buildout-server-username = user\n'
+            'buildout-server-password = secret\n'
+            '%(options)s' % {'url': self.url, 'options': options})
+
+    def tearDown(self):
+        base.session = self.globalSession
+        os.chdir(self.cwd)
+        super(BuildTest, self).tearDown()
+
+    def build(self, *args):
+        options, args = base.parser.parse_args(
+            ['-c', 'project.cfg', '-d', '--state-file', 'state.json']
+            + list(args))
+        build.build(options.configFile, options)
+
+    def test_build(self):
+        self.build()
+        self.assertEqual([(method, path) for method, path, body
+                          in self.server.uploads],
+                         [('PUT', '/buildouts//project/project-1.0.cfg')])
+        # nothing changed, nothing is uploaded again
+        self.build()
+        self.assertEqual(len(self.server.uploads), 1)
+
+    def test_no_upload(self):
+        # regression: a build that was not uploaded was remembered, so
+        # that the next run found nothing changed and uploaded nothing
+        self.build('--no-upload')
+        self.assertEqual(self.server.uploads, [])
+        self.build()
+        self.assertEqual([path for method, path, body
+                          in self.server.uploads],
+                         ['/buildouts//project/project-1.0.cfg'])
+
+    def test_hashed_files_on_server(self):
+        self.writeConfig('template = template.cfg\n'
+                         'hash-config-files = true\n')
+        open(self.path('template.cfg'), 'w').write(
+            '[buildout]\nextends = base.cfg\n')
+        open(self.path('base.cfg'), 'w').write('[buildout]\nparts =\n')
+        self.server.pages['/buildouts/project/'] = ('text/html', '')
+        self.build()
+        uploads = sorted([path.split('/')[-1] for method, path, body
+                          in self.server.uploads])
+        self.assertEqual(len(uploads), 2)
+        self.assertEqual(uploads[1], 'project-1.0.cfg')
+        hashed = uploads[0]
+        self.assertTrue(hashed.startswith('base-'))
+
+        # the hashed file is on the server, the next build skips it
+        self.server.uploads = []
+        self.server.pages['/buildouts/project/'] = ('text/html',
+            '<a href="../">..</a>\n'
+            '<a href="/buildouts/project/%s">%s</a>\n'
+            '<a href="project-1.0.cfg">project-1.0.cfg</a>' % (
+            hashed, hashed))
+        os.remove(self.path('state.json'))
+        self.build()
+        self.assertEqual([path.split('/')[-1] for method, path, body
+                          in self.server.uploads], ['project-1.0.cfg'])
+
+
+class SVNTestCase(TempDirTestCase):
+    """Replaces `base.do` to record the svn commands and answer them."""
+
+    def setUp(self):
+        super(SVNTestCase, self).setUp()
+        self.commands = []
+        self.outputs = []
+        self.do = base.do
+        base.do = self.fakeDo
+
+    def tearDown(self):
+        base.do = self.do
+        super(SVNTestCase, self).tearDown()
+
+    def fakeDo(self, cmd, cwd=None, captureOutput=True, ignoreErrors=False,
+               keepOutput=True, timeout=None):
+        self.commands.append(cmd)
+        if callable(self.outputs):
+            return self.outputs(cmd)
+        return self.outputs.pop(0)
+
+
+def infoXML(urls, head=20):
+    # the output of ``svn info --xml`` for urls below http://svn
+    entries = ''.join([
+        '<entry kind="dir" path="x" revision="%i"><url>%s</url>'
+        '<repository><root>http://svn</root></repository>'
+        '<commit revision="%i"><author>joe</author></commit></entry>'
+        % (head, url, 10 + index) for index, url in enumerate(urls)])
+    return '<?xml version="1.0"?>\n<info>%s</info>\n' % entries
+
+
+class SVNInfoTest(SVNTestCase):
+
+    def answer(self, cmd):
+        urls = [arg for arg in cmd.split() if arg.startswith('http')]
+        return infoXML([url for url in urls if 'missing' not in url])
+
+    def test_parseInfo(self):
+        infos = base.parseInfo(infoXML(['http://svn/trunk/pkg/']))
+        self.assertEqual(infos, {'http://svn/trunk/pkg': base.SVNInfo(
+            20, 10, 'http://svn/trunk/pkg/', 'http://svn')})
+        self.assertEqual(base.parseInfo(''), {})
+        # svn stops writing at a missing target
+        self.assertEqual(
+            len(base.parseInfo(infoXML(['http://svn/a'])[:-8])), 1)
+
+    def test_batches(self):
+        self.outputs = self.answer
+        svn = base.SVN()
+        svn.batchSize = 2
+        urls = ['http://svn/trunk/pkg%i' % i for i in range(5)]
+        infos = svn.info(urls + ['http://svn/trunk/missing'])
+        self.assertEqual(len(self.commands), 3)
+        self.assertEqual(sorted(infos.keys()), urls)
+        self.assertEqual(infos['http://svn/trunk/pkg1'].revision, 11)
+
+    def test_cached(self):
+        self.outputs = self.answer
+        cache = base.MetadataCache(self.path('svn.json'))
+        svn = base.SVN(repositoryUrl='http://svn/', cache=cache)
+        svn.info(['http://svn/trunk/a', 'http://svn/trunk/b'])
+        # the HEAD probe and one lookup
+        self.assertEqual(len(self.commands), 2)
+
+        cache = base.MetadataCache(self.path('svn.json'))
+        svn = base.SVN(repositoryUrl='http://svn/', cache=cache)
+        infos = svn.info(['http://svn/trunk/a', 'http://svn/trunk/c'])
+        self.assertEqual(len(infos), 2)
+        self.assertEqual(self.commands[-1].split()[-1], 'http://svn/trunk/c')
+        self.assertEqual(len(self.commands), 4)
+
+    def test_head_invalidated_while_probing(self):
+        cache = base.MetadataCache(self.path('svn.json'))
+        svn = base.SVN(repositoryUrl='http://svn/', cache=cache)
+
+        def commitWhileProbing(cmd):
+            # another thread commits and invalidates the heads
+            cache.invalidateHeads()
+            return infoXML(['http://svn/'], head=20)
+        self.outputs = commitWhileProbing
+        self.assertEqual(svn.head(), None)
+        self.assertEqual(cache.heads, {})
+
+        self.outputs = lambda cmd: infoXML(['http://svn/'], head=21)
+        self.assertEqual(svn.head(), 21)
+        self.assertEqual(svn.head(), 21)
+        self.assertEqual(len(self.commands), 2)
+        svn.cp('http://svn/trunk/a', 'http://svn/tags/a-1.0', 'tag')
+        self.assertEqual(cache.heads, {})
+
+    def test_resolveRevisions(self):
+        self.outputs = self.answer
+        builders = []
+        for name in ('a', 'b', 'c'):
+            builder = package.PackageBuilder(name, Options())
+            builder.svn = base.SVN()
+            builder.svnRepositoryUrl = 'http://svn/'
+            builders.append(builder)
+        package.resolveRevisions(builders)
+        self.assertEqual(len(self.commands), 1)
+        self.assertEqual(builders[2].getRevision('http://svn/trunk/c'),
+                         (20, 12))
+        self.assertEqual(len(self.commands), 1)
+
+
+def logXML(entries):
+    # the output of ``svn log --xml -v`` for (revision, paths) entries
+    return '<?xml version="1.0"?>\n<log>%s</log>\n' % ''.join([
+        '<logentry revision="%i"><author>joe</author><paths>%s</paths>'
+        '</logentry>' % (revision, ''.join([
+            '<path action="M" kind="file">%s</path>' % path
+            for path in paths]))
+        for revision, paths in entries])
+
+
+class ChangeDetectorTest(SVNTestCase):
+
+    def builder(self, name, tagRevision, head=30, root='http://svn'):
+        builder = package.PackageBuilder(name, Options())
+        builder.svn = base.SVN()
+        builder.svnRepositoryUrl = root + '/'
+        builder.versions = ['1.0']
+        builder.revisions = {}
+        branchUrl = builder.getBranchURL('trunk')
+        tagUrl = builder.getTagURL('1.0')
+        builder.revisions[base.normalizeURL(branchUrl)] = base.SVNInfo(
+            head, head, branchUrl, root)
+        if tagRevision is not None:
+            builder.revisions[base.normalizeURL(tagUrl)] = base.SVNInfo(
+                head, tagRevision, tagUrl, root)
+        return builder
+
+    def changed(self, builder):
+        return builder.changes.get(('1.0', 'trunk'))
+
+    def test_detect(self):
+        self.outputs = [logXML([
+            # versions in setup.py do not count
+            (12, ['/trunk/pkg.a/setup.py']),
+            # before the release of pkg.ab, and not below pkg.a/src
+            (13, ['/trunk/pkg.ab/src/pkg/ab.py']),
+            (20, ['/trunk/pkg.b/src/pkg/b.py', '/trunk/pkg.ab/src']),
+            ])]
+        a = self.builder('pkg.a', 10)
+        ab = self.builder('pkg.ab', 15)
+        b = self.builder('pkg.b', 10)
+        package.ChangeDetector('trunk').detect([a, ab, b])
+        # one log from the oldest release below the common directory
+        self.assertEqual(self.commands, [
+            'svn log --non-interactive  --xml -v -r 11:30 http://svn/trunk'])
+        self.assertEqual(self.changed(a), False)
+        self.assertEqual(self.changed(ab), True)
+        self.assertEqual(self.changed(b), True)
+        self.assertTrue(ab.hasChangedSince('1.0', 'trunk'))
+        self.assertFalse(a.hasChangedSince('1.0', 'trunk'))
+        self.assertEqual(len(self.commands), 1)
+
+    def test_nothing_committed(self):
+        a = self.builder('pkg.a', 30)
+        package.ChangeDetector('trunk').detect([a])
+        self.assertEqual(self.commands, [])
+        self.assertEqual(self.changed(a), False)
+
+    def test_roots(self):
+        # the paths of a log are relative to the root of its repository
+        logs = {'http://svn/trunk/pkg.a': [(12, ['/trunk/pkg.a/src/a.py'])],
+                'http://other/trunk/pkg.b': [(12, ['/trunk/pkg.b/setup.py'])]}
+        self.outputs = lambda cmd: logXML(logs[cmd.split()[-1]])
+        a = self.builder('pkg.a', 10)
+        b = self.builder('pkg.b', 10, root='http://other')
+        package.ChangeDetector('trunk').detect([a, b])
+        self.assertEqual(sorted([cmd.split()[-1] for cmd in self.commands]),
+                         sorted(logs.keys()))
+        self.assertEqual(self.changed(a), True)
+        self.assertEqual(self.changed(b), False)
+
+    def test_missing_tag_revision(self):
+        # packages without the tag revision check their revisions later
+        self.outputs = [logXML([(20, ['/trunk/pkg.b/src/b.py'])])]
+        a = self.builder('pkg.a', None)
+        b = self.builder('pkg.b', 10)
+        package.ChangeDetector('trunk').detect([a, b])
+        self.assertEqual(self.commands[0].split()[-1],
+                         'http://svn/trunk/pkg.b')
+        self.assertEqual(a.changes, {})
+        self.assertEqual(self.changed(b), True)
+
+        def answer(cmd):
+            url = cmd.split()[-1]
+            return infoXML([url]).replace(
+                'revision="10"', 'revision="%i"' % (
+                    url.endswith('/src') and 25 or 10))
+        self.outputs = answer
+        self.assertTrue(a.hasChangedSince('1.0', 'trunk'))
+        self.assertEqual(
+            [cmd.split()[-1] for cmd in self.commands[1:]],
+            ['http://svn/trunk/pkg.a/src', 'http://svn/tags/pkg.a-1.0'])
+
+    def test_log_unavailable(self):
+        self.outputs = ['svn: E170013: Unable to connect\n']
+        a = self.builder('pkg.a', 10)
+        package.ChangeDetector('trunk').detect([a])
+        self.assertEqual(a.changes, {})
+
+
+class ReleaseOptions(Options):
+    offline = False
+    noBranchUpdate = False
+
+
+class ReleasingBuilder(package.PackageBuilder):
+    """Records the release steps instead of running them; `fail` names the
+    step that fails."""
+
+    fail = None
+    distributed = None
+    released = False
+
+    def __init__(self, pkg, fail=None):
+        package.PackageBuilder.__init__(self, pkg, ReleaseOptions())
+        self.fail = fail
+        self.svn = base.SVN()
+        self.svnRepositoryUrl = 'http://svn/'
+        self.pendingRelease = ('1.0', 'trunk')
+        self.journal = state.Journal()
+
+    def check(self, step):
+        if self.fail == step:
+            base.logger.error('%s of %s failed' % (step, self.pkg))
+            sys.exit(1)
+
+    def createRelease(self, version, branch):
+        self.check('release')
+        self.released = True
+
+    def tagOperations(self, branchUrl, tagUrl, version):
+        self.check('tag')
+        return [('cp', 10, branchUrl, tagUrl)]
+
+    def distribute(self, version, tagUrl, tagDir, revision):
+        self.check('distribute')
+        self.distributed = revision
+
+    def branchVersionOperations(self, branchUrl, version, revision):
+        return [('put', '1.1dev', branchUrl + '/setup.py')], '1.1dev'
+
+
+class ReleaseExecutorTest(SVNTestCase):
+
+    def setUp(self):
+        super(ReleaseExecutorTest, self).setUp()
+        self.messages = []
+        self.handler = logging.Handler()
+        self.handler.emit = lambda record: self.messages.append(
+            record.getMessage())
+        base.logger.addHandler(self.handler)
+        self.level = base.logger.level
+        base.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        base.logger.removeHandler(self.handler)
+        base.logger.setLevel(self.level)
+        super(ReleaseExecutorTest, self).tearDown()
+
+    def committed(self, revision):
+        return 'r%i committed by joe at 2013-12-01T00:00:00Z\n' % revision
+
+    def test_batch(self):
+        self.outputs = [self.committed(42), self.committed(43)]
+        builders = [ReleasingBuilder('pkg.a'), ReleasingBuilder('pkg.b')]
+        failed = package.ReleaseExecutor(2, batch=True).run(builders)
+        self.assertEqual(failed, [])
+        # one commit for all tags, one for all branch versions
+        self.assertEqual(len(self.commands), 2)
+        for builder in builders:
+            self.assertTrue(builder.getTagURL('1.0') in self.commands[0])
+            self.assertTrue(builder.getBranchURL('trunk') + '/setup.py'
+                            in self.commands[1])
+            self.assertEqual(builder.distributed, 42)
+            self.assertEqual(builder.getStep('tag'), 42)
+            self.assertTrue(builder.isDone('branch'))
+            self.assertEqual(builder.pendingRelease, None)
+        # the branch versions are committed against the tagging revision
+        self.assertTrue(' -r 42 ' in self.commands[1])
+        self.assertEqual(self.messages[-1], '2 releases created, 0 failed')
+
+    def test_batch_tag_commit_fails(self):
+        self.outputs = ['svnmucc: E160020: Path already exists\n']
+        builders = [ReleasingBuilder('pkg.a'), ReleasingBuilder('pkg.b')]
+        failed = package.ReleaseExecutor(2, batch=True).run(builders)
+        self.assertEqual(failed, builders)
+        self.assertEqual(len(self.commands), 1)
+        for builder in builders:
+            self.assertEqual(builder.distributed, None)
+            self.assertFalse(builder.isDone('tag'))
+            self.assertEqual(builder.pendingRelease, ('1.0', 'trunk'))
+        self.assertEqual(self.messages[-1], '0 releases created, 2 failed')
+
+    def test_batch_partial(self):
+        self.outputs = [self.committed(42), self.committed(43)]
+        a = ReleasingBuilder('pkg.a', fail='distribute')
+        b = ReleasingBuilder('pkg.b')
+        failed = package.ReleaseExecutor(2, batch=True).run([a, b])
+        self.assertEqual(failed, [a])
+        # only the released package gets its next version
+        self.assertFalse(a.getBranchURL('trunk') in self.commands[1])
+        self.assertTrue(b.getBranchURL('trunk') in self.commands[1])
+        self.assertFalse(a.isDone('branch'))
+        self.assertTrue(b.isDone('branch'))
+        # the tag exists, a resumed run only distributes
+        self.assertEqual(a.getStep('tag'), 42)
+        self.assertEqual(a.pendingRelease, ('1.0', 'trunk'))
+        self.assertEqual(b.pendingRelease, None)
+        self.assertTrue('Release of pkg.a 1.0 failed: SystemExit: 1'
+                        in self.messages)
+        self.assertEqual(self.messages[-1], '1 releases created, 1 failed')
+
+    def test_parallel_partial(self):
+        builders = [ReleasingBuilder('pkg.%i' % i, fail=(i == 1 and 'release'))
+                    for i in range(4)]
+        failed = package.ReleaseExecutor(3).run(builders)
+        self.assertEqual(failed, [builders[1]])
+        self.assertEqual(self.commands, [])
+        self.assertEqual([builder.released for builder in builders],
+                         [True, False, True, True])
+        # the error is attributed to its package
+        self.assertTrue('[pkg.1] release of pkg.1 failed' in self.messages)
+        self.assertEqual(self.messages[-1], '3 releases created, 1 failed')
+
+
+class MetadataCacheTest(TempDirTestCase):
+
+    def test_head(self):
+        cache = base.MetadataCache(self.path('svn.json'))
+        cache.set('ls', 'http://svn/trunk/', 20, ['setup.py'])
+        self.assertEqual(cache.get('ls', 'http://svn/trunk', 20),
+                         ['setup.py'])
+        self.assertEqual(cache.get('ls', 'http://svn/trunk', 21), None)
+        self.assertEqual(cache.get('cat', 'http://svn/trunk', 20), None)
+
+    def test_ttl(self):
+        cache = base.MetadataCache(self.path('svn.json'), ttl=60)
+        cache.set('ls', 'http://svn/trunk', 20, ['setup.py'])
+        cache.data['ls http://svn/trunk']['time'] -= 120
+        self.assertEqual(cache.get('ls', 'http://svn/trunk', 20), None)
+
+    def test_save(self):
+        cache = base.MetadataCache(self.path('cache', 'svn.json'))
+        cache.set('ls', 'http://svn/trunk', 20, ['setup.py'])
+        cache.save()
+        cache = base.MetadataCache(self.path('cache', 'svn.json'))
+        self.assertEqual(cache.get('ls', 'http://svn/trunk', 20),
+                         ['setup.py'])
+        open(self.path('cache', 'svn.json'), 'w').write('{broken')
+        self.assertEqual(base.MetadataCache(self.path('cache', 'svn.json'))
+                         .data, {})
+
+    def test_save_shared(self):
+        # builds sharing the cache directory save at the same time
+        caches = [base.MetadataCache(self.path('svn.json')) for i in range(4)]
+        for index, cache in enumerate(caches):
+            cache.set('ls', 'http://svn/trunk', 20, ['setup.py'] * 1000)
+
+        def save(cache):
+            for i in range(20):
+                cache.save()
+        results = base.runParallel(save, caches, len(caches))
+        self.assertEqual(results, [(None, None)] * len(caches))
+        self.assertEqual(os.listdir(self.tmpdir), ['svn.json'])
+        cache = base.MetadataCache(self.path('svn.json'))
+        self.assertEqual(len(cache.get('ls', 'http://svn/trunk', 20)), 1000)
+
+
+class MuccTest(SVNTestCase):
+
+    def test_revision(self):
+        self.outputs = ['r42 committed by joe at 2013-12-01T00:00:00Z\n']
+        svn = base.SVN()
+        revision = svn.mucc(
+            [('cp', 40, 'http://svn/trunk/pkg', 'http://svn/tags/pkg-1.0'),
+             ('put', 'setup', 'http://svn/tags/pkg-1.0/setup.py')],
+            'Create release tag 1.0.', 40)
+        self.assertEqual(revision, 42)
+        command = self.commands[0]
+        self.assertTrue(command.startswith(
+            'svnmucc --non-interactive  -m "Create release tag 1.0." -r 40 '
+            'cp 40 http://svn/trunk/pkg http://svn/tags/pkg-1.0 put '))
+        self.assertTrue(command.endswith(
+            '/put-1 http://svn/tags/pkg-1.0/setup.py'))
+
+    def test_createTag(self):
+        # the tag is pinned to the revision the release was decided on
+        def answer(cmd):
+            if cmd.startswith('svn cat'):
+                return "setup(version = '1.1dev',)\n"
+            if cmd.startswith('svn ls'):
+                return ('<lists><list path="x"><entry kind="file">'
+                        '<name>setup.py</name></entry></list></lists>')
+            return 'r42 committed by joe\n'
+        self.outputs = answer
+        builder = package.PackageBuilder('pkg', Options())
+        builder.svn = base.SVN()
+        builder.revisions = {'http://svn/trunk/pkg': base.SVNInfo(
+            40, 38, 'http://svn/trunk/pkg', 'http://svn')}
+        self.assertEqual(builder.createTag(
+            'http://svn/trunk/pkg/', 'http://svn/tags/pkg-1.0', '1.0'), 42)
+        self.assertEqual(self.commands[0],
+                         'svn cat --non-interactive  '
+                         'http://svn/trunk/pkg/setup.py@40')
+        self.assertTrue(' -r 40 cp 40 http://svn/trunk/pkg ' in
+                        self.commands[-1])
+
+    def test_no_revision(self):
+        self.outputs = ['']
+        self.assertRaises(SystemExit, base.SVN().mucc,
+                          [('rm', 'http://svn/tags/pkg-1.0')], 'Remove.')
+
+
+class Builder(object):
+
+    def __init__(self, pkg, version, revision=(10, 9)):
+        self.pkg = pkg
+        self.chosenVersion = version
+        self.chosenBranch = 'trunk'
+        self.branchRevision = revision
+
+
+class BuildStateTest(TempDirTestCase):
+
+    def setUp(self):
+        super(BuildStateTest, self).setUp()
+        self.config = self.path('project.cfg')
+        open(self.config, 'w').write('[buildout]\n')
+        self.buildState = state.BuildState(self.path('state.json'))
+        self.buildState.setBuild(
+            [('pkg', '1.0', 'trunk', (10, 9))], [self.config], '2.0')
+        self.buildState.save()
+
+    def test_load(self):
+        buildState = state.BuildState(self.path('state.json'))
+        self.assertEqual(buildState.projectVersion, '2.0')
+        self.assertEqual(buildState.getPackage('pkg'),
+                         ('1.0', 'trunk', (10, 9)))
+        self.assertEqual(buildState.getPackage('other'), None)
+
+    def test_packagesChanged(self):
+        self.assertFalse(self.buildState.packagesChanged({'pkg': '1.0'}))
+        self.assertTrue(self.buildState.packagesChanged({'pkg': '1.1'}))
+        self.assertTrue(self.buildState.packagesChanged(
+            {'pkg': '1.0', 'other': '1.0'}))
+
+    def test_inputsChanged(self):
+        self.assertFalse(self.buildState.inputsChanged([self.config]))
+        other = self.path('other.cfg')
+        open(other, 'w').write('')
+        self.assertTrue(self.buildState.inputsChanged([self.config, other]))
+        open(self.config, 'a').write('x = 1\n')
+        self.assertTrue(self.buildState.inputsChanged([self.config]))
+
+    def test_uploaded(self):
+        self.assertFalse(self.buildState.isUploaded(self.config, 'http://s/'))
+        self.buildState.setUploaded(self.config, 'http://s/')
+        self.assertTrue(self.buildState.isUploaded(self.config, 'http://s'))
+        open(self.config, 'a').write('x = 1\n')
+        self.assertFalse(self.buildState.isUploaded(self.config, 'http://s/'))
+
+    def test_section(self):
+        deploy = self.path('deploy.cfg')
+        open(deploy, 'w').write('[buildout]\n')
+        self.buildState.setSection('ppd', 'key', deploy)
+        self.assertEqual(self.buildState.getSection('ppd', 'key'), deploy)
+        self.assertEqual(self.buildState.getSection('ppd', 'other'), None)
+        open(deploy, 'a').write('x = 1\n')
+        self.assertEqual(self.buildState.getSection('ppd', 'key'), None)
+
+    def test_failed_build_is_not_remembered(self):
+        # regression: the packages of a build that failed to upload were
+        # saved, so that the next build thought nothing changed
+        journal = state.Journal(self.path('journal'))
+        journal.start({'packages': []})
+        build.finishBuild(self.buildState, journal, [Builder('pkg', '1.1')],
+                          False, [self.config], '2.1')
+        buildState = state.BuildState(self.path('state.json'))
+        self.assertTrue(buildState.packagesChanged({'pkg': '1.1'}))
+        self.assertEqual(buildState.projectVersion, '2.0')
+        self.assertTrue(os.path.exists(self.path('journal')))
+
+    def test_complete_build_is_remembered(self):
+        journal = state.Journal(self.path('journal'))
+        journal.start({'packages': []})
+        build.finishBuild(self.buildState, journal, [Builder('pkg', '1.1')],
+                          True, [self.config], '2.1')
+        buildState = state.BuildState(self.path('state.json'))
+        self.assertFalse(buildState.packagesChanged({'pkg': '1.1'}))
+        self.assertEqual(buildState.projectVersion, '2.1')
+        self.assertFalse(os.path.exists(self.path('journal')))
+
+
+class JournalTest(TempDirTestCase):
+
+    def test_resume(self):
+        dist = self.path('pkg-1.0.tar.gz')
+        open(dist, 'w').write('dist')
+        journal = state.Journal(self.path('journal'))
+        journal.start({'packages': [{'name': 'pkg'}]})
+        journal.setStep('pkg', 'tag', 12)
+        kept = journal.keep(dist)
+        journal.setStep('pkg', 'dists', [kept])
+        journal.setUploaded(dist, 'http://s/')
+
+        journal = state.Journal(self.path('journal'))
+        self.assertEqual(journal.plan, {'packages': [{'name': 'pkg'}]})
+        self.assertTrue(journal.isDone('pkg', 'tag'))
+        self.assertEqual(journal.getStep('pkg', 'tag'), 12)
+        self.assertFalse(journal.isDone('pkg', 'upload'))
+        self.assertEqual(open(journal.getStep('pkg', 'dists')[0]).read(),
+                         'dist')
+        self.assertTrue(journal.isUploaded(dist, 'http://s/'))
+
+        journal.finish()
+        self.assertFalse(os.path.exists(self.path('journal')))
+        self.assertFalse(os.path.exists(journal.filesDir))
+
+    def test_start_forgets(self):
+        journal = state.Journal(self.path('journal'))
+        journal.start({'packages': []})
+        journal.setStep('pkg', 'tag', 12)
+        journal.start({'packages': []})
+        self.assertFalse(journal.isDone('pkg', 'tag'))
+
+    def test_in_memory(self):
+        dist = self.path('pkg-1.0.tar.gz')
+        open(dist, 'w').write('dist')
+        journal = state.Journal()
+        journal.start({'packages': []})
+        journal.setStep('pkg', 'tag', 12)
+        self.assertTrue(journal.isDone('pkg', 'tag'))
+        self.assertEqual(journal.keep(dist), dist)
+        journal.finish()
+        self.assertEqual(os.listdir(self.tmpdir), ['pkg-1.0.tar.gz'])
+
+    def test_getJournalPath(self):
+        options = Options()
+        self.assertEqual(state.getJournalPath('project.cfg', options), None)
+        options.cacheDir = self.tmpdir
+        path = state.getJournalPath('project.cfg', options)
+        self.assertEqual(os.path.dirname(path), self.tmpdir)
+        options.journal = 'project.journal'
+        self.assertEqual(state.getJournalPath('project.cfg', options),
+                         'project.journal')
+        options = Options()
+        options.resume = True
+        self.assertRaises(SystemExit, state.getJournalPath, 'project.cfg',
+                          options)
+
+
+class UploadingBuilder(package.PackageBuilder):
+
+    uploaded = None
+
+    def uploadDistributionFiles(self, distributionFileNames):
+        self.uploaded = distributionFileNames
+        self.setStep('upload')
+
+
+class DistributeTest(TempDirTestCase):
+
+    def setUp(self):
+        super(DistributeTest, self).setUp()
+        self.dist = self.path('pkg-1.0.tar.gz')
+        open(self.dist, 'w').write('dist')
+        self.builder = UploadingBuilder('pkg', Options())
+        self.builder.journal = state.Journal(self.path('journal'))
+        self.builder.journal.start({'packages': []})
+
+    def test_resume_dists(self):
+        self.builder.setStep('dists', [self.dist])
+        self.builder.distribute('1.0', 'http://svn/tags/pkg-1.0',
+                                self.path('tag'), 12)
+        self.assertEqual(self.builder.uploaded, [self.dist])
+        self.assertTrue(self.builder.isDone('upload'))
+
+    def test_resume_sdist_journal(self):
+        # journals of runs that did not build wheels yet
+        self.builder.setStep('sdist', self.dist)
+        self.builder.distribute('1.0', 'http://svn/tags/pkg-1.0',
+                                self.path('tag'), 12)
+        self.assertEqual(self.builder.uploaded, [self.dist])
+
+    def test_resume_uploaded(self):
+        self.builder.setStep('upload')
+        self.builder.distribute('1.0', 'http://svn/tags/pkg-1.0',
+                                self.path('tag'), 12)
+        self.assertEqual(self.builder.uploaded, None)
+
+
+class ArtifactCacheTest(TempDirTestCase):
+
+    def setUp(self):
+        super(ArtifactCacheTest, self).setUp()
+        self.cache = base.ArtifactCache(self.path('artifacts'))
+
+    def makeFile(self, name, size=10):
+        filename = self.path(name)
+        open(filename, 'w').write('x' * size)
+        return filename
+
+    def test_store_get(self):
+        self.assertEqual(self.cache.get('pkg', 'http://svn/tags/pkg-1.0', 12),
+                         None)
+        sdist = self.makeFile('pkg-1.0.tar.gz')
+        stored = self.cache.store('pkg', 'http://svn/tags/pkg-1.0', 12,
+                                  [sdist])
+        self.assertEqual(
+            self.cache.get('pkg', 'http://svn/tags/pkg-1.0/', 12), stored)
+        self.assertEqual(open(stored[0]).read(), 'x' * 10)
+        self.assertEqual(self.cache.get('pkg', 'http://svn/tags/pkg-1.0', 13),
+                         None)
+
+    def test_wheels(self):
+        sdist = self.makeFile('pkg-1.0.tar.gz')
+        wheel = self.makeFile('pkg-1.0-py2-none-any.whl')
+        self.cache.store('pkg', 'http://svn/tags/pkg-1.0', 12, [sdist])
+        self.assertEqual(
+            self.cache.get('pkg', 'http://svn/tags/pkg-1.0', 12, True), None)
+        stored = self.cache.store('pkg', 'http://svn/tags/pkg-1.0', 12,
+                                  [sdist, wheel], True)
+        self.assertEqual(
+            self.cache.get('pkg', 'http://svn/tags/pkg-1.0', 12, True),
+            stored)
+        self.assertEqual(
+            len(self.cache.get('pkg', 'http://svn/tags/pkg-1.0', 12)), 1)
+
+    def test_missing_file(self):
+        sdist = self.makeFile('pkg-1.0.tar.gz')
+        wheel = self.makeFile('pkg-1.0-py2-none-any.whl')
+        stored = self.cache.store('pkg', 'http://svn/tags/pkg-1.0', 12,
+                                  [sdist, wheel], True)
+        os.remove(stored[1])
+        self.assertEqual(
+            self.cache.get('pkg', 'http://svn/tags/pkg-1.0', 12, True), None)
+
+    def test_prune(self):
+        for revision in range(1, 5):
+            self.cache.store('pkg', 'http://svn/tags/pkg-1.0', revision,
+                             [self.makeFile('pkg-1.0.tar.gz', 1000)])
+            # distinct last use times
+            for lastUsed, size, path, meta in self.cache.entries():
+                os.utime(os.path.join(path, 'meta.json'),
+                         (meta['revision'], meta['revision']))
+        self.assertEqual(len(self.cache.entries()), 4)
+        self.cache.get('pkg', 'http://svn/tags/pkg-1.0', 1)
+        self.assertEqual(self.cache.prune(2500), 2)
+        self.assertEqual(
+            sorted([meta['revision'] for lastUsed, size, path, meta
+                    in self.cache.entries()]), [1, 4])
+        self.assertEqual(self.cache.prune(), 0)
+
+    def test_prune_on_store(self):
+        self.cache.maxSize = 1500
+        self.cache.store('pkg', 'http://svn/tags/pkg-1.0', 1,
+                         [self.makeFile('pkg-1.0.tar.gz', 1000)])
+        self.cache.store('pkg', 'http://svn/tags/pkg-1.0', 2,
+                         [self.makeFile('pkg-1.0.tar.gz', 1000)])
+        self.assertEqual(self.cache.get('pkg', 'http://svn/tags/pkg-1.0', 1),
+                         None)
+        self.assertNotEqual(
+            self.cache.get('pkg', 'http://svn/tags/pkg-1.0', 2), None)
+
+
+class WheelTest(unittest.TestCase):
+
+    def test_isPureWheel(self):
+        self.assertTrue(package.isPureWheel(
+            '/dist/keas.build-0.4.2-py2-none-any.whl'))
+        self.assertTrue(package.isPureWheel(
+            'keas.build-0.4.2-py2.py3-none-any.whl'))
+        self.assertFalse(package.isPureWheel(
+            'lxml-3.2.1-cp27-cp27mu-linux_x86_64.whl'))
+        self.assertFalse(package.isPureWheel(
+            'pkg-1.0-cp27-none-linux_x86_64.whl'))
+
+
+@unittest.skipUnless(sdist.isSupported(), 'needs os.fork')
+class SdistTest(TempDirTestCase):
+
+    def writeSetup(self, code):
+        open(self.path('setup.py'), 'w').write(code)
+
+    def test_build(self):
+        self.writeSetup(
+            'import os, sys\n'
+            'os.mkdir("dist")\n'
+            'open("dist/pkg-1.0.tar.gz", "w").write(" ".join(sys.argv[1:]))\n'
+            'print "built"\n')
+        code, output, files, duration, timedOut = sdist.build(
+            self.tmpdir, ('sdist',))
+        self.assertEqual(code, 0)
+        self.assertEqual(output, 'built\n')
+        self.assertEqual(files, [self.path('dist', 'pkg-1.0.tar.gz')])
+        self.assertEqual(open(files[0]).read(), 'sdist')
+        self.assertFalse(timedOut)
+
+    def test_error(self):
+        self.writeSetup('import sys\nsys.exit("broken")\n')
+        code, output, files, duration, timedOut = sdist.build(
+            self.tmpdir, ('sdist',))
+        self.assertEqual(code, 1)
+        self.assertEqual(output, 'broken\n')
+        self.assertEqual(files, [])
+
+    def test_timeout(self):
+        self.writeSetup('import time\ntime.sleep(30)\n')
+        code, output, files, duration, timedOut = sdist.build(
+            self.tmpdir, ('sdist',), timeout=0.2)
+        self.assertTrue(timedOut)
+        self.assertNotEqual(code, 0)
+        self.assertTrue(duration < 10)
+
+
+def test_suite():
+    return unittest.TestSuite([
+        unittest.makeSuite(CommandTest),
+        unittest.makeSuite(LinkExtractorTest),
+        unittest.makeSuite(HTTPSessionTest),
+        unittest.makeSuite(FetchTest),
+        unittest.makeSuite(FindVersionsTest),
+        unittest.makeSuite(UploadTest),
+        unittest.makeSuite(StreamBodyTest),
+        unittest.makeSuite(FindServerFilesTest),
+        unittest.makeSuite(BuildTest),
+        unittest.makeSuite(PlanTest),
+        unittest.makeSuite(PageCacheTest),
+        unittest.makeSuite(SVNInfoTest),
+        unittest.makeSuite(ChangeDetectorTest),
+        unittest.makeSuite(ReleaseExecutorTest),
+        unittest.makeSuite(MetadataCacheTest),
+        unittest.makeSuite(MuccTest),
+        unittest.makeSuite(ExtendsGraphTest),
+        unittest.makeSuite(AddHashesTest),
+        unittest.makeSuite(BuildStateTest),
+        unittest.makeSuite(JournalTest),
+        unittest.makeSuite(DistributeTest),
+        unittest.makeSuite(ArtifactCacheTest),
+        unittest.makeSuite(WheelTest),
+        unittest.makeSuite(SdistTest),
+        ])